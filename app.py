@@ -1,24 +1,110 @@
 import os
 from pathlib import Path
 import json
+import asyncio
+import hashlib
+import threading
+import concurrent.futures
+import weakref
+import time
+import uuid
+from string import hexdigits
 from abc import ABC, abstractmethod
+from collections import OrderedDict
 
-from flask import Flask, render_template, request
+from flask import Flask, Response, abort, current_app, g, jsonify, \
+        render_template, request, stream_with_context
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
 
-from openAiApi import ApiManager
+from tokenizer import getTokenizer
+from conversation import ConversationStore
+from conversationLog import ConversationLog
+from completionCache import CompletionCache
+from dataset import DatasetReport, preprocess, trainingCost
+from fineTuneTracker import FineTuneTracker
+from singleFlight import SingleFlight
+import scheduler
+from sharedState import SharedStore, SharedDict, SqliteConversationBackend
+import metrics
 
 
 USER="user-cvzkspjueh4uqrj9ppvbenwv"
-app = Flask(__name__)
-app.config["UPLOAD_FOLDER"] = "UploadedFiles"
 
-if not os.path.exists("UploadedFiles"):
-    os.mkdir("UploadedFiles")
+#path of a sqlite database to share state through, so several processes of
+#the app behave as one, e.g.
+#    AI9_SHARED_STATE=MetaData/shared.sqlite gunicorn -w 4 app:app
+#Unset, everything is kept in this process
+SHARED_STATE = os.environ.get("AI9_SHARED_STATE")
+#seconds after which a request is sampled by the profiler, unset for none
+SLOW_REQUEST_SECONDS = os.environ.get("AI9_SLOW_REQUEST_SECONDS")
 
+REQUEST_SECONDS = metrics.histogram("ai9_request_seconds",
+        "time to answer a request", ["endpoint"])
+REQUESTS_IN_FLIGHT = metrics.gauge("ai9_requests_in_flight",
+        "requests being answered")
+HANDLER_SECONDS = metrics.histogram("ai9_handler_seconds",
+        "time in Controller handlers", ["handler"])
+RENDER_SECONDS = metrics.histogram("ai9_render_seconds",
+        "time rendering templates", ["template"])
+APP_DATA_WRITE_SECONDS = metrics.histogram("ai9_app_data_write_seconds",
+        "time persisting a PersistentAppData mutation", ["file"])
+API_CACHE_READS = metrics.counter("ai9_api_cache_reads_total",
+        "ApiDataCache reads, by whether they were fresh, stale or missed",
+        ["resource", "result"])
+SECTION_CACHE_READS = metrics.counter("ai9_section_cache_reads_total",
+        "renders of versioned page sections, by whether the html was cached",
+        ["section", "result"])
 
 
 
+
+SESSION_COOKIE = "sessionId"
+def getSessionId(request):
+    '''
+    The session of a request, from its session cookie. A request without a
+    (well formed) cookie starts a new session, and setSessionCookie hands the
+    id to the browser on the way out.
+    @param flask.Request request : the request
+    @returns string: the session id
+    '''
+    if "sessionId" not in g:
+        sessionId = request.cookies.get(SESSION_COOKIE, "")
+        if len(sessionId) != 32 or not all(c in hexdigits for c in sessionId):
+            sessionId = uuid.uuid4().hex
+            g.newSession = True
+        g.sessionId = sessionId
+    return g.sessionId
+
+slowRequestSampler = metrics.SlowRequestSampler(float(SLOW_REQUEST_SECONDS)) \
+        if SLOW_REQUEST_SECONDS else None
+
+def startRequest():
+    g.requestStart = time.perf_counter()
+    REQUESTS_IN_FLIGHT.inc()
+    if slowRequestSampler is not None:
+        g.sampleToken = slowRequestSampler.begin(request.endpoint or "none")
+
+def finishRequest(error):
+    #a streamed response keeps its request context until the stream is done,
+    #and flask tears it down when the view returns as well as then
+    if g.get("streaming") and not g.get("streamDone"):
+        return
+    requestStart = g.pop("requestStart", None)
+    if requestStart is None:
+        return
+    REQUESTS_IN_FLIGHT.dec()
+    REQUEST_SECONDS.observe(time.perf_counter() - requestStart,
+            endpoint=request.endpoint or "none")
+    if "sampleToken" in g:
+        slowRequestSampler.end(g.sampleToken)
+
+def setSessionCookie(response):
+    if g.get("newSession"):
+        response.set_cookie(SESSION_COOKIE, g.sessionId, httponly=True,
+                samesite="Lax")
+    return response
+
 VALID_FILE_EXTENSIONS = {"json"}
 def isValidFilename(filename):
     '''
@@ -27,25 +113,61 @@ def isValidFilename(filename):
     return '.' in filename and \
             filename.rsplit('.', 1)[1].lower() in VALID_FILE_EXTENSIONS
 
+def fileStatus(apiManager, apiCache, fileId):
+    '''
+    asks the api once, without waiting, whether it is still processing a
+    file. If it is, the files are invalidated, so the files section shows it
+    as pending from now on, and the page's polling shows when it is done
+    @param ApiManager apiManager: interaface to the api
+    @param ApiDataCache apiCache: the cache for api data
+    @param string fileId: the file
+    @returns tuple: whether the file is pending, and its status
+    '''
+    #imported here, so importing the app doesn't import the openai sdk
+    from openAiApi import PENDING_FILE_STATUSES
+    status = apiManager.getFileStatus(fileId)
+    pending = status in PENDING_FILE_STATUSES
+    if pending:
+        apiCache.invalidate("files")
+    return pending, status
+
 class Controller:
     '''
     This is the main controller of the application. Handlers are registered
     with the controller for different forms, and the controller shall direct
     requests to the appropriate handlers
     @attribute TemplateRenderer templateGen: passed to handlers on handle.
-      The hanlders modify the TemplateRenderer, and controller calls render
+      The hanlders modify the TemplateRenderer, and controller calls render.
+      Every request gets a fork of it, so requests can run at the same time
     @method index(request) : returns html for a request to index page
+    @method aindex(request) : async index, for the async server
+    @method api(section, request) : one section of the page as json
+    @method fragment(section, request) : one section of the page as html
     @method registerHandler(name, handler) : register handler to listen for form
     @method removeHander(name) : remove a registered handler
+    Sections answer with an ETag and a 304 when the client already has them.
+    A post that sends X-Section-Etags (json, section->etag the page has) gets
+    json back instead of the whole page: the notice, and the html of only the
+    sections whose etag changed.
     '''
-    def __init__(self, templateGen, dataCache, dataParser):
+
+    #parts of the page that can be fetched and updated on their own
+    SECTIONS = ("conversation", "files", "models", "fineTunes")
+    #the query or form parameter with the page shown of each paged section
+    PAGE_ARGS = {"files": "filesPage", "fineTunes": "fineTunesPage"}
+
+    def __init__(self, templateGen, dataCache, registry, conversations):
         '''
         @param TemplateRenderer templateGen : template renderer for index page
+        @param ApiDataCache dataCache : the cache for api data
+        @param ApiRegistry registry : indexed, parsed api data
+        @param ConversationStore conversations : conversation of every session
         '''
         self._handlers = {}
         self._templateGen = templateGen
         self._apiCache = dataCache
-        self._apiDataParser = dataParser
+        self._registry = registry
+        self._conversations = conversations
 
     def index(self, request):
         '''
@@ -60,21 +182,13 @@ class Controller:
 
     def handleStartup(self, request):
         '''
-        Serves initial webpage
+        Serves initial webpage from the ApiDataCache, without waiting on the api
+        unless the cache is empty
         @param flask.Request request : the post or get request
         @returns html for index page
         '''
-        self._apiCache.refresh() 
-        filenames = self._apiDataParser.getFilenames(
-                self._apiCache.getFileData())
-        self._templateGen.set("files", filenames)
-        modelNames = self._apiDataParser.getModelnames(
-                self._apiCache.getModels())
-        self._templateGen.set("models", modelNames)
-        fineTunes = self._apiDataParser.getFineTunes(
-                self._apiCache.getFineTunes())
-        self._templateGen.set("fineTunes", fineTunes)
-        return self._templateGen.render()
+        templateGen = self._fill(*self._pages(request))
+        return self._respond(request, templateGen)
 
     def post(self, request):
         '''
@@ -86,8 +200,236 @@ class Controller:
         '''
         for name in request.form.keys():
             if name in self._handlers:
-                self._handlers[name].handle(request, self._templateGen)
-                return self._templateGen.render()
+                templateGen = self._fill(*self._pages(request))
+                with HANDLER_SECONDS.time(handler=name):
+                    self._handlers[name].handle(request, templateGen)
+                return self._respond(request, templateGen)
+
+    async def aindex(self, request):
+        '''
+        index for the async server. Handlers with an async implementation run
+        on the event loop, the rest on worker threads
+        @param flask.Request request : the post or get request
+        @returns html for index page
+        '''
+        if request.method=="GET":
+            return await asyncio.to_thread(self.handleStartup, request)
+        for name in request.form.keys():
+            if name in self._handlers:
+                #filling may have to fetch, if the cache is empty
+                templateGen = await asyncio.to_thread(self._fill,
+                        *self._pages(request))
+                with HANDLER_SECONDS.time(handler=name):
+                    await self._handlers[name].ahandle(request, templateGen)
+                return self._respond(request, templateGen)
+
+    def _fill(self, filesPage=1, fineTunesPage=1):
+        '''
+        @param int filesPage: the page of the files shown
+        @param int fineTunesPage: the page of the fine tunes shown
+        @returns TemplateRenderer: a fork of the renderer for one request, with
+          the api data sections filled in. Handlers overwrite what they change
+        '''
+        templateGen = self._templateGen.fork()
+        #the key is read before the data, so html is never kept under a key
+        #newer than its data
+        key = self._sectionKey("files", filesPage)
+        templateGen.setSection("files", self._registry.getFilenames(filesPage),
+                key)
+        key = self._sectionKey("models")
+        templateGen.setSection("models", self._registry.getModelnames(), key)
+        key = self._sectionKey("fineTunes", fineTunesPage)
+        templateGen.setSection("fineTunes",
+                self._registry.getFineTunes(fineTunesPage), key)
+        #a notice, or a comparison, is only shown on the response to the
+        #post it is for
+        templateGen.set("notice", "")
+        templateGen.set("comparison", [])
+        return templateGen
+
+    def _respond(self, request, templateGen):
+        '''
+        @param TemplateRenderer templateGen : the request's renderer
+        @returns the whole page, or the changed sections if the page's script
+          asked for them
+        '''
+        if "X-Section-Etags" in request.headers:
+            return self._sectionUpdates(request, templateGen)
+        self._setConversation(request, templateGen)
+        self._setEtags(templateGen)
+        return templateGen.render()
+
+    def api(self, section, request):
+        '''
+        @param string section: one of SECTIONS
+        @param flask.Request request : the get request
+        @returns flask.Response: the section as json, or a 304
+        '''
+        data = self._sectionData(section, request)
+        etag = self._sectionEtag("json", section, data)
+        if request.if_none_match.contains(etag):
+            return self._notModified(section, etag)
+        response = jsonify(self._toJson(section, data))
+        if isinstance(data, Page):
+            response.headers["X-Page"] = str(data.page)
+            response.headers["X-Pages"] = str(data.pages)
+        return self._conditional(response, section, etag)
+
+    def fragment(self, section, request):
+        '''
+        @param string section: one of SECTIONS
+        @param flask.Request request : the get request
+        @returns flask.Response: the html of the section, or a 304
+        '''
+        key = self._sectionKey(section, self._sectionPage(section, request))
+        data = self._sectionData(section, request)
+        etag = self._sectionEtag("html", section, data)
+        if request.if_none_match.contains(etag):
+            return self._notModified(section, etag)
+        response = Response(self._templateGen.renderSection(section, data,
+                key))
+        return self._conditional(response, section, etag)
+
+    def _sectionData(self, section, request):
+        '''
+        @param string section: one of SECTIONS, 404 otherwise
+        @param flask.Request request : the request, for its session
+        @returns list: what the section template renders
+        '''
+        if section == "conversation":
+            return self._conversations.getConversation(getSessionId(request))
+        if section == "files":
+            return self._registry.getFilenames(
+                    self._sectionPage(section, request))
+        if section == "models":
+            return self._registry.getModelnames()
+        if section == "fineTunes":
+            return self._registry.getFineTunes(
+                    self._sectionPage(section, request))
+        abort(404)
+
+    def _sectionKey(self, section, page=None):
+        '''
+        @param string section: one of SECTIONS
+        @param int page: the page of it shown
+        @returns tuple: what the section's html is cached under, the version
+          of the data it shows and the page. None for the conversation,
+          which is every session's own
+        '''
+        if section == "conversation":
+            return None
+        #the models are never paged
+        return self._registry.getVersion(section), \
+                None if section == "models" else page
+
+    @staticmethod
+    def _pageArg(request, name):
+        '''
+        @returns int: the page asked for in the query string or the posted
+          form, default 1
+        '''
+        try:
+            return int(request.values.get(name, 1))
+        except ValueError:
+            return 1
+
+    def _sectionPage(self, section, request):
+        '''
+        @returns int: the page of section the request shows, None for a
+          section that isn't paged
+        '''
+        if section not in self.PAGE_ARGS:
+            return None
+        return self._pageArg(request, self.PAGE_ARGS[section])
+
+    def _pages(self, request):
+        '''
+        @returns tuple<int>: the pages of the files and of the fine tunes the
+          request shows, for _fill
+        '''
+        return self._sectionPage("files", request), \
+                self._sectionPage("fineTunes", request)
+
+    @staticmethod
+    def _sectionEtag(kind, section, data):
+        '''
+        @param string kind: the representation, "json" or "html"
+        @returns string: the etag, unquoted
+        '''
+        #a Page serializes as its rows, so its place goes in separately
+        return hashlib.sha1(json.dumps([kind, section,
+                getattr(data, "page", None), getattr(data, "pages", None),
+                data]).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _toJson(section, data):
+        if section == "conversation":
+            return [{"prompt": prompt, "response": response}
+                    for prompt, response in data]
+        if section == "files":
+            return [{"id": fileId, "filename": filename, "status": status}
+                    for fileId, filename, status in data]
+        if section == "fineTunes":
+            return [{"id": row[0], "model": row[1], "baseModel": row[2],
+                    "status": row[3], "trainFile": row[4]} for row in data]
+        return data
+
+    def _conditional(self, response, section, etag):
+        response.set_etag(etag)
+        #the client has to ask every time, but mostly gets a 304
+        response.headers["Cache-Control"] = "no-cache"
+        if section == "conversation":
+            response.headers["Vary"] = "Cookie"
+        return response
+
+    def _notModified(self, section, etag):
+        return self._conditional(Response(status=304), section, etag)
+
+    def _sectionUpdates(self, request, templateGen):
+        '''
+        the answer to a post from the page's script: the notice, and every
+        section that is not what the page has
+        @param flask.Request request : the post, with its X-Section-Etags
+        @param TemplateRenderer templateGen : the request's renderer
+        @returns flask.Response: json, {"notice": string, "sections":
+          {section: {"etag": string, "html": string}}}
+        '''
+        try:
+            known = json.loads(request.headers["X-Section-Etags"])
+        except ValueError:
+            known = {}
+        sections = {}
+        for section in self.SECTIONS:
+            key = self._sectionKey(section,
+                    self._sectionPage(section, request))
+            data = self._sectionData(section, request)
+            etag = self._sectionEtag("html", section, data)
+            if known.get(section) != etag:
+                sections[section] = {"etag": etag,
+                        "html": self._templateGen.renderSection(section, data,
+                        key)}
+        return jsonify({"notice": templateGen.get("notice"),
+                "sections": sections})
+
+    def _setEtags(self, templateGen):
+        '''
+        puts the etag of every section in the page, so the page's script can
+        tell the server what it already has
+        @param TemplateRenderer templateGen : the request's renderer
+        '''
+        templateGen.set("etags", {section: self._sectionEtag("html",
+                section, templateGen.get(section))
+                for section in self.SECTIONS})
+
+    def _setConversation(self, request, templateGen):
+        '''
+        the conversation of the caller's session is put in right before
+        rendering
+        @param flask.Request request : the post or get request
+        @param TemplateRenderer templateGen : the request's renderer
+        '''
+        templateGen.set("conversation",
+                self._conversations.getConversation(getSessionId(request)))
 
     def registerHandler(self, name, handler):
         '''
@@ -112,30 +454,111 @@ class PersistentAppData(dict):
     writes automatically on the set. You also can't currently have two of these
     objects with same filename, and I haven't protected you against that. If
     things get bigger you might implement generator pattern
+    By default every mutation rewrites the whole file. In journal mode a
+    mutation is instead appended as one line to a journal next to the file,
+    which is fsynced every syncEvery mutations and folded back into the json
+    file every compactEvery mutations. The json file keeps today's format, so
+    either mode loads the other's data.
+    An inverse index (value->keys) is kept alongside, so invGet and hasValue
+    don't scan the values.
     @method __setitem__(key, value) : overridden to write to persistent mem 
     @method invGet(inKey) : gets a key though inverse. throws on duplicate key
+    @method hasValue(value) : whether any key maps to value
+    @method flush() : forces the journal to disk
+    @method compact() : folds the journal into the json file
     '''
 
-    def __init__(self, dataFilename):
+    def __init__(self, dataFilename, journal=False, syncEvery=32,
+            compactEvery=1024):
         '''
-        loads in the file specified.
+        loads in the file specified, and replays its journal if there is one.
         If file doesn't exist in MetaData, it will be generated
         @param String dataFilename : the name of the file to read/write. Not
           path. File must be in MetaData directory
+        @param bool journal : use journal mode
+        @param int syncEvery : journal mode fsyncs after this many mutations
+        @param int compactEvery : journal mode compacts after this many
         '''
         #make dir if necessary
         self._filepath = os.path.join("MetaData", dataFilename)
+        self._journalpath = self._filepath + ".journal"
         if not os.path.exists("MetaData"):
             os.mkdir("MetaData")
         #make file if necessary
         if not os.path.exists(self._filepath):
             with(open(self._filepath, 'w')) as fid:
                 fid.write("{}")
+        self._inverse = {}
+        self._lock = threading.RLock()
         #load file
         with open(self._filepath, 'r') as json_file:
             d = json.load(json_file)
             for key, value in d.items():
-                super().__setitem__(key, value)
+                self._set(key, value)
+        #replay journal
+        self._journal = None
+        self._journalLength = 0
+        self._unsynced = 0
+        self._syncEvery = syncEvery
+        self._compactEvery = compactEvery
+        if os.path.exists(self._journalpath):
+            self._replayJournal()
+        if journal:
+            self._journal = open(self._journalpath, 'a')
+
+    def _replayJournal(self):
+        with open(self._journalpath, 'r') as file:
+            for line in file:
+                try:
+                    op, key, value = json.loads(line)
+                except ValueError:
+                    #a torn last line from a crash, the rest is in order
+                    break
+                if op == "set":
+                    self._set(key, value)
+                elif key in self:
+                    self._del(key)
+                self._journalLength += 1
+        #leaving the journal around would make the default mode lose it
+        self.compact()
+
+    def _set(self, key, value):
+        if key in self:
+            self._unindex(key, self[key])
+        super().__setitem__(key, value)
+        self._inverse.setdefault(value, set()).add(key)
+
+    def _del(self, key):
+        self._unindex(key, self[key])
+        super().__delitem__(key)
+
+    def _unindex(self, key, value):
+        keys = self._inverse[value]
+        keys.discard(key)
+        if not keys:
+            del self._inverse[value]
+
+    def _persist(self, op, key, value=None):
+        '''
+        writes one mutation out, whichever way the mode says
+        '''
+        with APP_DATA_WRITE_SECONDS.time(file=self._filepath):
+            self._write(op, key, value)
+
+    def _write(self, op, key, value):
+        if self._journal is None:
+            with open(self._filepath, 'w') as file:
+                json.dump(self, file)
+            return
+        self._journal.write(json.dumps([op, key, value]) + "\n")
+        #flushed every time, so only a power loss can lose unsynced lines
+        self._journal.flush()
+        self._journalLength += 1
+        self._unsynced += 1
+        if self._journalLength >= self._compactEvery:
+            self.compact()
+        elif self._unsynced >= self._syncEvery:
+            self.flush()
 
     def __setitem__(self, key, value):
         '''
@@ -143,36 +566,66 @@ class PersistentAppData(dict):
         @param key : the key to set
         @param value : the value to set
         '''
-        super().__setitem__(key, value)
-        with open(self._filepath, 'w') as file:
-            json.dump(self, file)
+        with self._lock:
+            self._set(key, value)
+            self._persist("set", key, value)
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._del(key)
+            self._persist("del", key)
     
     def delete(self, key):
         del self[key]
-        with open(self._filepath, 'w') as file:
-            json.dump(self, file)
+
+    def flush(self):
+        '''
+        fsyncs the journal, if we have one
+        '''
+        with self._lock:
+            if self._journal is not None:
+                self._journal.flush()
+                os.fsync(self._journal.fileno())
+            self._unsynced = 0
+
+    def compact(self):
+        '''
+        writes the whole mapping to the json file, atomically, then empties the
+        journal
+        '''
+        with self._lock:
+            tmppath = self._filepath + ".tmp"
+            with open(tmppath, 'w') as file:
+                json.dump(self, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmppath, self._filepath)
+            if self._journal is not None:
+                self._journal.truncate(0)
+            elif os.path.exists(self._journalpath):
+                os.remove(self._journalpath)
+            self._journalLength = 0
+            self._unsynced = 0
+
+    def hasValue(self, value):
+        '''
+        @param value : the value to look for
+        @returns bool: whether any key maps to value
+        '''
+        return value in self._inverse
 
     def invGet(self, inKey):
         '''
-        Rather slow andsloppy. Searches all of the values for inKey, then finds
-        associated key.
+        Looks inKey up in the inverse index, then finds associated key.
         @param inKey : the key in reverse dict
         @throws AssertionError: if there are duplicate keys in the inverse
         @throws KeyError: if the key is not in the inverse
         '''
-        out = 'nokeyfoundidentifier39440133' #the inverse value to this key
-        seenKey = False
-        #loop through the dictionary
-        for val, key in self.items():
-            if seenKey:
-                assert(inKey!=key), "duplicate key in inverse"
-            else:
-                if inKey == key:
-                    out = val
-                    seenKey=True
-        if not seenKey:
+        keys = self._inverse.get(inKey)
+        if not keys:
             raise KeyError("key not in inverse")
-        return out
+        assert(len(keys) == 1), "duplicate key in inverse"
+        return next(iter(keys))
 
 class TemplateRenderer:
     '''
@@ -180,18 +633,39 @@ class TemplateRenderer:
     specify the params needed for the jinja template. You can set these
     attributes to change behaviour. Then you call render on the attributes and
     the template
+    Sections are parts of the template with a template of their own,
+    sections/<section>.html, showing the parameter of the same name. render
+    renders them first and hands the template their html as sections.<name>.
+    A section set with a key, which must change whenever its html would,
+    like the version of the data it shows, is rendered once per key: the html
+    is kept, and shared with every fork, until maxCached others push it out.
     @method set(param, val) : reset a parameter to a value
+    @method setSection(section, val, key) : set a section's parameter, with
+      the key its html is cached under
+    @method get(param) : the value of a parameter
+    @method fork() : a copy with parameters of its own
     @method render() : render a template in accordance to the parameters we have
+    @method renderSection(section, val, key) : render one section of the
+      template
     '''
-    def __init__(self, template, attrs):
+    def __init__(self, template, attrs, sections=(), maxCached=64):
         '''
         Setup this renderer with attributes and a template
         @param string template : the template to render
         @param list attrs : a list of attributes that the jinja template uses to
           render
+        @param list sections : the attributes that are sections
+        @param int maxCached : the most section renders kept
         '''
         self._TEMPLATE = template
         self._params = {attr:[] for attr in attrs}
+        self._sections = tuple(sections)
+        #section->key of its value, for those set with one
+        self._keys = {}
+        #(section, key)->html, least recently used first
+        self._cache = OrderedDict()
+        self._maxCached = maxCached
+        self._cacheLock = threading.Lock()
     
     def set(self, param, val):
         '''
@@ -200,17 +674,84 @@ class TemplateRenderer:
         @param val : the value to assign that parameter
         '''
         self._params[param] = val
+        #a section set without a key is rendered afresh
+        self._keys.pop(param, None)
+
+    def setSection(self, section, val, key):
+        '''
+        sets the parameter of a section, and the key its html is cached under
+        @param string section : the section
+        @param val : the value to assign its parameter
+        @param key : hashable, equal only for values that render the same
+        '''
+        self._params[section] = val
+        self._keys[section] = key
+
+    def fork(self):
+        '''
+        @returns TemplateRenderer: a copy whose parameters can be set without
+          touching ours, for the state of one request. It shares our cache
+        '''
+        forked = TemplateRenderer(self._TEMPLATE, [], self._sections,
+                self._maxCached)
+        forked._params = dict(self._params)
+        forked._keys = dict(self._keys)
+        forked._cache = self._cache
+        forked._cacheLock = self._cacheLock
+        return forked
+
+    def get(self, param):
+        '''
+        @param param : the template parameter
+        @returns the value it has
+        '''
+        return self._params[param]
 
     def render(self):
         '''
-        renders the template according to the parameters we have
+        renders the template according to the parameters we have, and the
+        sections that are not cached
         '''
-        return render_template(self._TEMPLATE, **self._params)
+        sections = {section: Markup(self.renderSection(section,
+                self._params[section], self._keys.get(section)))
+                for section in self._sections}
+        with RENDER_SECONDS.time(template=self._TEMPLATE):
+            return render_template(self._TEMPLATE, sections=sections,
+                    **self._params)
+
+    def renderSection(self, section, val, key=None):
+        '''
+        renders sections/<section>.html, the part of the template that shows
+        the parameter of the same name
+        @param string section : the section, named after its parameter
+        @param val : the value of that parameter
+        @param key : see setSection. None renders without the cache
+        @returns string: the html of the section
+        '''
+        if key is not None:
+            with self._cacheLock:
+                html = self._cache.get((section, key))
+                if html is not None:
+                    self._cache.move_to_end((section, key))
+            SECTION_CACHE_READS.inc(section=section,
+                    result="miss" if html is None else "hit")
+            if html is not None:
+                return html
+        template = "sections/{}.html".format(section)
+        with RENDER_SECONDS.time(template=template):
+            html = render_template(template, **{section: val})
+        if key is not None:
+            with self._cacheLock:
+                self._cache[(section, key)] = html
+                while len(self._cache) > self._maxCached:
+                    self._cache.popitem(last=False)
+        return html
 
 class Handler(ABC):
     '''
     abstract class for handler. Must implement handle method.
     @method handle(request, templateGen)
+    @method ahandle(request, templateGen) : async handle, for the async server
     '''
 
     @abstractmethod
@@ -222,6 +763,15 @@ class Handler(ABC):
         '''
         pass
 
+    async def ahandle(self, request, templateGen):
+        '''
+        handle for the event loop. Unless a handler has an async version,
+        handle runs on a worker thread so it doesn't block the loop
+        @param Request request: the post request object
+        @param TemplateRenderer templateGen : the template generator to update
+        '''
+        await asyncio.to_thread(self.handle, request, templateGen)
+
 class SubmitButtonHandler(Handler):
     '''
     Handler for the submission of a prompt.
@@ -229,38 +779,86 @@ class SubmitButtonHandler(Handler):
     updating those things/clearing them. This violates single responsibility
     prinicple, and probably should be refactored if this area is developed, but
     this code has been fairly stable.
-    @method clear() : clears the prompts and responses
+    The conversations themselves live in a ConversationStore, one per
+    session.
+    @method clear(sessionId) : clears the prompts and responses of a session
     '''
 
-    def __init__(self, apiManager):
+    def __init__(self, apiManager, conversations):
         '''
         @param ApiManager apiManager: interface to API
+        @param ConversationStore conversations: the conversation of every
+          session
         '''
-        #prompts and responses are stored in the order in which they are added,
-        #first at index 0
-        self._responses = []
-        self._prompts = []
+        self._conversations = conversations
         self._apiManager = apiManager
 
-    def clear(self):
+    def clear(self, sessionId):
         '''
-        clears responses and prompts
+        clears responses and prompts of a session
+        @param string sessionId: the session to clear
         '''
-        self._responses = []
-        self._prompts = []
+        self._conversations.clear(sessionId)
 
-    def _generateFeed(self):
+    def _generateFeed(self, sessionId, model, nTokens, latestInput):
         '''
         creates a string version of the feed, in order first at start of string.
-        This is designed for the model prompting
+        This is designed for the model prompting. Only the newest turns that
+        fit the token budget of the model are included.
+        @param string sessionId: the session whose conversation we feed
+        @param string model: the model that will be prompted
+        @param int nTokens: the token budget of prompt and completion
+        @param string latestInput: the input that follows the feed
         @return string: the feed
         '''
-        feed = []
-        for prompt, response in zip(self._prompts, self._responses):
-            feed.append(prompt)
-            feed.append(response)
-        return "\n".join(feed)
-            
+        #imported here, so importing the app doesn't import the openai sdk
+        from openAiApi import getContextSize
+        available = min(nTokens, getContextSize(model)) - \
+                getTokenizer().countTokens(latestInput) - 1
+        #history gets at most half of what is left, the rest is for the
+        #completion
+        return self._conversations.feed(sessionId, available // 2)
+
+    def readPrompt(self, request, model=None):
+        '''
+        reads the prompt form and builds the prompt for the api, which is the
+        conversation of the session up to this point followed by the latest
+        input
+        @param Request request: the post request object
+        @param string model: the model to prompt, defaults to the form's
+        @returns dict: sessionId and latestInput, plus the prompt, model,
+          temperature and nTokens keyword arguments for ApiManager.prompt
+        '''
+        sessionId = getSessionId(request)
+        latestInput = request.form.get('textbox')
+        if model is None:
+            model = request.form.get("model")
+        nTokens = int(request.form.get("nTokens"))
+        feed = self._generateFeed(sessionId, model, nTokens, latestInput)
+        return {
+                "sessionId": sessionId,
+                "latestInput": latestInput,
+                "prompt": "{}\n{}".format(feed, latestInput),
+                "model": model,
+                "temperature": float(request.form.get("temperature")),
+                "nTokens": nTokens
+                }
+
+    def addTurn(self, sessionId, latestInput, completion):
+        '''
+        adds a prompt/response pair to the conversation of a session
+        @param string sessionId: the session
+        @param string latestInput: what the user typed
+        @param string completion: what the model answered
+        '''
+        self._conversations.append(sessionId, latestInput, completion)
+
+    def getConversation(self, sessionId):
+        '''
+        @param string sessionId: the session
+        @returns list<tuple<string>>: prompt/response pairs, latest first
+        '''
+        return self._conversations.getConversation(sessionId)
 
     def handle(self, request, templateGen):
         '''
@@ -272,19 +870,91 @@ class SubmitButtonHandler(Handler):
         @param Request request: the post request object
         @param TemplateRenderer templateGen : the template generator to update
         '''
-        latestInput = request.form.get('textbox')
-        prompt = "{}\n{}".format(self._generateFeed(), latestInput)
-        model = request.form.get("model")
-        temperature = float(request.form.get("temperature"))
-        nTokens = int(request.form.get("nTokens"))
-        response = self._apiManager.prompt(
-                prompt, model=model, temperature=temperature, nTokens=nTokens)
+        args = self.readPrompt(request)
+        sessionId = args.pop("sessionId")
+        latestInput = args.pop("latestInput")
+        with scheduler.priority(scheduler.INTERACTIVE):
+            response = self._apiManager.prompt(**args)
+        completion = response["choices"][0]["text"]
+        self.addTurn(sessionId, latestInput, completion)
+        templateGen.set("conversation", self.getConversation(sessionId))
+
+    async def ahandle(self, request, templateGen):
+        '''
+        handle, awaiting the api instead of blocking on it
+        '''
+        args = self.readPrompt(request)
+        sessionId = args.pop("sessionId")
+        latestInput = args.pop("latestInput")
+        with scheduler.priority(scheduler.INTERACTIVE):
+            response = await self._apiManager.aprompt(**args)
         completion = response["choices"][0]["text"]
-        self._prompts.append(latestInput)
-        self._responses.append(completion)
-        conversation=list(zip(self._prompts, self._responses))
-        conversation.reverse()
-        templateGen.set("conversation", conversation)
+        self.addTurn(sessionId, latestInput, completion)
+        templateGen.set("conversation", self.getConversation(sessionId))
+
+    def stream(self, request):
+        '''
+        Streaming version of handle. Queries the API the same way, but returns
+        the completion as Server-Sent-Events while it arrives: one data event
+        per piece of text (json encoded), then a done event once the turn has
+        been added to the conversation, or an error event if the api fails.
+        The form is read here, so the generator can run after the request.
+        @param Request request: the post request object
+        @returns generator<string>: the event stream
+        '''
+        args = self.readPrompt(request)
+        sessionId = args.pop("sessionId")
+        latestInput = args.pop("latestInput")
+        return self._streamEvents(sessionId, latestInput, args)
+
+    def _streamEvents(self, sessionId, latestInput, args):
+        pieces = []
+        try:
+            stream = self._apiManager.promptStream(**args)
+            while True:
+                #the priority is set for each step only. Across a yield it
+                #would leak into whatever the consumer runs meanwhile
+                with scheduler.priority(scheduler.INTERACTIVE):
+                    text = next(stream, None)
+                if text is None:
+                    break
+                pieces.append(text)
+                yield "data: {}\n\n".format(json.dumps(text))
+        except Exception as e:
+            yield "event: error\ndata: {}\n\n".format(json.dumps(str(e)))
+            return
+        self.addTurn(sessionId, latestInput, "".join(pieces))
+        yield "event: done\ndata: {}\n\n"
+
+    def astream(self, request):
+        '''
+        stream, for the event loop
+        @param Request request: the post request object
+        @returns async generator<string>: the event stream
+        '''
+        args = self.readPrompt(request)
+        sessionId = args.pop("sessionId")
+        latestInput = args.pop("latestInput")
+        return self._astreamEvents(sessionId, latestInput, args)
+
+    async def _astreamEvents(self, sessionId, latestInput, args):
+        pieces = []
+        try:
+            stream = self._apiManager.apromptStream(**args)
+            while True:
+                #as in _streamEvents, the priority is set for each step only
+                with scheduler.priority(scheduler.INTERACTIVE):
+                    try:
+                        text = await stream.__anext__()
+                    except StopAsyncIteration:
+                        break
+                pieces.append(text)
+                yield "data: {}\n\n".format(json.dumps(text))
+        except Exception as e:
+            yield "event: error\ndata: {}\n\n".format(json.dumps(str(e)))
+            return
+        self.addTurn(sessionId, latestInput, "".join(pieces))
+        yield "event: done\ndata: {}\n\n"
 
 class ClearButtonHandler(Handler):
     '''
@@ -300,11 +970,124 @@ class ClearButtonHandler(Handler):
 
     def handle(self, request, templateGen):
         '''
-        clears the conversation, and sets the template generator in accordance.
+        clears the conversation of the caller's session, and sets the template
+        generator in accordance.
         '''
-        self._submitButtonHandler.clear()
+        self._submitButtonHandler.clear(getSessionId(request))
         templateGen.set("conversation", [])
 
+class CompareHandler(Handler):
+    '''
+    Handles the compare button: sends the prompt to every model picked in
+    compareModels at once, and shows the completions side by side with the
+    latency and token usage of each model. The models are prompted
+    concurrently, so the comparison takes as long as the slowest model, not
+    the sum. Each model gets the conversation as its own context size
+    allows, but the comparison is not added to the conversation. A model
+    that fails shows its error instead of failing the rest.
+    '''
+
+    def __init__(self, apiManager, submitButtonHandler, maxModels=8):
+        '''
+        @param ApiManager apiManager: interface to API
+        @param SubmitButtonHandler submitButtonHandler: reads the prompt form
+        @param int maxModels: the most models compared at once
+        '''
+        self._apiManager = apiManager
+        self._submitButtonHandler = submitButtonHandler
+        self._maxModels = maxModels
+        self._pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=maxModels, thread_name_prefix="CompareHandler")
+
+    def _readModels(self, request):
+        '''
+        @returns list<string>: the models picked, in order, without repeats
+        '''
+        models = list(dict.fromkeys(request.form.getlist("compareModels")))
+        return models[:self._maxModels]
+
+    def _result(self, model, start, response=None, error=None):
+        '''
+        @returns dict: what the comparison shows of one model
+        '''
+        result = {"model": model, "seconds": time.perf_counter() - start,
+                "text": "", "promptTokens": None, "completionTokens": None,
+                "error": None}
+        if error is not None:
+            result["error"] = str(error)
+            return result
+        #completions the cache streamed in have no usage
+        usage = response.get("usage") or {}
+        result["text"] = response["choices"][0]["text"]
+        result["promptTokens"] = usage.get("prompt_tokens")
+        result["completionTokens"] = usage.get("completion_tokens")
+        return result
+
+    def _promptModel(self, args):
+        '''
+        runs on the pool, whose threads don't have the request's context
+        '''
+        start = time.perf_counter()
+        try:
+            with scheduler.priority(scheduler.INTERACTIVE):
+                response = self._apiManager.prompt(**args)
+        except Exception as e:
+            return self._result(args["model"], start, error=e)
+        return self._result(args["model"], start, response)
+
+    async def _apromptModel(self, args):
+        start = time.perf_counter()
+        try:
+            with scheduler.priority(scheduler.INTERACTIVE):
+                response = await self._apiManager.aprompt(**args)
+        except Exception as e:
+            return self._result(args["model"], start, error=e)
+        return self._result(args["model"], start, response)
+
+    def _promptArgs(self, request, models):
+        '''
+        @returns list<dict>: ApiManager.prompt keyword arguments per model
+        '''
+        argsList = []
+        for model in models:
+            args = self._submitButtonHandler.readPrompt(request, model)
+            del args["sessionId"], args["latestInput"]
+            argsList.append(args)
+        return argsList
+
+    def _show(self, templateGen, results, start):
+        templateGen.set("comparison", results)
+        templateGen.set("notice", "compared {} models in {:.2f}s".format(
+                len(results), time.perf_counter() - start))
+
+    def handle(self, request, templateGen):
+        '''
+        prompts the picked models on the pool, and sets the comparison
+        @param Request request: the post request object
+        @param TemplateRenderer templateGen : the template generator to update
+        '''
+        models = self._readModels(request)
+        if not models:
+            templateGen.set("notice", "pick the models to compare")
+            return
+        start = time.perf_counter()
+        results = list(self._pool.map(self._promptModel,
+                self._promptArgs(request, models)))
+        self._show(templateGen, results, start)
+
+    async def ahandle(self, request, templateGen):
+        '''
+        handle, awaiting the models together on the event loop
+        '''
+        models = self._readModels(request)
+        if not models:
+            templateGen.set("notice", "pick the models to compare")
+            return
+        start = time.perf_counter()
+        results = await asyncio.gather(*(self._apromptModel(args)
+                for args in self._promptArgs(request, models)))
+        self._show(templateGen, list(results), start)
+
 class ApiDataCache:
     '''
     maintains a cache of response data from the ApiManager. Is responsible for
@@ -313,52 +1096,294 @@ class ApiDataCache:
     If you ever build more than two of these for the same ApiManager, things
     would get strange. This class could be refactored to make such a situation
     impossible. As it is, just don't do it.
+    Each resource ("files", "fineTunes", "models") remembers when it was
+    fetched. The getters always answer from memory. Once a resource is older
+    than its ttl, a background thread revalidates it while the stale copy
+    keeps being served. invalidate marks a resource as wrong (we just changed
+    it), so the next get fetches it before answering.
+    Given a FineTuneTracker, fine tunes are read from its job table instead,
+    which it keeps fresh by itself, and a fine tune that succeeds invalidates
+    the models.
+    Fetches of a resource that overlap share one call, and so do refreshes.
+    Given a SharedStore, the resources and when they were fetched are kept in
+    it too, so every process running the app sees one cache: a fetch or an
+    invalidate in one process is picked up by the others on their next get.
     @method refreshFileData()
     @method refreshFineTunes()
     @method refreshModels()
-    @method refresh()
+    @method refresh(timeout)
+    @method invalidate(resource)
+    @method getVersion(resource)
+    @method getTimings()
     @method getFileData()
     @method getFineTunes()
     @method getModels()
     '''
 
-    def __init__(self, apiManager):
+    #seconds before a resource is considered stale
+    DEFAULT_TTLS = {"files": 60.0, "fineTunes": 30.0, "models": 300.0}
+    #namespace of the resources in a SharedStore
+    SHARED_NAMESPACE = "apiCache"
+    #the ApiManager read that fetches each resource
+    LIST_CALLS = {"files": "listFiles", "fineTunes": "listFineTunes",
+            "models": "listModels"}
+
+    def __init__(self, apiManager, ttls=None, concurrentRefresh=True,
+            fineTuneTracker=None, sharedStore=None):
         '''
         @param ApiManager apiManager
+        @param dict ttls: optional overrides of DEFAULT_TTLS, resource->seconds
+        @param bool concurrentRefresh: if true refresh fans the list calls out
+          over a thread pool, otherwise they run one after another
+        @param FineTuneTracker fineTuneTracker: optional source of fine tunes
+        @param SharedStore sharedStore: optional store shared with other
+          processes
         '''
         self._apiManager = apiManager
-        self._fileData = []
-        self._fineTunes = []
-        self._models = []
+        self._fineTuneTracker = fineTuneTracker
+        self._fetchers = {
+                "files": apiManager.listFiles,
+                "fineTunes": apiManager.listFineTunes,
+                "models": apiManager.listModels
+                }
+        if fineTuneTracker is not None:
+            #a refresh resyncs the tracker rather than bypassing it
+            self._fetchers["fineTunes"] = fineTuneTracker.sync
+            fineTuneTracker.addListener(self._fineTuneChanged)
+        self._ttls = dict(self.DEFAULT_TTLS)
+        if ttls is not None:
+            self._ttls.update(ttls)
+        self._data = {resource: [] for resource in self._fetchers}
+        #None means never fetched, or invalidated
+        self._fetchedAt = {resource: None for resource in self._fetchers}
+        #bumped whenever the data of a resource changes
+        self._versions = {resource: 0 for resource in self._fetchers}
+        #bumped by invalidate. Reads only join fetches of the current one
+        self._generations = {resource: 0 for resource in self._fetchers}
+        self._revalidating = set()
+        #seconds the last successful fetch of each resource took
+        self._timings = {}
+        self._concurrentRefresh = concurrentRefresh
+        self._sharedStore = sharedStore
+        #the tracker's table is not shared, each process keeps its own
+        self._shared = {resource for resource in self._fetchers if
+                resource != "fineTunes" or fineTuneTracker is None}
+        #version of the store's namespace last read
+        self._sharedVersion = None
+        self._refreshPool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(self._fetchers),
+                thread_name_prefix="ApiDataCache")
+        self._flight = SingleFlight("apiCache")
+        self._lock = threading.Lock()
 
-    def refresh(self):
-        '''
-        Refreshes all api data
-        '''
-        self.refreshFileData()
-        self.refreshFineTunes()
-        self.refreshModels()
+    def refresh(self, timeout=None):
+        '''
+        Refreshes all api data. In concurrent mode the three list calls are
+        issued in parallel, so a refresh costs the slowest call rather than the
+        sum. A resource that fails, or is still running when timeout expires,
+        keeps its previous data and is reported back; a late call still stores
+        its result when it lands. A refresh asked for while another is running
+        waits for that one, and gets its errors.
+        @param float timeout: seconds to wait for the calls, None waits for all
+        @returns dict: resource->exception for every resource that failed
+        '''
+        return self._flight.do("refresh", self._refreshAll, timeout)
+
+    def _refreshAll(self, timeout):
+        errors = {}
+        if not self._concurrentRefresh:
+            for resource in self._fetchers:
+                try:
+                    self._refreshResource(resource)
+                except Exception as e:
+                    errors[resource] = e
+            return errors
+        futures = {resource: self._refreshPool.submit(
+                self._refreshResource, resource)
+                for resource in self._fetchers}
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for resource, future in futures.items():
+            remaining = None
+            if deadline is not None:
+                remaining = max(0.0, deadline - time.monotonic())
+            try:
+                future.result(timeout=remaining)
+            except concurrent.futures.TimeoutError:
+                errors[resource] = TimeoutError(
+                        "refreshing {} timed out".format(resource))
+            except Exception as e:
+                errors[resource] = e
+        return errors
 
     def refreshFileData(self):
-        resp = self._apiManager.listFiles()
-        self._fileData = resp["data"]
+        self._refreshResource("files")
 
     def refreshFineTunes(self):
-        resp = self._apiManager.listFineTunes()
-        self._fineTunes = resp["data"]
+        self._refreshResource("fineTunes")
 
     def refreshModels(self):
-        resp = self._apiManager.listModels()
-        self._models = resp["data"]
+        self._refreshResource("models")
+
+    def invalidate(self, resource):
+        '''
+        Marks resource as out of date, so the next get refetches it before
+        returning. Call this after changing the resource through the api.
+        @param string resource: one of "files", "fineTunes", "models"
+        '''
+        with self._lock:
+            self._fetchedAt[resource] = None
+            self._versions[resource] += 1
+            self._generations[resource] += 1
+            data = self._data[resource]
+        #nor may the fetch join a list call the api manager has in flight
+        self._apiManager.invalidate(self.LIST_CALLS[resource])
+        self._publish(resource, data, None)
+
+    def getVersion(self, resource):
+        '''
+        @param string resource: one of "files", "fineTunes", "models"
+        @returns int: a number that changes whenever the resource's data does
+        '''
+        if resource == "fineTunes" and self._fineTuneTracker is not None:
+            return self._fineTuneTracker.getVersion()
+        self._syncShared()
+        with self._lock:
+            return self._versions[resource]
+
+    def getTimings(self):
+        '''
+        @returns dict: resource->seconds taken by its last successful fetch
+        '''
+        with self._lock:
+            return dict(self._timings)
 
     def getFileData(self):
-        return self._fileData
+        return self._get("files")
 
     def getFineTunes(self):
-        return self._fineTunes
+        if self._fineTuneTracker is not None:
+            return self._fineTuneTracker.getFineTunes()
+        return self._get("fineTunes")
+
+    def _fineTuneChanged(self, job):
+        #a succeeded fine tune has made a new model
+        if job["status"] == "succeeded":
+            self.invalidate("models")
 
     def getModels(self):
-        return self._models
+        return self._get("models")
+
+    def _refreshResource(self, resource):
+        '''
+        fetches resource from the api and stores it, blocking. Joins a fetch
+        of the resource already running, if there is one that started since
+        the resource was last invalidated
+        @param string resource: the resource to fetch
+        '''
+        with self._lock:
+            generation = self._generations[resource]
+        self._flight.do((resource, generation), self._fetchResource, resource,
+                generation)
+
+    def _fetchResource(self, resource, generation):
+        '''
+        fetches and stores resource. If it was invalidated while the fetch
+        ran, or its version moved because something newer was stored, the
+        result may predate that and is dropped rather than marked fresh
+        '''
+        with self._lock:
+            version = self._versions[resource]
+        start = time.monotonic()
+        resp = self._fetchers[resource]()
+        end = time.monotonic()
+        with self._lock:
+            if self._generations[resource] != generation or \
+                    self._versions[resource] != version:
+                return
+            if resp["data"] != self._data[resource]:
+                self._versions[resource] += 1
+            self._data[resource] = resp["data"]
+            self._fetchedAt[resource] = end
+            self._timings[resource] = end - start
+        self._publish(resource, resp["data"], time.time())
+
+    def _publish(self, resource, data, fetchedAt):
+        '''
+        writes a resource to the shared store, if we have one
+        @param float fetchedAt: wall clock time of the fetch, None if
+          invalidated
+        '''
+        if self._sharedStore is None or resource not in self._shared:
+            return
+        self._sharedStore.put(self.SHARED_NAMESPACE, resource,
+                {"data": data, "fetchedAt": fetchedAt})
+
+    def _syncShared(self):
+        '''
+        takes in what other processes fetched or invalidated since we last
+        looked. One read of the namespace's version when nothing changed.
+        '''
+        if self._sharedStore is None:
+            return
+        version = self._sharedStore.version(self.SHARED_NAMESPACE)
+        with self._lock:
+            if version == self._sharedVersion:
+                return
+        version, entries = self._sharedStore.items(self.SHARED_NAMESPACE)
+        #fetch times are shared as wall clock, kept here as monotonic
+        offset = time.monotonic() - time.time()
+        with self._lock:
+            for resource, entry in entries:
+                if resource not in self._shared:
+                    continue
+                if entry["data"] != self._data[resource]:
+                    self._versions[resource] += 1
+                    self._data[resource] = entry["data"]
+                fetchedAt = entry["fetchedAt"]
+                if fetchedAt is None and \
+                        self._fetchedAt[resource] is not None:
+                    #invalidated by another process
+                    self._generations[resource] += 1
+                self._fetchedAt[resource] = None if fetchedAt is None \
+                        else fetchedAt + offset
+            self._sharedVersion = version
+
+    def _revalidate(self, resource):
+        '''
+        body of the background revalidation thread. On failure the stale data
+        stays in place and the next get will try again.
+        '''
+        try:
+            with scheduler.priority(scheduler.BACKGROUND):
+                self._refreshResource(resource)
+        except Exception as e:
+            print("revalidating {} failed: {}".format(resource, e))
+        finally:
+            with self._lock:
+                self._revalidating.discard(resource)
+
+    def _get(self, resource):
+        '''
+        @param string resource: the resource to read
+        @returns list: the cached data, fetched first if we have none
+        '''
+        self._syncShared()
+        with self._lock:
+            fetchedAt = self._fetchedAt[resource]
+            if fetchedAt is not None:
+                age = time.monotonic() - fetchedAt
+                stale = age > self._ttls[resource]
+                if stale and resource not in self._revalidating:
+                    self._revalidating.add(resource)
+                    threading.Thread(target=self._revalidate,
+                            args=(resource,), daemon=True).start()
+                API_CACHE_READS.inc(resource=resource,
+                        result="stale" if stale else "fresh")
+                return self._data[resource]
+        API_CACHE_READS.inc(resource=resource, result="miss")
+        self._refreshResource(resource)
+        with self._lock:
+            return self._data[resource]
 
 class ApiDataParser:
     '''
@@ -379,24 +1404,16 @@ class ApiDataParser:
         @param dict respModels: the Api response of models
         @returns list<string> the modelnames
         '''
-        modelnames = [model["id"] for model in respModels 
-                if model["owned_by"] == USER]
-        return modelnames
+        modelnames = [self.parseModel(model) for model in respModels]
+        return [modelname for modelname in modelnames if modelname is not None]
 
     def getFilenames(self, respFileData):
         '''
         @param dict respFileData: the Api response of files
-        @returns list<tuple<string>>: fileid followed by filename
+        @returns list<tuple<string>>: fileid, filename, and processing status
         '''
-        filenames = []
-        for fileDatum in respFileData:
-            fileid = fileDatum["id"]
-            try:
-                filename = self._filenameLookup[fileid]
-                filenames.append((fileid, filename))
-            except KeyError:
-                print(fileid)
-        return filenames
+        filenames = [self.parseFile(fileDatum) for fileDatum in respFileData]
+        return [filename for filename in filenames if filename is not None]
     
     def getFineTunes(self, respFineTunes):
         '''
@@ -408,21 +1425,188 @@ class ApiDataParser:
           + status
           + train file 1st
         '''
-        fineTunes = []
-        for fineTune in respFineTunes:
-            trainFileId = fineTune["training_files"][0]["id"]
-            try:
-                trainFilename = self._filenameLookup[trainFileId]
-            except:
-                trainFilename = "deleted"
-            row = []
-            row.append(fineTune["id"])
-            row.append(fineTune["fine_tuned_model"])
-            row.append(fineTune["model"])
-            row.append(fineTune["status"])
-            row.append(trainFilename)
-            fineTunes.append(row)
-        return fineTunes
+        return [self.parseFineTune(fineTune) for fineTune in respFineTunes]
+
+    def parseModel(self, model):
+        '''
+        @param dict model: one model of the Api response
+        @returns string: its name, None if it isn't one of ours
+        '''
+        if model["owned_by"] != USER:
+            return None
+        return model["id"]
+
+    def parseFile(self, fileDatum):
+        '''
+        @param dict fileDatum: one file of the Api response
+        @returns tuple<string>: fileid, filename, and processing status, None
+          if we don't know its name
+        '''
+        fileid = fileDatum["id"]
+        try:
+            filename = self._filenameLookup[fileid]
+        except KeyError:
+            #uploaded elsewhere, so we don't show it
+            return None
+        return (fileid, filename, fileDatum.get("status", "processed"))
+
+    def parseFineTune(self, fineTune):
+        '''
+        @param dict fineTune: one fine tune of the Api response
+        @returns list<string>: a row of getFineTunes
+        '''
+        trainFileId = fineTune["training_files"][0]["id"]
+        try:
+            trainFilename = self._filenameLookup[trainFileId]
+        except:
+            trainFilename = "deleted"
+        row = []
+        row.append(fineTune["id"])
+        row.append(fineTune["fine_tuned_model"])
+        row.append(fineTune["model"])
+        row.append(fineTune["status"])
+        row.append(trainFilename)
+        return row
+
+
+class Page(list):
+    '''
+    One page of a list from the ApiRegistry
+    @attribute int page: its number, counting from 1
+    @attribute int pages: how many pages the list has
+    '''
+
+    def __init__(self, rows, page=1, pages=1):
+        super().__init__(rows)
+        self.page = page
+        self.pages = pages
+
+
+class ApiRegistry:
+    '''
+    Id indexed views of the ApiDataCache, parsed by an ApiDataParser, for
+    handlers to look things up in and page through. Each view remembers the
+    cache versions it was built from. Once the cache has moved on, the next
+    read updates the view from the new data, parsing again only the items
+    that changed. Reads in between neither scan nor parse.
+    @method getFile(fileId) : the parsed file, or None
+    @method findFile(ids) : the first of ids that is a known file, or None
+    @method hasModel(modelname)
+    @method getFilenames(page, perPage) : like ApiDataParser.getFilenames
+    @method getModelnames(page, perPage) : like ApiDataParser.getModelnames
+    @method getFineTunes(page, perPage) : like ApiDataParser.getFineTunes
+    @method getVersion(resource) : changes whenever the resource's view may
+    '''
+
+    #rows on a page of the lists the page shows
+    PER_PAGE = 50
+    #what a view is parsed from. Fine tune rows show the train file's name
+    DEPENDENCIES = {"files": ("files",), "models": ("models",),
+            "fineTunes": ("fineTunes", "files")}
+
+    def __init__(self, apiCache, dataParser):
+        '''
+        @param ApiDataCache apiCache: the cache for api data
+        @param ApiDataParser dataParser: turns api items into rows
+        '''
+        self._apiCache = apiCache
+        self._getters = {"files": apiCache.getFileData,
+                "models": apiCache.getModels,
+                "fineTunes": apiCache.getFineTunes}
+        self._parsers = {"files": dataParser.parseFile,
+                "models": dataParser.parseModel,
+                "fineTunes": dataParser.parseFineTune}
+        #resource->(versions, {id: (item, row)}, rows in api order)
+        self._views = {resource: (None, {}, []) for resource in self._getters}
+        self._lock = threading.Lock()
+
+    def getFile(self, fileId):
+        '''
+        @param string fileId: the file
+        @returns tuple<string>: fileid, filename and status, None if unknown
+        '''
+        entry = self._view("files")[0].get(fileId)
+        return None if entry is None else entry[1]
+
+    def findFile(self, ids):
+        '''
+        @param iterable<string> ids: e.g. the keys of a form
+        @returns string: the first of ids that is a known file, or None
+        '''
+        index = self._view("files")[0]
+        for fileId in ids:
+            if fileId in index:
+                return fileId
+        return None
+
+    def hasModel(self, modelname):
+        return modelname in self._view("models")[0]
+
+    def getFilenames(self, page=None, perPage=PER_PAGE):
+        return self._page(self._view("files")[1], page, perPage)
+
+    def getModelnames(self, page=None, perPage=PER_PAGE):
+        return self._page(self._view("models")[1], page, perPage)
+
+    def getFineTunes(self, page=None, perPage=PER_PAGE):
+        return self._page(self._view("fineTunes")[1], page, perPage)
+
+    def getVersion(self, resource):
+        '''
+        @param string resource: "files", "models" or "fineTunes"
+        @returns tuple<int>: the cache versions of what its view is parsed
+          from
+        '''
+        return tuple(self._apiCache.getVersion(dependency)
+                for dependency in self.DEPENDENCIES[resource])
+
+    def _page(self, rows, page, perPage):
+        '''
+        @param int page: from 1, clamped to the pages there are. None for
+          every row
+        @returns Page: the rows of the page
+        '''
+        if page is None:
+            return Page(rows)
+        pages = max(1, -(-len(rows) // perPage))
+        page = min(max(1, page), pages)
+        return Page(rows[(page - 1) * perPage:page * perPage], page, pages)
+
+    def _view(self, resource):
+        '''
+        @param string resource: "files", "models" or "fineTunes"
+        @returns tuple: {id: (item, row)}, rows, up to date with the cache
+        '''
+        versions = self.getVersion(resource)
+        with self._lock:
+            builtFrom, index, rows = self._views[resource]
+            if builtFrom == versions:
+                return index, rows
+        #may fetch, so not under the lock
+        data = self._getters[resource]()
+        parse = self._parsers[resource]
+        with self._lock:
+            builtFrom, oldIndex, _ = self._views[resource]
+            #rows of unchanged items can be kept, as long as nothing else
+            #they are parsed from has changed
+            if builtFrom is None or builtFrom[1:] != versions[1:]:
+                oldIndex = {}
+            index = {}
+            rows = []
+            for item in data:
+                itemId = item["id"]
+                old = oldIndex.get(itemId)
+                if old is not None and (old[0] is item or old[0] == item):
+                    row = old[1]
+                else:
+                    row = parse(item)
+                    if row is None:
+                        #left out, so it is parsed again next time
+                        continue
+                index[itemId] = (item, row)
+                rows.append(row)
+            self._views[resource] = (versions, index, rows)
+            return index, rows
 
 
 class DeleteModelHandler(Handler):
@@ -430,15 +1614,15 @@ class DeleteModelHandler(Handler):
     Handler for Delete Model button.
     '''
 
-    def __init__(self, apiManager, apiCache, dataParser):
+    def __init__(self, apiManager, apiCache, registry):
         '''
         @param ApiManager apiManager: interaface to the api
         @param ApiDataCache apiCache: the cache for api data
-        @param ApiDataParser dataParser: object to process api data
+        @param ApiRegistry registry: indexed, parsed api data
         '''
         self._apiManager = apiManager
         self._apiCache = apiCache
-        self._apiDataParser = dataParser
+        self._registry = registry
 
     def handle(self, request, templateGen):
         '''
@@ -450,9 +1634,8 @@ class DeleteModelHandler(Handler):
         modelName = request.form["model"]
         assert(modelName != "createModel")
         resp = self._apiManager.deleteModel(modelName)
-        self._apiCache.refreshModels()
-        modelNames = self._apiDataParser.getModelnames(
-                self._apiCache.getModels())
+        self._apiCache.invalidate("models")
+        modelNames = self._registry.getModelnames()
         templateGen.set("models", modelNames)
 
 class DeleteFileHandler(Handler):
@@ -460,43 +1643,49 @@ class DeleteFileHandler(Handler):
     Handle delete model button
     '''
     
-    def __init__(self, apiManager, apiCache, dataParser, filenameLookup):
+    def __init__(self, apiManager, apiCache, registry, filenameLookup,
+            contentHashes, datasetTokens):
         '''
         @param ApiManager apiManager: interaface to the api
         @param ApiDataCache apiCache: the cache for api data
-        @param ApiDataParser dataParser: object to process api data
+        @param ApiRegistry registry: indexed, parsed api data
         @param PersistentAppDadta filenameLookup: maps fileids to filenames
+        @param PersistentAppData contentHashes: maps fileids to content hashes
+        @param PersistentAppData datasetTokens: maps fileids to token counts
         '''
         self._apiManager = apiManager
         self._apiCache = apiCache
-        self._apiDataParser = dataParser
+        self._registry = registry
         self._filenameLookup = filenameLookup
+        self._contentHashes = contentHashes
+        self._datasetTokens = datasetTokens
 
     def handle(self, request, templateGen):
         '''
-        on press of deleteFile, removes the file from the filenameLookup. Also 
-        deletes the file from the api. Finally, updates the template gen to be
-        aware of the changes
+        on press of deleteFile, deletes the file from the api, and removes it
+        from the filenameLookup. Finally, updates the template gen to be
+        aware of the changes. A file the api is still processing can't be
+        deleted yet: it is left alone, with a notice
         '''
         #the form.keys has other gunk too, so we compare it against filenames
         #I was nice enough to throw an error if you can't find 
-        delFile = ""
-        filenames = self._apiDataParser.getFilenames(
-            self._apiCache.getFileData())
-        for reqFileId in request.form.keys():
-            for fileId, _ in filenames:
-                if fileId == reqFileId:
-                    delFile = reqFileId
-                    break
-        assert(delFile != "") #you did't find a file
-
-        self._filenameLookup.delete(delFile)
-        #I think this should be fine because if the file was on the list,
-        #then it has definitely been uploaded, so you can delete it.
-        self._apiManager.deleteFile(delFile)
-        self._apiCache.refreshFileData()
-        filenames = self._apiDataParser.getFilenames(
-                self._apiCache.getFileData())
+        delFile = self._registry.findFile(request.form.keys())
+        assert(delFile is not None) #you did't find a file
+
+        pending, status = fileStatus(self._apiManager, self._apiCache, delFile)
+        if pending:
+            templateGen.set("notice", "{} is still being processed ({}), "
+                    "delete it once it's done".format(
+                    self._filenameLookup[delFile], status))
+        else:
+            self._apiManager.deleteFile(delFile)
+            self._filenameLookup.delete(delFile)
+            if delFile in self._contentHashes:
+                self._contentHashes.delete(delFile)
+            if delFile in self._datasetTokens:
+                self._datasetTokens.delete(delFile)
+            self._apiCache.invalidate("files")
+        filenames = self._registry.getFilenames(1)
         templateGen.set("files", filenames)
 
 class TrainHandler(Handler):
@@ -504,86 +1693,165 @@ class TrainHandler(Handler):
     Handle requests to train a model through finetune
     '''
     
-    def __init__(self, apiManager, apiCache, dataParser):
+    def __init__(self, apiManager, apiCache, registry, datasetTokens,
+            fineTuneTracker):
         '''
         @param ApiManager apiManager: interaface to the api
         @param ApiDataCache apiCache: the cache for api data
-        @param ApiDataParser dataParser: object to process api data
+        @param ApiRegistry registry: indexed, parsed api data
+        @param PersistentAppData datasetTokens: maps fileids to token counts
+        @param FineTuneTracker fineTuneTracker: follows the new fine tune
         '''
         self._apiManager = apiManager
         self._apiCache = apiCache
-        self._apiDataParser = dataParser
+        self._registry = registry
+        self._datasetTokens = datasetTokens
+        self._fineTuneTracker = fineTuneTracker
 
     def handle(self, request, templateGen):
         '''
         If create model is selected, will train a model with sepecified file. If
         a model is selected, will use that model as the base for training.
-        Refreshes fine tunes and models. Updates the template.
+        Hands the new fine tune to the tracker. Updates the template. A file
+        the api is still processing can't be trained on yet: nothing is
+        trained, and a notice says so
 
-        @throws assertion error if you didn't select a file
+        @throws assertion error if you didn't select a file, or the api
+          failed to process it
         '''
         #the form.keys has other gunk too, so we compare it against filenames
         #I was nice enough to throw an error if you can't find
-        trainFile = ""
-        filenames = self._apiDataParser.getFilenames(
-            self._apiCache.getFileData())
-        for reqFileId in request.form.keys():
-            for fileId, _ in filenames:
-                if fileId == reqFileId:
-                    trainFile = reqFileId
-                    break
-        assert(trainFile != "") #you did't find a file
+        trainFile = self._registry.findFile(request.form.keys())
+        assert(trainFile is not None) #you did't find a file
+        pending, status = fileStatus(self._apiManager, self._apiCache,
+                trainFile)
+        if pending:
+            templateGen.set("notice", "{} is still being processed ({}), "
+                    "train on it once it's done".format(
+                    self._registry.getFile(trainFile)[1], status))
+            templateGen.set("files", self._registry.getFilenames(1))
+            return
+        assert(status == "processed"),\
+                "File is {}, it can't be trained on".format(status)
                     
         model = request.form["model"]
         if model == "createModel":
-            self._apiManager.train(trainFile) #use default
+            job = self._apiManager.train(trainFile) #use default
         else:
-            self._apiManager.train(trainFile, model)
-        self._apiCache.refreshFineTunes()
-        self._apiCache.refreshModels()
-        modelNames = self._apiDataParser.getModelnames(
-                self._apiCache.getModels())
+            job = self._apiManager.train(trainFile, model)
+        self._fineTuneTracker.track(job)
+        if trainFile in self._datasetTokens:
+            tokens = self._datasetTokens[trainFile]
+            #ApiManager.train defaults to davinci
+            cost = trainingCost(tokens,
+                    "davinci" if model == "createModel" else model)
+            templateGen.set("notice", "Training on {} tokens{}".format(tokens,
+                    "" if cost is None else ", about ${:.2f}".format(cost)))
+        #the new model only shows up once the fine tune finishes, which the
+        #tracker tells the cache about
+        modelNames = self._registry.getModelnames()
         templateGen.set("models", modelNames)
-        fineTunes = self._apiDataParser.getFineTunes(
-                self._apiCache.getFineTunes())
+        fineTunes = self._registry.getFineTunes(1)
         templateGen.set("fineTunes", fineTunes)
 
 class UploadHandler(Handler):
     '''
     Handles the upload of a new file.
+    The file goes through the dataset preprocessor on its way to disk, so
+    only valid, unique examples are uploaded. Files are deduplicated by
+    content: if the same examples were uploaded before, under any name, and
+    that file is still on the api, its id is reused and nothing is uploaded.
     '''
-    
-    def __init__(self, apiManager, apiCache, dataParser, filenameLookup):
+
+    def __init__(self, apiManager, apiCache, registry, filenameLookup,
+            contentHashes, datasetTokens, uploadFolder="UploadedFiles"):
         '''
         @param ApiManager apiManager: interaface to the api
         @param ApiDataCache apiCache: the cache for api data
-        @param ApiDataParser dataParser: object to process api data
+        @param ApiRegistry registry: indexed, parsed api data
         @param PersistentAppDadta filenameLookup: maps fileids to filenames
+        @param PersistentAppData contentHashes: maps fileids to content hashes
+        @param PersistentAppData datasetTokens: maps fileids to token counts
+        @param string uploadFolder: where uploads are saved, made if need be
         '''
+        if not os.path.exists(uploadFolder):
+            os.makedirs(uploadFolder, exist_ok=True)
+        self._uploadFolder = uploadFolder
         self._apiManager = apiManager
         self._apiCache = apiCache
-        self._apiDataParser = dataParser
+        self._registry = registry
         self._filenameLookup = filenameLookup
+        self._contentHashes = contentHashes
+        self._datasetTokens = datasetTokens
+
+    def _saveAndHash(self, fileStorage, filepath):
+        '''
+        streams the upload line by line through the dataset preprocessor, which
+        drops invalid and duplicate examples, and saves the clean lines to
+        filepath, hashing them on the way
+        @param FileStorage fileStorage: the uploaded file
+        @param string filepath: where to save it
+        @returns tuple: sha256 of the clean content, DatasetReport
+        '''
+        hasher = hashlib.sha256()
+        report = DatasetReport()
+        with open(filepath, 'wb') as file:
+            for line in preprocess(fileStorage.stream, report):
+                hasher.update(line)
+                file.write(line)
+        return hasher.hexdigest(), report
+
+    def _findUploaded(self, contentHash):
+        '''
+        @param string contentHash: sha256 of a file
+        @returns string: id of a file on the api with that content, or None
+        '''
+        try:
+            fileId = self._contentHashes.invGet(contentHash)
+        except KeyError:
+            return None
+        if self._registry.getFile(fileId) is None:
+            return None
+        return fileId
 
     def handle(self, request, templateGen):
         '''
-        Places the uploaded file into a folder on local machine. Then uploads
-        the file to the api, refreshes the filenames, and udates the template
+        Streams the uploaded file into a folder on local machine. Then uploads
+        the file to the api, unless its content is already there, refreshes
+        the filenames, and udates the template
         @throws assertion error: if you give invalid filename, or if it's not in
           the filenameLooup
         '''
         fileStorage = request.files["fileChooser"]
         assert(isValidFilename(fileStorage.filename)) #need to change for prod
         filename = secure_filename(fileStorage.filename)
-        assert(filename not in self._filenameLookup.values()),\
+        assert(not self._filenameLookup.hasValue(filename)),\
                 "Filename has already been uploaded. Please change name"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        fileStorage.save(filepath)
-        resp = self._apiManager.uploadFile(filepath)
-        self._filenameLookup[resp['id']] = filename
-        self._apiCache.refreshFileData()
-        filenames = self._apiDataParser.getFilenames(
-                self._apiCache.getFileData())
+        filepath = os.path.join(self._uploadFolder, filename)
+        contentHash, report = self._saveAndHash(fileStorage, filepath)
+        if report.valid == 0:
+            os.remove(filepath)
+        assert(report.valid > 0), "No valid examples in file: {}".format(
+                "; ".join(report.errors))
+        templateGen.set("notice", report.summary())
+        uploaded = self._findUploaded(contentHash)
+        if uploaded is not None:
+            #same content is already up, under its first name
+            os.remove(filepath)
+            templateGen.set("notice", "{}. The same examples were already "
+                    "uploaded as {}, which is used instead".format(
+                    report.summary(), self._filenameLookup[uploaded]))
+        else:
+            resp = self._apiManager.uploadFile(filepath)
+            if self._contentHashes.hasValue(contentHash):
+                #an earlier upload of this content was deleted remotely
+                self._contentHashes.delete(
+                        self._contentHashes.invGet(contentHash))
+            self._contentHashes[resp['id']] = contentHash
+            self._datasetTokens[resp['id']] = report.tokens()
+            self._filenameLookup[resp['id']] = filename
+            self._apiCache.invalidate("files")
+        filenames = self._registry.getFilenames(1)
         templateGen.set("files", filenames)
 
 class RefreshHandler(Handler):
@@ -591,55 +1859,344 @@ class RefreshHandler(Handler):
     Handles the refresh button
     '''
 
-    def __init__(self, apiCache, apiDataParser):
+    def __init__(self, apiCache, registry):
         '''
         @param ApiDataCache apiCache: the cache for api data
-        @param ApiDataParser dataParser: object to process api data
+        @param ApiRegistry registry: indexed, parsed api data
         '''
         self._apiCache = apiCache
-        self._apiDataParser = apiDataParser
+        self._registry = registry
 
     def handle(self, request, templateGen):
         '''
-        refreshes everything, then updates the templateGen
+        refreshes everything, then updates the templateGen. Resources that
+        fail to refresh keep showing their previous data.
         '''
-        self._apiCache.refresh()
-        filenames = self._apiDataParser.getFilenames(
-                self._apiCache.getFileData())
+        errors = self._apiCache.refresh()
+        for resource, error in errors.items():
+            print("refreshing {} failed: {}".format(resource, error))
+        filenames = self._registry.getFilenames(1)
         templateGen.set("files", filenames)
-        modelNames = self._apiDataParser.getModelnames(
-                self._apiCache.getModels())
+        modelNames = self._registry.getModelnames()
         templateGen.set("models", modelNames)
-        fineTunes = self._apiDataParser.getFineTunes(
-                self._apiCache.getFineTunes())
+        fineTunes = self._registry.getFineTunes(1)
         templateGen.set("fineTunes", fineTunes)
 
-with open("apiKey", 'r') as file:
-    apiKey = file.read()[:-1] #drop newline
-    apiManager = ApiManager(apiKey)
-templateRenderer = TemplateRenderer("index.html",
-        ["template", "conversation", "files", "models", "fineTunes"]
-        )
-apiCache = ApiDataCache(apiManager)
-filenameLookup = PersistentAppData('filenames.json')
-apiProcessor = ApiDataParser(filenameLookup)
-controller = Controller(templateRenderer, apiCache, apiProcessor)
-submitButtonHandler = SubmitButtonHandler(apiManager)
-clearButtonHandler = ClearButtonHandler(submitButtonHandler)
-deleteModelHandler = DeleteModelHandler(apiManager, apiCache, apiProcessor)
-deleteFileHandler = DeleteFileHandler(
-        apiManager, apiCache, apiProcessor, filenameLookup)
-trainHandler = TrainHandler(apiManager, apiCache, apiProcessor)
-refreshHandler = RefreshHandler(apiCache, apiProcessor)
-uploadHandler = UploadHandler(apiManager, apiCache, apiProcessor,filenameLookup)
-controller.registerHandler("submitPrompt", submitButtonHandler)
-controller.registerHandler("clear", clearButtonHandler)
-controller.registerHandler("refresh", refreshHandler)
-controller.registerHandler("train", trainHandler)
-controller.registerHandler("upload", uploadHandler)
-controller.registerHandler("deleteFile", deleteFileHandler)
-controller.registerHandler("deleteModel", deleteModelHandler)
-
-@app.route("/", methods=("GET","POST"))
+class _LazyComponent:
+    '''
+    Decorator for the methods of Components that make a component. The
+    method runs the first time the component is read, and its result is kept
+    in the instance, where later reads find it without coming here again.
+    '''
+
+    def __init__(self, make):
+        self._make = make
+        self._name = make.__name__
+        self.__doc__ = make.__doc__
+
+    def __get__(self, components, owner=None):
+        if components is None:
+            return self
+        #a component being made makes the ones it needs, on the same thread
+        with components._lock:
+            if self._name not in components.__dict__:
+                components.__dict__[self._name] = self._make(components)
+        return components.__dict__[self._name]
+
+class Components:
+    '''
+    Everything the app is made of, from the ApiManager to the handlers. Each
+    component is made the first time it is used, along with the components
+    it needs, so making an app costs next to nothing, and the openai sdk is
+    only imported once something talks to the api. warmUp makes them all on
+    a background thread and fills the ApiDataCache, so a new worker is
+    serving before the api has answered, and its first page load finds the
+    cache full, or joins the fetch already in flight.
+    @method warmUp() : makes everything and fills the cache, in the background
+    @method waitWarm(timeout) : waits for warmUp to be done
+    @method isMade(name) : whether a component has been made yet
+    @method appData(dataFilename) : PersistentAppData, or a shared copy
+    '''
+
+    def __init__(self, apiKeyPath="apiKey", sharedState=None,
+            uploadFolder="UploadedFiles"):
+        '''
+        @param string apiKeyPath: file holding the api key, on its first line
+        @param string sharedState: path of a sqlite database to share state
+          with other processes through, None to keep it in this one
+        @param string uploadFolder: where uploaded files are saved
+        '''
+        self._apiKeyPath = apiKeyPath
+        self._sharedState = sharedState
+        self._uploadFolder = uploadFolder
+        self._lock = threading.RLock()
+        self._warm = threading.Event()
+        self._warmThread = None
+
+    def warmUp(self):
+        '''
+        makes every component and refreshes the ApiDataCache on a background
+        thread. Failures are printed; whatever failed is made or fetched
+        again when a request needs it
+        '''
+        def warm():
+            try:
+                self.controller
+                errors = self.apiCache.refresh()
+                for resource, error in errors.items():
+                    print("warming {} failed: {}".format(resource, error))
+            except Exception as e:
+                print("warming up failed: {}".format(e))
+            finally:
+                self._warm.set()
+        with self._lock:
+            if self._warmThread is None:
+                self._warmThread = threading.Thread(target=warm, daemon=True,
+                        name="warmUp")
+                self._warmThread.start()
+
+    def waitWarm(self, timeout=None):
+        '''
+        @param float timeout: seconds to wait, None waits as long as it takes
+        @returns bool: whether warmUp is done
+        '''
+        return self._warm.wait(timeout)
+
+    def isMade(self, name):
+        '''
+        @param string name: a component, e.g. "conversations"
+        @returns bool: whether it has been made
+        '''
+        return name in self.__dict__
+
+    def appData(self, dataFilename):
+        '''
+        @param string dataFilename: file of the data when kept in this process
+        @returns dict: the data, shared between processes if we share state.
+          The shared copy starts from the file the first time
+        '''
+        if self.sharedStore is None:
+            return PersistentAppData(dataFilename, journal=True)
+        return SharedDict(self.sharedStore, dataFilename,
+                seed=lambda: PersistentAppData(dataFilename))
+
+    @_LazyComponent
+    def completionCache(self):
+        return CompletionCache()
+
+    @_LazyComponent
+    def apiManager(self):
+        #the openai sdk is the bulk of our import time
+        from openAiApi import ApiManager
+        from scheduler import ApiScheduler
+        from transport import Transport
+        with open(self._apiKeyPath, 'r') as file:
+            apiKey = file.read()[:-1] #drop newline
+        #keeps us under the account's rate limits, prompts first
+        apiScheduler = ApiScheduler(requestsPerMinute=3000,
+                tokensPerMinute=250000)
+        return ApiManager(apiKey, self.completionCache,
+                transport=Transport(scheduler=apiScheduler))
+
+    @_LazyComponent
+    def sharedStore(self):
+        return SharedStore(self._sharedState) if self._sharedState else None
+
+    @_LazyComponent
+    def fineTuneTracker(self):
+        #every process tracks the fine tunes itself
+        fineTuneTracker = FineTuneTracker(self.apiManager)
+        fineTuneTracker.start()
+        return fineTuneTracker
+
+    @_LazyComponent
+    def apiCache(self):
+        return ApiDataCache(self.apiManager,
+                fineTuneTracker=self.fineTuneTracker,
+                sharedStore=self.sharedStore)
+
+    @_LazyComponent
+    def filenameLookup(self):
+        return self.appData('filenames.json')
+
+    @_LazyComponent
+    def contentHashes(self):
+        return self.appData('contentHashes.json')
+
+    @_LazyComponent
+    def datasetTokens(self):
+        return self.appData('datasetTokens.json')
+
+    @_LazyComponent
+    def registry(self):
+        return ApiRegistry(self.apiCache, ApiDataParser(self.filenameLookup))
+
+    @_LazyComponent
+    def conversations(self):
+        #conversations outlive the process, in the shared store or in logs of
+        #our own
+        return ConversationStore(backend=ConversationLog()
+                if self.sharedStore is None else
+                SqliteConversationBackend(self.sharedStore))
+
+    @_LazyComponent
+    def submitButtonHandler(self):
+        return SubmitButtonHandler(self.apiManager, self.conversations)
+
+    @_LazyComponent
+    def controller(self):
+        templateRenderer = TemplateRenderer("index.html",
+                ["template", "conversation", "files", "models", "fineTunes",
+                    "notice", "etags", "comparison"],
+                sections=Controller.SECTIONS
+                )
+        controller = Controller(templateRenderer, self.apiCache,
+                self.registry, self.conversations)
+        apiManager, apiCache, registry = \
+                self.apiManager, self.apiCache, self.registry
+        submitButtonHandler = self.submitButtonHandler
+        controller.registerHandler("submitPrompt", submitButtonHandler)
+        controller.registerHandler("clear",
+                ClearButtonHandler(submitButtonHandler))
+        controller.registerHandler("compare",
+                CompareHandler(apiManager, submitButtonHandler))
+        controller.registerHandler("refresh",
+                RefreshHandler(apiCache, registry))
+        controller.registerHandler("train", TrainHandler(apiManager,
+                apiCache, registry, self.datasetTokens, self.fineTuneTracker))
+        controller.registerHandler("upload", UploadHandler(apiManager,
+                apiCache, registry, self.filenameLookup, self.contentHashes,
+                self.datasetTokens, self._uploadFolder))
+        controller.registerHandler("deleteFile", DeleteFileHandler(
+                apiManager, apiCache, registry, self.filenameLookup,
+                self.contentHashes, self.datasetTokens))
+        controller.registerHandler("deleteModel",
+                DeleteModelHandler(apiManager, apiCache, registry))
+        return controller
+
+COMPLETION_CACHE_LOOKUPS = metrics.counter(
+        "ai9_completion_cache_lookups_total",
+        "CompletionCache lookups, by the tier that answered", ["result"])
+CONVERSATION_SESSIONS = metrics.gauge("ai9_conversation_sessions",
+        "sessions whose conversation is held in memory")
+CONVERSATION_BYTES = metrics.gauge("ai9_conversation_bytes",
+        "estimated bytes the conversations in memory hold")
+#the Components of every app of the process, until they are collected
+_liveComponents = weakref.WeakSet()
+def collectMetrics():
+    '''
+    copies counts the apps of the process keep elsewhere into metrics, at
+    every scrape, summed over the apps. Components not made yet are left
+    alone rather than made for a scrape
+    '''
+    results = ("memoryHits", "diskHits", "misses")
+    lookups, conversations = None, None
+    for components in list(_liveComponents):
+        if components.isMade("completionCache"):
+            stats = components.completionCache.getStats()
+            lookups = lookups or dict.fromkeys(results, 0)
+            for result in results:
+                lookups[result] += stats[result]
+        if components.isMade("conversations"):
+            sessions, size = components.conversations.size()
+            conversations = conversations or [0, 0]
+            conversations[0] += sessions
+            conversations[1] += size
+    if lookups is not None:
+        for result in results:
+            COMPLETION_CACHE_LOOKUPS.set(lookups[result], result=result)
+    if conversations is not None:
+        CONVERSATION_SESSIONS.set(conversations[0])
+        CONVERSATION_BYTES.set(conversations[1])
+#once per process, however many apps createApp makes
+metrics.REGISTRY.addCollector(collectMetrics)
+
+def getComponents():
+    '''
+    @returns Components: those of the app handling the current request
+    '''
+    return current_app.extensions["ai9"]
+
 def main():
-    return controller.index(request)
+    return getComponents().controller.index(request)
+
+def api(section):
+    return getComponents().controller.api(section, request)
+
+def fragment(section):
+    return getComponents().controller.fragment(section, request)
+
+def metricsPage():
+    '''
+    the process's metrics, for Prometheus to scrape
+    '''
+    return Response(metrics.REGISTRY.render(),
+            content_type=metrics.CONTENT_TYPE)
+
+def slowRequests():
+    '''
+    the slow requests the profiler sampled, with their most common stacks
+    '''
+    if slowRequestSampler is None:
+        abort(404)
+    return jsonify(slowRequestSampler.getReports())
+
+def stream():
+    '''
+    streams the completion for the prompt form as Server-Sent-Events. The
+    request lasts, for its metrics and the profiler, until the stream ends
+    '''
+    events = getComponents().submitButtonHandler.stream(request)
+    def streamed():
+        try:
+            yield from events
+        finally:
+            g.streamDone = True
+    g.streaming = True
+    return Response(stream_with_context(streamed()),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def createApp(apiKeyPath="apiKey", sharedState=SHARED_STATE, warm=True):
+    '''
+    The application factory. Makes a flask app with the routes, whose
+    Components are made when first used, so it returns right away:
+        gunicorn -w 4 "app:createApp()"
+        flask --app "app:createApp()" run
+    @param string apiKeyPath: file holding the api key
+    @param string sharedState: see SHARED_STATE
+    @param bool warm: make the components and fill the ApiDataCache in the
+      background now, rather than on the first requests
+    @returns flask.Flask: the app, with its Components in
+      extensions["ai9"]
+    '''
+    flaskApp = Flask(__name__)
+    components = Components(apiKeyPath, sharedState)
+    flaskApp.extensions["ai9"] = components
+    flaskApp.before_request(startRequest)
+    flaskApp.teardown_request(finishRequest)
+    flaskApp.after_request(setSessionCookie)
+    flaskApp.add_url_rule("/", view_func=main, methods=("GET", "POST"))
+    flaskApp.add_url_rule("/api/<section>", view_func=api)
+    flaskApp.add_url_rule("/fragment/<section>", view_func=fragment)
+    flaskApp.add_url_rule("/metrics", view_func=metricsPage)
+    flaskApp.add_url_rule("/metrics/slow", view_func=slowRequests)
+    flaskApp.add_url_rule("/stream", view_func=stream, methods=("POST",))
+    _liveComponents.add(components)
+    if warm:
+        components.warmUp()
+    return flaskApp
+
+def __getattr__(name):
+    '''
+    app.app, for servers pointed at it (gunicorn app:app, flask run), is made
+    by createApp the first time it is asked for rather than on import
+    '''
+    if name == "app":
+        with _appLock:
+            if "app" not in globals():
+                globals()["app"] = createApp()
+        return globals()["app"]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__,
+            name))
+_appLock = threading.Lock()
@@ -0,0 +1,152 @@
+'''
+Serves the app from one asyncio event loop, so a single process can have
+hundreds of completions in flight instead of one per worker thread.
+
+    python asyncServer.py --port 5000
+
+aiohttp does the http. Every request is handed to the flask app inside a
+flask request context, so routing, templates, cookies and error pages stay
+the flask app's. The prompt routes (the index page and /stream) await the api
+through ApiManager's async calls; every other route runs on a worker thread.
+Needs flask 2.2 or later, whose request context lives in a contextvar and so
+follows each asyncio task.
+'''
+import inspect
+import asyncio
+import argparse
+import tempfile
+
+from aiohttp import web
+from multidict import CIMultiDict
+from flask import current_app, request
+from werkzeug.exceptions import HTTPException
+
+import app as appModule
+
+#headers aiohttp writes itself
+HOP_HEADERS = ("content-length", "transfer-encoding", "connection")
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+#request bodies bigger than this are spooled to disk
+SPOOL_BYTES = 2**20
+
+
+async def _index():
+    return await appModule.getComponents().controller.aindex(request)
+
+async def _stream():
+    return appModule.getComponents().submitButtonHandler.astream(request)
+
+#flask endpoint->coroutine that answers it on the loop
+ASYNC_VIEWS = {"main": _index, "stream": _stream}
+
+
+def _toAiohttp(response):
+    '''
+    @param flask.Response response: a finished flask response
+    @returns aiohttp.web.Response
+    '''
+    headers = CIMultiDict((name, value) for name, value in
+            response.headers.items() if name.lower() not in HOP_HEADERS)
+    return web.Response(status=response.status_code, headers=headers,
+            body=response.get_data())
+
+
+async def _sendEvents(aioRequest, events):
+    '''
+    streams an async generator of Server-Sent-Events
+    @param aiohttp.web.Request aioRequest: the request
+    @param events: async generator<string> of events
+    @returns aiohttp.web.StreamResponse
+    '''
+    #process_response adds the session cookie and the like
+    app = current_app._get_current_object()
+    response = app.process_response(app.response_class(
+            mimetype="text/event-stream", headers=SSE_HEADERS))
+    stream = web.StreamResponse(status=200, headers=CIMultiDict(
+            (name, value) for name, value in response.headers.items()
+            if name.lower() not in HOP_HEADERS))
+    await stream.prepare(aioRequest)
+    async for event in events:
+        await stream.write(event.encode("utf-8"))
+    await stream.write_eof()
+    return stream
+
+
+async def _dispatch(aioRequest):
+    '''
+    @param aiohttp.web.Request aioRequest: the request, from a flask request
+      context pushed for it
+    @returns aiohttp.web.StreamResponse
+    '''
+    app = current_app._get_current_object()
+    endpoint = request.url_rule.endpoint if request.url_rule else None
+    view = ASYNC_VIEWS.get(endpoint)
+    if view is None:
+        #the thread sees a copy of this task's context, request and all
+        return _toAiohttp(await asyncio.to_thread(app.full_dispatch_request))
+    try:
+        #before_request hooks, which full_dispatch_request runs otherwise
+        rv = app.preprocess_request()
+        if rv is None:
+            rv = await view()
+        if inspect.isasyncgen(rv):
+            return await _sendEvents(aioRequest, rv)
+        response = app.make_response(rv)
+    except HTTPException as e:
+        response = e.get_response()
+    except Exception as e:
+        response = app.handle_exception(e)
+    return _toAiohttp(app.process_response(response))
+
+
+async def handle(aioRequest):
+    '''
+    answers any request through the flask app
+    @param aiohttp.web.Request aioRequest: the request
+    @returns aiohttp.web.StreamResponse
+    '''
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES) as body:
+        async for chunk in aioRequest.content.iter_chunked(2**16):
+            body.write(chunk)
+        contentLength = body.tell()
+        body.seek(0)
+        headers = [(name, value) for name, value in aioRequest.headers.items()
+                if name.lower() not in HOP_HEADERS]
+        with aioRequest.app["flaskApp"].test_request_context(aioRequest.path,
+                method=aioRequest.method,
+                query_string=aioRequest.query_string, headers=headers,
+                input_stream=body, content_length=contentLength):
+            return await _dispatch(aioRequest)
+
+
+async def _close(application):
+    components = application["flaskApp"].extensions["ai9"]
+    if components.isMade("apiManager"):
+        await components.apiManager.aclose()
+
+
+def makeApplication(flaskApp=None):
+    '''
+    @param flask.Flask flaskApp: the app to serve, defaults to a new one
+      from createApp
+    @returns aiohttp.web.Application: the app, ready to run
+    '''
+    application = web.Application(client_max_size=0)
+    application["flaskApp"] = flaskApp if flaskApp is not None else \
+            appModule.createApp()
+    application.router.add_route("*", "/{path:.*}", handle)
+    application.on_cleanup.append(_close)
+    return application
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args(argv)
+    web.run_app(makeApplication(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+'''
+Runs every prompt of a JSONL file through ApiManager.promptBatch.
+
+    python batchRunner.py prompts.jsonl completions.jsonl --model davinci
+
+Each input line is a json object with a "prompt". Each output line is
+{"line": <input line number>, "prompt": ..., "completion": ...}, in input
+order. The input is streamed, batches are sent with bounded concurrency, and
+a rerun with the same output file resumes after the last line written. Lines
+that aren't json with a string "prompt" are skipped with a warning. When a
+batch fails its prompts are retried one by one, and a prompt that fails alone
+is written as {"line": ..., "prompt": ..., "error": ...}, which a rerun treats
+as done. Requests go
+through a scheduler.ApiScheduler at background priority, which keeps the run
+under the account's rate limits and leaves a share of them to the app.
+Throughput is reported on stderr in prompts/s and tokens/s.
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import concurrent.futures
+from collections import deque
+
+import scheduler
+from openAiApi import ApiManager
+from transport import Transport
+
+
+def readBatches(inputPath, batchSize, skip):
+    '''
+    streams the input file in batches
+    @param string inputPath: the JSONL file of prompts
+    @param int batchSize: prompts per batch
+    @param int skip: number of leading lines already done
+    @returns generator<list<tuple>>: batches of (line number, prompt). Bad
+      lines are left out, with a warning on stderr
+    '''
+    batch = []
+    with open(inputPath, 'r', encoding="utf-8") as file:
+        for lineNumber, line in enumerate(file):
+            if lineNumber < skip or not line.strip():
+                continue
+            try:
+                prompt = json.loads(line)["prompt"]
+                if not isinstance(prompt, str):
+                    raise TypeError("prompt is a {}, not a string".format(
+                            type(prompt).__name__))
+            except (ValueError, KeyError, TypeError) as e:
+                print("skipping line {}: {!r}".format(lineNumber, e),
+                        file=sys.stderr)
+                continue
+            batch.append((lineNumber, prompt))
+            if len(batch) == batchSize:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def resumePoint(outputPath):
+    '''
+    finds where a previous run stopped, dropping a half written last line
+    @param string outputPath: the JSONL file of results
+    @returns int: the input line number to continue from
+    '''
+    if not os.path.exists(outputPath):
+        return 0
+    lastLine = -1
+    goodBytes = 0
+    with open(outputPath, 'rb') as file:
+        for line in file:
+            try:
+                lastLine = json.loads(line)["line"]
+            except (ValueError, KeyError, TypeError):
+                break
+            goodBytes += len(line)
+    with open(outputPath, 'r+b') as file:
+        file.truncate(goodBytes)
+    return lastLine + 1
+
+
+class BatchRunner:
+    '''
+    Sends batches of prompts concurrently and writes the results in input
+    order. At most `concurrency` batches are in flight; results that come
+    back early wait in order behind the ones still running.
+    @method run(inputPath, outputPath) : processes the whole file
+    '''
+
+    def __init__(self, apiManager, model, temperature=0.0, nTokens=None,
+            batchSize=20, concurrency=4, maxRequestTokens=16000):
+        '''
+        @param ApiManager apiManager: interface to the api
+        @param string model: the model to prompt
+        @param float temperature: sampling temperature
+        @param int nTokens: token budget of each prompt plus completion
+        @param int batchSize: prompts read per batch, at most 20 per request
+        @param int concurrency: batches in flight at once
+        @param int maxRequestTokens: passed to ApiManager.promptBatch
+        '''
+        self._apiManager = apiManager
+        self._model = model
+        self._temperature = temperature
+        self._nTokens = nTokens
+        self._batchSize = batchSize
+        self._concurrency = concurrency
+        self._maxRequestTokens = maxRequestTokens
+        self.prompts = 0
+        self.tokens = 0
+        self.errors = 0
+
+    def _runBatch(self, batch):
+        #returns a result dict per prompt, with a completion or an error, and
+        #the tokens used. Batches give way to interactive prompts
+        with scheduler.priority(scheduler.BACKGROUND):
+            try:
+                completions, usage = self._apiManager.promptBatch(
+                        [prompt for _, prompt in batch], model=self._model,
+                        temperature=self._temperature, nTokens=self._nTokens,
+                        maxPrompts=min(self._batchSize, 20),
+                        maxRequestTokens=self._maxRequestTokens)
+            except Exception as e:
+                if len(batch) == 1:
+                    return [{"error": repr(e)}], 0
+                failure = e
+            else:
+                return ([{"completion": completion}
+                        for completion in completions],
+                        usage["total_tokens"])
+        #one bad prompt shouldn't cost the rest of its batch
+        print("batch at line {} failed, retrying its prompts alone: {!r}"
+                .format(batch[0][0], failure), file=sys.stderr)
+        results = []
+        tokens = 0
+        for entry in batch:
+            result, used = self._runBatch([entry])
+            results.extend(result)
+            tokens += used
+        return results, tokens
+
+    def run(self, inputPath, outputPath):
+        '''
+        @param string inputPath: the JSONL file of prompts
+        @param string outputPath: the JSONL file of results, appended to
+        '''
+        skip = resumePoint(outputPath)
+        if skip:
+            print("resuming at line {}".format(skip), file=sys.stderr)
+        start = time.monotonic()
+        pending = deque()
+        with concurrent.futures.ThreadPoolExecutor(self._concurrency) as pool,\
+                open(outputPath, 'a', encoding="utf-8") as output:
+            for batch in readBatches(inputPath, self._batchSize, skip):
+                pending.append((batch, pool.submit(self._runBatch, batch)))
+                if len(pending) >= self._concurrency:
+                    self._write(pending.popleft(), output, start)
+            while pending:
+                self._write(pending.popleft(), output, start)
+        self._report(start)
+
+    def _write(self, entry, output, start):
+        batch, future = entry
+        results, tokens = future.result()
+        for (lineNumber, prompt), result in zip(batch, results):
+            if "error" in result:
+                print("line {} failed: {}".format(lineNumber, result["error"]),
+                        file=sys.stderr)
+                self.errors += 1
+            output.write(json.dumps(dict(line=lineNumber, prompt=prompt,
+                    **result)) + "\n")
+        #a batch is either fully written or, after a crash, resumed
+        output.flush()
+        self.prompts += len(batch)
+        self.tokens += tokens
+        self._report(start)
+
+    def _report(self, start):
+        elapsed = max(time.monotonic() - start, 1e-9)
+        print("{} prompts, {} errors, {} tokens, {:.1f} prompts/s, "
+                "{:.1f} tokens/s".format(self.prompts, self.errors,
+                self.tokens, self.prompts / elapsed, self.tokens / elapsed),
+                file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file with a prompt per line")
+    parser.add_argument("output", help="JSONL file to write completions to")
+    parser.add_argument("--model", default="text-davinci-003")
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--nTokens", type=int, default=None,
+            help="token budget of each prompt plus its completion")
+    parser.add_argument("--batchSize", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--maxRequestTokens", type=int, default=16000)
+    parser.add_argument("--requestsPerMinute", type=float, default=3000,
+            help="the account's request rate limit")
+    parser.add_argument("--tokensPerMinute", type=float, default=250000,
+            help="the account's token rate limit")
+    parser.add_argument("--apiKeyFile", default="apiKey")
+    parser.add_argument("--apiBase", default=None,
+            help="e.g. the url of a fakeApi.FakeOpenAiServer")
+    args = parser.parse_args(argv)
+    with open(args.apiKeyFile, 'r') as file:
+        apiKey = file.read().strip()
+    apiScheduler = scheduler.ApiScheduler(
+            requestsPerMinute=args.requestsPerMinute,
+            tokensPerMinute=args.tokensPerMinute)
+    apiManager = ApiManager(apiKey, apiBase=args.apiBase,
+            transport=Transport(scheduler=apiScheduler))
+    runner = BatchRunner(apiManager, args.model,
+            temperature=args.temperature, nTokens=args.nTokens,
+            batchSize=args.batchSize, concurrency=args.concurrency,
+            maxRequestTokens=args.maxRequestTokens)
+    runner.run(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
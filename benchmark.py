@@ -0,0 +1,404 @@
+'''
+Load benchmark of the app against a local fake openai api.
+
+    python benchmark.py
+    python benchmark.py --scenarios pageLoad prompt --concurrency 1 16 64
+    python benchmark.py --latency 0.2 --distribution lognormal --json now.json
+    python benchmark.py --baseline before.json --tolerance 0.2
+    python benchmark.py --scenarios pageLoad --coldStarts 10
+
+Every scenario is run at every concurrency level: that many client threads,
+each with its own session, send requests until --requests are done. The
+report gives throughput and p50/p95/p99 latency per run, and how many api
+requests the fake server saw. With --baseline, a run whose p95 grew, or whose
+throughput fell, by more than --tolerance is a regression and the exit code
+is 1. With --coldStarts the app is also started that many times in new
+processes, timing how long it takes to be made (coldStart) and to answer its
+first page load (firstLoad).
+
+By default the app is imported into this process, inside a scratch directory
+with a throwaway apiKey, and driven through flask's test client, so the
+numbers are the app's own, without a network in between. With --url the
+requests go over http to a server started separately, e.g. the async server
+pointed at the fake api (see fakeApi.py).
+'''
+import io
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+
+import fakeApi
+
+PROMPT_FORM = {"model": "text-davinci-003", "nTokens": "256",
+        #not 0, which the completion cache would answer
+        "temperature": "0.7"}
+#uploads need names that were never used
+_uploadIds = itertools.count()
+
+
+def _promptForm(i):
+    form = dict(PROMPT_FORM)
+    form["textbox"] = "benchmark prompt number {}".format(i)
+    return form
+
+def _dataset(name, lines):
+    #content unique to the upload, or the app skips it as a duplicate
+    return "".join(json.dumps({"prompt": "{} question {} ->".format(name, i),
+            "completion": " answer {}\n".format(i)}) + "\n"
+            for i in range(lines)).encode("utf-8")
+
+def _pageLoad(i, args):
+    return "GET", "/", None, None
+
+def _poll(i, args):
+    return "GET", "/api/files", None, None
+
+def _prompt(i, args):
+    form = _promptForm(i)
+    form["submitPrompt"] = ""
+    return "POST", "/", form, None
+
+def _stream(i, args):
+    return "POST", "/stream", _promptForm(i), None
+
+def _upload(i, args):
+    name = "bench{}-{}.json".format(os.getpid(), next(_uploadIds))
+    return "POST", "/", {"upload": ""}, \
+            {"fileChooser": (name, _dataset(name, args.uploadLines))}
+
+def _refresh(i, args):
+    return "POST", "/", {"refresh": ""}, None
+
+#name->function(i, args) returning the (method, path, form, files) to send
+SCENARIOS = {"pageLoad": _pageLoad, "poll": _poll, "prompt": _prompt,
+        "stream": _stream, "upload": _upload, "refresh": _refresh}
+
+
+class _FlaskClient:
+    '''
+    sends requests through the test client of the app in this process
+    '''
+
+    def __init__(self, app):
+        self._client = app.test_client()
+
+    def send(self, method, path, form, files):
+        '''
+        @returns int: the status, once the whole body has been read
+        '''
+        data = dict(form or {})
+        for field, (name, content) in (files or {}).items():
+            data[field] = (io.BytesIO(content), name)
+        response = self._client.open(path, method=method, data=data)
+        response.get_data()
+        response.close()
+        return response.status_code
+
+
+class _HttpClient:
+    '''
+    sends requests to a server over http, keeping its connection
+    '''
+
+    def __init__(self, url):
+        import requests
+        self._url = url.rstrip("/")
+        self._session = requests.Session()
+
+    def send(self, method, path, form, files):
+        response = self._session.request(method, self._url + path, data=form,
+                files=files)
+        response.content
+        return response.status_code
+
+
+def percentile(values, p):
+    '''
+    @param list<float> values: sorted
+    @param float p: the percentile, in (0, 100]
+    @returns float: the nearest rank percentile, None if there are no values
+    '''
+    if not values:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def runLevel(scenario, concurrency, nRequests, makeClient, args):
+    '''
+    sends nRequests requests of a scenario from concurrency threads
+    @param scenario: function from SCENARIOS
+    @param makeClient: function returning a new client, one per thread
+    @returns dict: the run's statistics
+    '''
+    nextRequest = itertools.count()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker():
+        client = makeClient()
+        #one untimed request, so a session exists and caches are warm
+        try:
+            client.send(*scenario(-1, args))
+        finally:
+            ready.wait()
+        while True:
+            i = next(nextRequest)
+            if i >= nRequests:
+                return
+            request = scenario(i, args)
+            start = time.perf_counter()
+            try:
+                status = client.send(*request)
+            except Exception as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    #the clock starts once every thread has warmed up
+    ready = threading.Barrier(concurrency + 1)
+    threads = [threading.Thread(target=worker, daemon=True)
+            for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items()
+            if not isinstance(status, int) or status >= 400)
+    return {"requests": len(latencies), "errors": errors,
+            "seconds": seconds,
+            "throughput": len(latencies) / seconds if seconds else None,
+            "p50": percentile(latencies, 50), "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else None,
+            "statuses": {str(status): count
+                for status, count in statuses.items()}}
+
+
+#run by coldStart in a new interpreter, in a scratch directory. Prints the
+#wall clock times it got to each point, and the first page load's status
+_COLD_START = """
+import sys, time, json
+started = time.time()
+import app
+imported = time.time()
+flaskApp = app.createApp()
+made = time.time()
+response = flaskApp.test_client().get("/")
+response.get_data()
+answered = time.time()
+flaskApp.extensions["ai9"].waitWarm()
+print(json.dumps({"started": started, "imported": imported, "made": made,
+        "answered": answered, "warm": time.time(),
+        "status": response.status_code}))
+"""
+
+
+def _timings(name, values, errors):
+    '''
+    @param list<float> values: seconds, one per run
+    @returns dict: statistics like runLevel's, without a throughput
+    '''
+    values = sorted(values)
+    return {"scenario": name, "concurrency": 1, "requests": len(values),
+            "errors": errors, "seconds": sum(values), "throughput": None,
+            "p50": percentile(values, 50), "p95": percentile(values, 95),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else None, "statuses": {}}
+
+
+def coldStart(url, runs):
+    '''
+    Starts the app in a new process runs times, each in a new scratch
+    directory pointed at the fake api, and times how long it takes to come
+    up and answer its first page load, as an autoscaled worker would.
+    @param string url: the fake api's base url
+    @param int runs: how many processes to start
+    @returns list<dict>: coldStart (process start until the app is made)
+      and firstLoad (its first page load) statistics, and the average
+      time of each step
+    '''
+    root = os.path.dirname(os.path.abspath(__file__))
+    environment = dict(os.environ, OPENAI_API_BASE=url,
+            PYTHONPATH=os.pathsep.join(filter(None, [root,
+            os.environ.get("PYTHONPATH")])))
+    steps = {"interpreter": [], "import": [], "createApp": [],
+            "firstRequest": [], "warm": []}
+    starts = []
+    errors = 0
+    for _ in range(runs):
+        spawned = time.time()
+        result = subprocess.run([sys.executable, "-c", _COLD_START],
+                cwd=_scratchDirectory(), env=environment,
+                capture_output=True, text=True)
+        try:
+            times = json.loads(result.stdout.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            print(result.stderr, file=sys.stderr)
+            errors += 1
+            continue
+        if times["status"] >= 400:
+            errors += 1
+        starts.append(times["made"] - spawned)
+        steps["interpreter"].append(times["started"] - spawned)
+        steps["import"].append(times["imported"] - times["started"])
+        steps["createApp"].append(times["made"] - times["imported"])
+        steps["firstRequest"].append(times["answered"] - times["made"])
+        steps["warm"].append(times["warm"] - times["made"])
+    print("cold start, mean ms: " + ", ".join("{} {:.1f}".format(step,
+            sum(values) / len(values) * 1000)
+            for step, values in steps.items() if values))
+    return [_timings("coldStart", starts, errors),
+            _timings("firstLoad", steps["firstRequest"], errors)]
+
+
+def compare(results, baseline, tolerance):
+    '''
+    @param list<dict> results: this run's
+    @param list<dict> baseline: an earlier run's, from --json
+    @param float tolerance: the fraction a number may get worse by
+    @returns list<string>: the regressions found
+    '''
+    before = {(run["scenario"], run["concurrency"]): run for run in baseline}
+    regressions = []
+    for run in results:
+        old = before.get((run["scenario"], run["concurrency"]))
+        if old is None:
+            continue
+        name = "{} x{}".format(run["scenario"], run["concurrency"])
+        if old["p95"] and run["p95"] > old["p95"] * (1 + tolerance):
+            regressions.append("{}: p95 {:.1f}ms, was {:.1f}ms".format(name,
+                    run["p95"] * 1000, old["p95"] * 1000))
+        if old["throughput"] and \
+                run["throughput"] < old["throughput"] * (1 - tolerance):
+            regressions.append("{}: {:.1f} req/s, was {:.1f}".format(name,
+                    run["throughput"], old["throughput"]))
+    return regressions
+
+
+def _report(run):
+    def ms(seconds):
+        return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+    return "{:<10}{:>6}{:>8}{:>7}{:>10.1f}{:>9}{:>9}{:>9}{:>9}{:>9}".format(
+            run["scenario"], run["concurrency"], run["requests"],
+            run["errors"], run["throughput"] or 0, ms(run["p50"]),
+            ms(run["p95"]), ms(run["p99"]), ms(run["max"]),
+            "-" if run["apiRequests"] is None else run["apiRequests"])
+
+
+def _scratchDirectory():
+    '''
+    @returns string: a new directory with a throwaway apiKey, for the app to
+      run in
+    '''
+    directory = tempfile.mkdtemp(prefix="ai9-benchmark-")
+    with open(os.path.join(directory, "apiKey"), 'w') as file:
+        file.write("benchmark\n")
+    return directory
+
+
+def _importApp(url):
+    '''
+    makes the app in a scratch directory, pointed at the fake api
+    @param string url: the fake api's base url
+    @returns flask.Flask: the app, warmed up
+    '''
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(_scratchDirectory())
+    import openai
+    openai.api_base = url
+    import app
+    flaskApp = app.createApp()
+    flaskApp.extensions["ai9"].waitWarm()
+    return flaskApp
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS),
+            default=["pageLoad", "poll", "prompt", "stream", "refresh"])
+    parser.add_argument("--concurrency", nargs="+", type=int,
+            default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200,
+            help="requests per scenario and concurrency level")
+    parser.add_argument("--uploadLines", type=int, default=100,
+            help="lines in every uploaded dataset")
+    parser.add_argument("--url", default=None,
+            help="benchmark a server at this url instead of in process")
+    parser.add_argument("--json", default=None,
+            help="write the results to this file")
+    parser.add_argument("--baseline", default=None,
+            help="results of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--coldStarts", type=int, default=0,
+            help="also time this many cold starts of the app in new "
+            "processes, not with --url")
+    fakeApi.addServerArguments(parser)
+    args = parser.parse_args(argv)
+    #the app runs in a scratch directory
+    for name in ("json", "baseline"):
+        if getattr(args, name) is not None:
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+
+    server = None
+    if args.url is not None:
+        makeClient = lambda: _HttpClient(args.url)
+    else:
+        server = fakeApi.serverFromArguments(args)
+        app = _importApp(server.start())
+        makeClient = lambda: _FlaskClient(app)
+    print("{:<10}{:>6}{:>8}{:>7}{:>10}{:>9}{:>9}{:>9}{:>9}{:>9}".format(
+            "scenario", "conc", "reqs", "errs", "req/s", "p50ms", "p95ms",
+            "p99ms", "maxms", "apiReqs"))
+    results = []
+    for name in args.scenarios:
+        for concurrency in args.concurrency:
+            before = sum(server.getRequestCounts().values()) if server else 0
+            run = runLevel(SCENARIOS[name], concurrency, args.requests,
+                    makeClient, args)
+            run["scenario"] = name
+            run["concurrency"] = concurrency
+            run["apiRequests"] = sum(server.getRequestCounts().values()) - \
+                    before if server else None
+            results.append(run)
+            print(_report(run))
+    if server is not None and args.coldStarts:
+        before = sum(server.getRequestCounts().values())
+        runs = coldStart(server.url, args.coldStarts)
+        #the api requests of the cold starts go on their first line
+        runs[0]["apiRequests"] = sum(server.getRequestCounts().values()) - \
+                before
+        runs[1]["apiRequests"] = None
+        for run in runs:
+            print(_report(run))
+        results.extend(runs)
+    if server is not None:
+        server.stop()
+    if args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class CompletionCache:
+    '''
+    Cache of completion responses for deterministic prompts, which only makes
+    sense at temperature 0. Entries are keyed by model, prompt hash,
+    max_tokens and temperature. There are two tiers: an in memory lru of the
+    most recent entries, and a sqlite file on disk that survives restarts and
+    is trimmed, least recently used first, once it grows past maxDiskBytes.
+    Safe to use from several threads.
+    @method key(model, prompt, maxTokens, temperature) : the cache key
+    @method get(key) : the cached response, or None
+    @method put(key, model, response) : stores a response
+    @method invalidateModel(model) : forgets every entry of a model
+    @method getStats() : hit and miss counters
+    '''
+
+    def __init__(self, path=os.path.join("MetaData", "completions.sqlite"),
+            memoryEntries=1024, maxDiskBytes=256 * 2**20):
+        '''
+        @param string path: the sqlite file of the disk tier
+        @param int memoryEntries: the most entries in the memory tier
+        @param int maxDiskBytes: the most response bytes in the disk tier
+        '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._memoryEntries = memoryEntries
+        self._maxDiskBytes = maxDiskBytes
+        #key->(model, response), least recently used first
+        self._memory = OrderedDict()
+        self._stats = {"memoryHits": 0, "diskHits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        #other processes of the app may use the same file, WAL lets them
+        #read while one writes
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, "
+                "size INTEGER, lastUsed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS completionsByModel "
+                "ON completions (model)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS completionsByUse "
+                "ON completions (lastUsed)")
+        self._db.commit()
+        self._diskBytes = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def key(model, prompt, maxTokens, temperature):
+        '''
+        @param string model: the model prompted
+        @param string prompt: the prompt
+        @param int maxTokens: the max_tokens sent
+        @param float temperature: the temperature sent
+        @returns string: the key of this request
+        '''
+        promptHash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        return json.dumps([model, promptHash, maxTokens, float(temperature)])
+
+    def get(self, key):
+        '''
+        @param string key: from CompletionCache.key
+        @returns dict: the cached response, None on a miss
+        '''
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats["memoryHits"] += 1
+                return json.loads(self._memory[key][1])
+            row = self._db.execute(
+                    "SELECT model, response FROM completions WHERE key = ?",
+                    (key,)).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            self._stats["diskHits"] += 1
+            self._db.execute("UPDATE completions SET lastUsed = ? "
+                    "WHERE key = ?", (time.time(), key))
+            self._db.commit()
+            self._remember(key, row[0], row[1])
+            return json.loads(row[1])
+
+    def put(self, key, model, response):
+        '''
+        @param string key: from CompletionCache.key
+        @param string model: the model prompted, so it can be invalidated
+        @param dict response: the completion response
+        '''
+        data = json.dumps(response)
+        size = len(data)
+        with self._lock:
+            self._remember(key, model, data)
+            old = self._db.execute("SELECT size FROM completions "
+                    "WHERE key = ?", (key,)).fetchone()
+            if old is not None:
+                self._diskBytes -= old[0]
+            self._db.execute("INSERT OR REPLACE INTO completions "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, model, data, size, time.time()))
+            self._diskBytes += size
+            self._trim()
+            self._db.commit()
+
+    def invalidateModel(self, model):
+        '''
+        forgets every entry of model, for when the model is deleted
+        @param string model: the model
+        '''
+        with self._lock:
+            for key in [key for key, (entryModel, _) in self._memory.items()
+                    if entryModel == model]:
+                del self._memory[key]
+            removed = self._db.execute("SELECT COALESCE(SUM(size), 0) "
+                    "FROM completions WHERE model = ?", (model,)).fetchone()[0]
+            self._db.execute("DELETE FROM completions WHERE model = ?",
+                    (model,))
+            self._db.commit()
+            self._diskBytes -= removed
+
+    def getStats(self):
+        '''
+        @returns dict: memoryHits, diskHits, misses, memoryEntries, diskBytes
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memoryEntries"] = len(self._memory)
+            stats["diskBytes"] = self._diskBytes
+        return stats
+
+    def _remember(self, key, model, data):
+        '''
+        puts an entry in the memory tier. Holds the lock.
+        '''
+        self._memory[key] = (model, data)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self._memoryEntries:
+            self._memory.popitem(last=False)
+
+    def _trim(self):
+        '''
+        deletes least recently used disk entries until we are within
+        maxDiskBytes. Holds the lock.
+        '''
+        while self._diskBytes > self._maxDiskBytes:
+            rows = self._db.execute("SELECT key, size FROM completions "
+                    "ORDER BY lastUsed LIMIT 64").fetchall()
+            if not rows:
+                break
+            #the rows are read in batches, but only as many are deleted as
+            #it takes
+            deleted = []
+            for key, size in rows:
+                if self._diskBytes <= self._maxDiskBytes:
+                    break
+                deleted.append((key,))
+                self._diskBytes -= size
+            self._db.executemany("DELETE FROM completions WHERE key = ?",
+                    deleted)
@@ -0,0 +1,314 @@
+import time
+import threading
+from collections import deque, OrderedDict
+
+from tokenizer import getTokenizer
+
+
+class Turn:
+    '''
+    One prompt/response pair with its token count. Slotted, since a busy
+    process holds a lot of these.
+    '''
+    __slots__ = ("prompt", "response", "tokens")
+
+    #rough bytes a turn costs besides its text: the object and two str headers
+    OVERHEAD = 200
+
+    def __init__(self, prompt, response, tokens):
+        '''
+        @param string prompt: what the user typed
+        @param string response: what the model answered
+        @param int tokens: tokens the turn uses in a feed
+        '''
+        self.prompt = prompt
+        self.response = response
+        self.tokens = tokens
+
+    def size(self):
+        '''
+        @returns int: estimate of the bytes this turn holds on to
+        '''
+        return len(self.prompt) + len(self.response) + self.OVERHEAD
+
+
+class ContextWindow:
+    '''
+    Running, token counted history of a conversation. Turns are appended at
+    the end and the oldest turns are evicted once the history holds more than
+    maxTokens, so memory and prompt building stay bounded however long the
+    conversation goes. Every turn is tokenized once, when it is added.
+    @method append(prompt, response) : adds a turn, evicting the oldest
+    @method feed(budget) : the newest turns that fit in budget, as a prompt
+    @method turns() : the kept turns, oldest first
+    @method clear() : forgets every turn
+    '''
+
+    def __init__(self, maxTokens=8192, tokenizer=None):
+        '''
+        @param int maxTokens: the most tokens of history kept
+        @param Tokenizer tokenizer: counts tokens, defaults to the shared one
+        '''
+        self._maxTokens = maxTokens
+        self._tokenizer = tokenizer if tokenizer is not None else getTokenizer()
+        #Turns, oldest first
+        self._turns = deque()
+        self._tokenCount = 0
+        self._size = 0
+
+    def makeTurn(self, prompt, response):
+        '''
+        tokenizes a turn, without adding it
+        @param string prompt: what the user typed
+        @param string response: what the model answered
+        @returns Turn: the turn, ready for appendTurn
+        '''
+        #two newlines join the turn into the feed
+        tokens = self._tokenizer.countTokens(prompt) + \
+                self._tokenizer.countTokens(response) + 2
+        return Turn(prompt, response, tokens)
+
+    def append(self, prompt, response):
+        '''
+        adds a turn, then evicts from the front until we are within maxTokens.
+        The newest turn is always kept, even if it alone is too big.
+        @param string prompt: what the user typed
+        @param string response: what the model answered
+        '''
+        self.appendTurn(self.makeTurn(prompt, response))
+
+    def appendTurn(self, turn):
+        '''
+        append, for a turn made by makeTurn
+        @param Turn turn: the turn to add
+        '''
+        self._turns.append(turn)
+        self._tokenCount += turn.tokens
+        self._size += turn.size()
+        while self._tokenCount > self._maxTokens and len(self._turns) > 1:
+            evicted = self._turns.popleft()
+            self._tokenCount -= evicted.tokens
+            self._size -= evicted.size()
+
+    def feed(self, budget):
+        '''
+        builds the history part of a prompt, newest turns first until budget
+        runs out. If even the newest turn does not fit, its end is kept.
+        Cost depends on the turns that fit, not the length of the history.
+        @param int budget: the most tokens the feed may use
+        @returns string: the turns, oldest first, separated by newlines
+        '''
+        parts = []
+        used = 0
+        for turn in reversed(self._turns):
+            if used + turn.tokens > budget:
+                if not parts and budget > 0:
+                    text = "{}\n{}".format(turn.prompt, turn.response)
+                    parts.append(self._tokenizer.truncateLeft(text, budget))
+                break
+            parts.append(turn.response)
+            parts.append(turn.prompt)
+            used += turn.tokens
+        parts.reverse()
+        return "\n".join(parts)
+
+    def turns(self):
+        '''
+        @returns list<tuple<string>>: prompt/response pairs, oldest first
+        '''
+        return [(turn.prompt, turn.response) for turn in self._turns]
+
+    def clear(self):
+        self._turns.clear()
+        self._tokenCount = 0
+        self._size = 0
+
+    def tokenCount(self):
+        '''
+        @returns int: tokens of history currently kept
+        '''
+        return self._tokenCount
+
+    def size(self):
+        '''
+        @returns int: estimate of the bytes the kept turns hold on to
+        '''
+        return self._size
+
+
+class ConversationStore:
+    '''
+    The conversations of every session, each a ContextWindow. Sessions are
+    kept in least recently used order. Sessions idle for longer than
+    idleSeconds expire, and once the sessions together hold more than
+    maxBytes, or there are more than maxSessions, the least recently used
+    ones are dropped. Safe to use from several threads.
+    With a backend the sessions are kept in it as well, and what is held here
+    is a cache: a session dropped from memory is loaded again when next used,
+    and one changed by another process is reloaded. A backend has
+    version(sessionId), load(sessionId) -> (version, [(prompt, response,
+    tokens)]), append(sessionId, prompt, response, tokens, maxTokens) ->
+    (versionBefore, versionAfter) and clear(sessionId); see
+    sharedState.SqliteConversationBackend and conversationLog.ConversationLog.
+    @method feed(sessionId, budget) : history of a session for a prompt
+    @method append(sessionId, prompt, response) : adds a turn to a session
+    @method getConversation(sessionId) : turns of a session, latest first
+    @method clear(sessionId) : forgets a session
+    '''
+
+    def __init__(self, historyTokens=8192, maxBytes=64 * 2**20,
+            maxSessions=10000, idleSeconds=3600.0, backend=None):
+        '''
+        @param int historyTokens: the most tokens of history kept per session
+        @param int maxBytes: memory budget for all conversations together
+        @param int maxSessions: the most sessions kept
+        @param float idleSeconds: sessions unused this long are dropped
+        @param backend: where sessions are kept beyond this process, or None
+        '''
+        self._historyTokens = historyTokens
+        self._maxBytes = maxBytes
+        self._maxSessions = maxSessions
+        self._idleSeconds = idleSeconds
+        #sessionId->(ContextWindow, last used), least recently used first
+        self._sessions = OrderedDict()
+        self._size = 0
+        self._backend = backend
+        #sessionId->backend version its ContextWindow was loaded at
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def feed(self, sessionId, budget):
+        '''
+        @param string sessionId: the session
+        @param int budget: the most tokens the feed may use
+        @returns string: see ContextWindow.feed
+        '''
+        with self._lock:
+            #a session with no history isn't kept just for being read
+            if not self._exists(sessionId):
+                return ""
+            return self._touch(sessionId).feed(budget)
+
+    def append(self, sessionId, prompt, response):
+        '''
+        adds a turn to the conversation of a session
+        @param string sessionId: the session
+        @param string prompt: what the user typed
+        @param string response: what the model answered
+        '''
+        with self._lock:
+            context = self._touch(sessionId)
+        #tokenizing can take a while, so it happens outside the lock
+        turn = context.makeTurn(prompt, response)
+        with self._lock:
+            context = self._touch(sessionId)
+            before = context.size()
+            context.appendTurn(turn)
+            self._size += context.size() - before
+            if self._backend is not None:
+                versionBefore, versionAfter = self._backend.append(sessionId,
+                        prompt, response, turn.tokens, self._historyTokens)
+                #if another process got in first we miss its turn, so reload
+                self._versions[sessionId] = versionAfter if \
+                        versionBefore == self._versions.get(sessionId) else None
+            self._enforceLimits()
+
+    def getConversation(self, sessionId):
+        '''
+        @param string sessionId: the session
+        @returns list<tuple<string>>: prompt/response pairs, latest first
+        '''
+        with self._lock:
+            #a session with no turns isn't kept just for being read
+            if not self._exists(sessionId):
+                return []
+            conversation = self._touch(sessionId).turns()
+        conversation.reverse()
+        return conversation
+
+    def clear(self, sessionId):
+        '''
+        forgets the conversation of a session
+        @param string sessionId: the session
+        '''
+        with self._lock:
+            if self._backend is not None:
+                self._backend.clear(sessionId)
+            self._drop(sessionId)
+
+    def size(self):
+        '''
+        @returns tuple<int>: number of sessions, estimated bytes they hold
+        '''
+        with self._lock:
+            return len(self._sessions), self._size
+
+    def _exists(self, sessionId):
+        '''
+        @returns bool: whether the session is here, or has turns in the
+          backend. Holds the lock
+        '''
+        return sessionId in self._sessions or (self._backend is not None and
+                self._backend.version(sessionId) != 0)
+
+    def _touch(self, sessionId):
+        '''
+        marks a session as just used, creating it if needed, or loading it
+        from the backend if it isn't here or is outdated, then drops whatever
+        is past the limits. Holds the lock.
+        @returns ContextWindow: the conversation of the session
+        '''
+        now = time.monotonic()
+        context = None
+        if sessionId in self._sessions:
+            context, _ = self._sessions.pop(sessionId)
+        if self._backend is not None and (context is None or
+                self._versions.get(sessionId) !=
+                self._backend.version(sessionId)):
+            if context is not None:
+                self._size -= context.size()
+            context = self._load(sessionId)
+            self._size += context.size()
+        if context is None:
+            context = ContextWindow(maxTokens=self._historyTokens)
+        self._sessions[sessionId] = (context, now)
+        self._expire(now)
+        self._enforceLimits()
+        return context
+
+    def _load(self, sessionId):
+        '''
+        @returns ContextWindow: the session as the backend has it
+        '''
+        version, turns = self._backend.load(sessionId)
+        context = ContextWindow(maxTokens=self._historyTokens)
+        for prompt, response, tokens in turns:
+            context.appendTurn(Turn(prompt, response, tokens))
+        self._versions[sessionId] = version
+        return context
+
+    def _drop(self, sessionId):
+        self._versions.pop(sessionId, None)
+        entry = self._sessions.pop(sessionId, None)
+        if entry is not None:
+            self._size -= entry[0].size()
+
+    def _expire(self, now):
+        '''
+        drops idle sessions. They sit at the front, so this stops at the
+        first session that is still in use.
+        '''
+        while self._sessions:
+            sessionId, (_, lastUsed) = next(iter(self._sessions.items()))
+            if now - lastUsed <= self._idleSeconds:
+                break
+            self._drop(sessionId)
+
+    def _enforceLimits(self):
+        '''
+        drops least recently used sessions until we are within the limits,
+        never the most recent one
+        '''
+        while len(self._sessions) > 1 and (self._size > self._maxBytes or
+                len(self._sessions) > self._maxSessions):
+            self._drop(next(iter(self._sessions)))
@@ -0,0 +1,214 @@
+'''
+Append-only, on-disk log of the conversation of every session, so
+conversations survive a restart without being loaded into memory up front.
+
+Each session has two files, under a directory named after the first two
+characters of its id:
+
+    <sessionId>.log : its turns, one record each, in the order they happened.
+                      A record is a header of two big endian uint32, the
+                      length of the body and the turn's tokens, followed by
+                      the body, the json of [prompt, response]
+    <sessionId>.idx : a big endian uint64 per record, its offset in the log
+
+Appending a turn writes one record and one index entry, whatever the length
+of the conversation. Reading the newest turns maps both files and jumps
+straight to their records through the index, so only what is returned gets
+parsed. The record is written before its index entry: a crash in between
+leaves a record nobody points at, which is harmless.
+'''
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+
+_HEADER = struct.Struct(">II")
+_OFFSET = struct.Struct(">Q")
+
+
+class ConversationLog:
+    '''
+    Keeps the conversations of a ConversationStore in per session logs, so a
+    session resumes after a restart from its newest turns. It is a backend
+    for ConversationStore, like sharedState.SqliteConversationBackend, for a
+    single process: the version of a session is the number of turns it has
+    logged. Logs are never rewritten. A session's history is trimmed when it
+    is read, to the newest turns within the store's token budget, and the
+    logs of sessions idle for longer than idleSeconds are deleted now and
+    then.
+    @method version(sessionId)
+    @method load(sessionId) : version, [(prompt, response, tokens)]
+    @method append(sessionId, prompt, response, tokens, maxTokens)
+    @method clear(sessionId)
+    '''
+
+    def __init__(self, directory=os.path.join("MetaData", "conversations"),
+            historyTokens=8192, idleSeconds=7 * 24 * 3600.0,
+            expireEvery=600.0):
+        '''
+        @param string directory: where the logs are kept
+        @param int historyTokens: the most tokens of history load returns.
+          Use the store's historyTokens
+        @param float idleSeconds: logs unused this long are deleted
+        @param float expireEvery: seconds between sweeps for idle logs
+        '''
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self._directory = directory
+        self._historyTokens = historyTokens
+        self._idleSeconds = idleSeconds
+        self._expireEvery = expireEvery
+        self._lastExpire = time.time()
+        self._lock = threading.Lock()
+
+    def _paths(self, sessionId):
+        '''
+        @returns tuple<string>: the log and the index of a session
+        '''
+        assert(sessionId and os.path.basename(sessionId) == sessionId and
+                not sessionId.startswith(".")), \
+                "bad session id {!r}".format(sessionId)
+        base = os.path.join(self._directory, sessionId[:2], sessionId)
+        return base + ".log", base + ".idx"
+
+    def version(self, sessionId):
+        '''
+        @returns int: the turns the session has logged, 0 if none
+        '''
+        try:
+            return os.path.getsize(self._paths(sessionId)[1]) // _OFFSET.size
+        except FileNotFoundError:
+            return 0
+
+    def load(self, sessionId):
+        '''
+        @returns tuple: the version, and the newest turns within
+          historyTokens as (prompt, response, tokens), oldest first. The
+          newest turn is returned even if it alone is too big
+        '''
+        with self._lock:
+            with _Mapped(*self._paths(sessionId)) as mapped:
+                start = mapped.count
+                used = 0
+                while start > 0:
+                    used += mapped.tokens(start - 1)
+                    if used > self._historyTokens and start != mapped.count:
+                        break
+                    start -= 1
+                return mapped.count, mapped.turns(start)
+
+    def append(self, sessionId, prompt, response, tokens, maxTokens):
+        '''
+        logs a turn. Nothing is deleted, load trims the history instead
+        @param int maxTokens: unused, load trims to historyTokens
+        @returns tuple<int>: the session's version before, and after
+        '''
+        self._maybeExpire()
+        logPath, indexPath = self._paths(sessionId)
+        body = json.dumps([prompt, response]).encode("utf-8")
+        with self._lock:
+            directory = os.path.dirname(logPath)
+            if not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+            with open(logPath, "ab") as log:
+                offset = log.tell()
+                log.write(_HEADER.pack(len(body), tokens) + body)
+            with open(indexPath, "ab") as index:
+                #a torn entry from a crash would shift every later one
+                count, torn = divmod(index.tell(), _OFFSET.size)
+                if torn:
+                    index.truncate(count * _OFFSET.size)
+                index.write(_OFFSET.pack(offset))
+        return count, count + 1
+
+    def clear(self, sessionId):
+        with self._lock:
+            for path in self._paths(sessionId):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    def _maybeExpire(self):
+        now = time.time()
+        if now - self._lastExpire < self._expireEvery:
+            return
+        self._lastExpire = now
+        cutoff = now - self._idleSeconds
+        with self._lock:
+            for shard in os.scandir(self._directory):
+                if not shard.is_dir():
+                    continue
+                for entry in os.scandir(shard.path):
+                    try:
+                        if entry.stat().st_mtime < cutoff:
+                            os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+
+
+class _Mapped:
+    '''
+    a session's log and index, mapped read only, for a with block
+    '''
+
+    def __init__(self, logPath, indexPath):
+        self._paths = (logPath, indexPath)
+        self._files = []
+        self._maps = []
+        self.count = 0
+
+    def __enter__(self):
+        try:
+            self._log, self._index = [self._map(path) for path in self._paths]
+        except FileNotFoundError:
+            return self
+        if self._log is not None and self._index is not None:
+            self.count = len(self._index) // _OFFSET.size
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        self.close()
+        return False
+
+    def _map(self, path):
+        file = open(path, "rb")
+        self._files.append(file)
+        #an empty file can't be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        for file in self._files:
+            file.close()
+        self._maps, self._files = [], []
+
+    def _offset(self, i):
+        return _OFFSET.unpack_from(self._index, i * _OFFSET.size)[0]
+
+    def tokens(self, i):
+        '''
+        @returns int: the tokens of turn i, without parsing its body
+        '''
+        return _HEADER.unpack_from(self._log, self._offset(i))[1]
+
+    def turns(self, start):
+        '''
+        @returns list<tuple>: turns start to the newest, as (prompt,
+          response, tokens)
+        '''
+        turns = []
+        for i in range(start, self.count):
+            offset = self._offset(i)
+            length, tokens = _HEADER.unpack_from(self._log, offset)
+            offset += _HEADER.size
+            prompt, response = json.loads(self._log[offset:offset + length])
+            turns.append((prompt, response, tokens))
+        return turns
@@ -0,0 +1,289 @@
+'''
+Streaming validator and preprocessor for fine-tune datasets.
+
+    python dataset.py train.jsonl --output clean.jsonl
+    python dataset.py train.jsonl --output clean.jsonl --shardLines 100000
+
+Reads the JSONL file line by line in constant memory, checks every line is a
+{"prompt": str, "completion": str} object, drops exact duplicates, counts
+tokens and estimates the training cost, and writes the clean lines out,
+optionally split into shards. Prints the report as json.
+'''
+import sys
+import json
+import math
+import time
+import hashlib
+import argparse
+
+from tokenizer import getTokenizer
+
+#training price in dollars per 1000 tokens, by base model
+TRAINING_PRICES = {"ada": 0.0004, "babbage": 0.0006, "curie": 0.003,
+        "davinci": 0.03}
+DEFAULT_EPOCHS = 4
+
+
+def trainingCost(tokens, model, epochs=DEFAULT_EPOCHS):
+    '''
+    @param int tokens: tokens in the dataset
+    @param string model: base model, or a fine tune of one
+    @param int epochs: passes over the dataset
+    @returns float: estimated dollars, None for a model we have no price for
+    '''
+    base = model.split(":")[0]
+    if base not in TRAINING_PRICES:
+        return None
+    return tokens * epochs * TRAINING_PRICES[base] / 1000
+
+
+class BloomFilter:
+    '''
+    Fixed memory set membership with false positives at about errorRate once
+    capacity items are in. Used for dedup when the dataset is too big for an
+    exact set; a false positive drops a line that wasn't a duplicate.
+    @method add(data) : adds, returns whether it (probably) was there
+    '''
+
+    def __init__(self, capacity=10**7, errorRate=1e-4):
+        '''
+        @param int capacity: number of items sized for
+        @param float errorRate: false positive rate at capacity
+        '''
+        nBits = int(-capacity * math.log(errorRate) / math.log(2) ** 2)
+        self._nBits = max(8, nBits)
+        self._nHashes = max(1, round(self._nBits / capacity * math.log(2)))
+        self._bits = bytearray((self._nBits + 7) // 8)
+
+    def add(self, data):
+        '''
+        @param bytes data: the item
+        @returns bool: True if the item was (probably) added before
+        '''
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        seen = True
+        for i in range(self._nHashes):
+            bit = (h1 + i * h2) % self._nBits
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self._bits[byte] & mask:
+                seen = False
+                self._bits[byte] |= mask
+        return seen
+
+
+class ExactSet:
+    '''
+    Dedup set that keeps an 8 byte digest per item rather than the item.
+    @method add(data) : adds, returns whether it was there
+    '''
+
+    def __init__(self):
+        self._digests = set()
+
+    def add(self, data):
+        digest = hashlib.blake2b(data, digest_size=8).digest()
+        if digest in self._digests:
+            return True
+        self._digests.add(digest)
+        return False
+
+
+class DatasetReport:
+    '''
+    What preprocess found: line counts, token statistics and the first
+    errors, with their line numbers.
+    @method estimatedCost(model, epochs) : see trainingCost
+    @method toDict()
+    '''
+
+    #errors kept, the rest are only counted
+    MAX_ERRORS = 20
+
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+        self.valid = 0
+        self.invalid = 0
+        self.duplicates = 0
+        self.promptTokens = 0
+        self.completionTokens = 0
+        self.maxExampleTokens = 0
+        self.errors = []
+
+    def error(self, lineNumber, message):
+        self.invalid += 1
+        if len(self.errors) < self.MAX_ERRORS:
+            self.errors.append("line {}: {}".format(lineNumber, message))
+
+    def tokens(self):
+        return self.promptTokens + self.completionTokens
+
+    def estimatedCost(self, model, epochs=DEFAULT_EPOCHS):
+        return trainingCost(self.tokens(), model, epochs)
+
+    def summary(self, model="davinci"):
+        '''
+        @param string model: base model for the cost estimate
+        @returns string: one line for people
+        '''
+        text = "{} examples kept, {} invalid and {} duplicate lines " \
+                "dropped, {} tokens".format(self.valid, self.invalid,
+                self.duplicates, self.tokens())
+        cost = self.estimatedCost(model)
+        if cost is not None:
+            text += ", about ${:.2f} to train {} for {} epochs".format(
+                    cost, model, DEFAULT_EPOCHS)
+        return text
+
+    def toDict(self):
+        return {"lines": self.lines, "bytes": self.bytes, "valid": self.valid,
+                "invalid": self.invalid, "duplicates": self.duplicates,
+                "promptTokens": self.promptTokens,
+                "completionTokens": self.completionTokens,
+                "maxExampleTokens": self.maxExampleTokens,
+                "errors": self.errors}
+
+
+def _validate(record):
+    '''
+    @returns string: what is wrong with a parsed line, None if nothing
+    '''
+    if not isinstance(record, dict):
+        return "not a json object"
+    if set(record) != {"prompt", "completion"}:
+        return "keys must be exactly prompt and completion, got {}".format(
+                sorted(record))
+    if not isinstance(record["prompt"], str) or \
+            not isinstance(record["completion"], str):
+        return "prompt and completion must be strings"
+    if not record["completion"]:
+        return "empty completion"
+    return None
+
+
+def preprocess(lines, report, dedup="exact", countTokens=True):
+    '''
+    Generator over the clean lines of a dataset. Holds one line at a time,
+    plus the dedup set.
+    @param iterable<bytes> lines: the raw lines, e.g. an open binary file
+    @param DatasetReport report: filled in while iterating
+    @param string dedup: "exact", "bloom" or None
+    @param bool countTokens: whether to count tokens, the slowest part
+    @returns generator<bytes>: valid, unique lines, newline terminated
+    '''
+    seen = {"exact": ExactSet, "bloom": BloomFilter}[dedup]() \
+            if dedup else None
+    tokenizer = getTokenizer() if countTokens else None
+    for lineNumber, line in enumerate(lines, 1):
+        report.lines += 1
+        report.bytes += len(line)
+        line = line.strip()
+        if not line:
+            report.lines -= 1
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            report.error(lineNumber, "invalid json: {}".format(e))
+            continue
+        problem = _validate(record)
+        if problem is not None:
+            report.error(lineNumber, problem)
+            continue
+        if seen is not None and seen.add("{}\0{}".format(record["prompt"],
+                record["completion"]).encode("utf-8")):
+            report.duplicates += 1
+            continue
+        report.valid += 1
+        if tokenizer is not None:
+            promptTokens = tokenizer.countTokens(record["prompt"])
+            completionTokens = tokenizer.countTokens(record["completion"])
+            report.promptTokens += promptTokens
+            report.completionTokens += completionTokens
+            report.maxExampleTokens = max(report.maxExampleTokens,
+                    promptTokens + completionTokens)
+        yield line + b"\n"
+
+
+class ShardWriter:
+    '''
+    Writes lines to prefix-00000.jsonl, prefix-00001.jsonl, ... starting a new
+    shard every shardLines lines. With shardLines None it writes one file,
+    path, as is.
+    @method write(line)
+    @method close() : returns the paths written
+    '''
+
+    def __init__(self, path, shardLines=None):
+        self._path = path
+        self._shardLines = shardLines
+        self._file = None
+        self._linesInShard = 0
+        self.paths = []
+
+    def _open(self):
+        if self._shardLines is None:
+            path = self._path
+        else:
+            stem = self._path[:-len(".jsonl")] \
+                    if self._path.endswith(".jsonl") else self._path
+            path = "{}-{:05d}.jsonl".format(stem, len(self.paths))
+        self.paths.append(path)
+        self._file = open(path, 'wb')
+        self._linesInShard = 0
+
+    def write(self, line):
+        if self._file is None or (self._shardLines is not None and
+                self._linesInShard >= self._shardLines):
+            self.close()
+            self._open()
+        self._file.write(line)
+        self._linesInShard += 1
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return self.paths
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL dataset")
+    parser.add_argument("--output", help="where to write the clean lines")
+    parser.add_argument("--shardLines", type=int, default=None,
+            help="split the output into shards of this many lines")
+    parser.add_argument("--dedup", choices=("exact", "bloom", "none"),
+            default="exact")
+    parser.add_argument("--noTokens", action="store_true",
+            help="skip token counting, which is the slow part")
+    parser.add_argument("--model", default="davinci",
+            help="base model for the cost estimate")
+    parser.add_argument("--epochs", type=int, default=DEFAULT_EPOCHS)
+    args = parser.parse_args(argv)
+    report = DatasetReport()
+    start = time.perf_counter()
+    writer = ShardWriter(args.output, args.shardLines) if args.output else None
+    with open(args.input, 'rb') as file:
+        for line in preprocess(file, report,
+                dedup=None if args.dedup == "none" else args.dedup,
+                countTokens=not args.noTokens):
+            if writer is not None:
+                writer.write(line)
+    elapsed = time.perf_counter() - start
+    result = report.toDict()
+    result["seconds"] = elapsed
+    result["MBPerSecond"] = report.bytes / 1e6 / elapsed if elapsed else None
+    if writer is not None:
+        result["outputs"] = writer.close()
+    if not args.noTokens:
+        result["estimatedCost"] = report.estimatedCost(args.model, args.epochs)
+    print(json.dumps(result, indent=2))
+    return 0 if report.invalid == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
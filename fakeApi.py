@@ -0,0 +1,517 @@
+'''
+Stand ins for the openai api: FakeApiManager in process, FakeOpenAiServer over
+http. The server can also be run by itself, to point a separately started app
+at it:
+
+    python fakeApi.py --port 8001 --latency 0.05 --distribution lognormal
+    OPENAI_API_BASE=http://127.0.0.1:8001/v1 python asyncServer.py
+'''
+import json
+import math
+import time
+import random
+import argparse
+import threading
+from urllib.parse import unquote
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _makeFiles(n):
+    return [{"id": "file-{}".format(i), "object": "file",
+            "filename": "file-{}.json".format(i), "purpose": "fine-tune",
+            "status": "processed"} for i in range(n)]
+
+def _makeFineTunes(n):
+    return [{"id": "ft-{}".format(i), "object": "fine-tune",
+            "model": "davinci", "status": "succeeded",
+            "fine_tuned_model": "davinci:ft-{}".format(i),
+            "training_files": [{"id": "file-0"}]} for i in range(n)]
+
+def _makeEvents(fineTunes):
+    return {fineTune["id"]: [{"object": "fine-tune-event", "level": "info",
+            "message": "Fine-tune succeeded", "created_at": 0}]
+            for fineTune in fineTunes}
+
+def _makeModels(n, user):
+    return [{"id": "davinci:ft-{}".format(i), "object": "model",
+            "owned_by": user} for i in range(n)]
+
+
+class _HttpServer(ThreadingHTTPServer):
+    #room for bursts of hundreds of connections
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+class FakeApiManager:
+    '''
+    Stand in for ApiManager that never leaves the process. Every call sleeps
+    for its configured latency and can be made to fail, so the caching and
+    refresh logic can be exercised and timed without an api key.
+    @method setLatency(method, seconds)
+    @method setFailureRate(method, rate)
+    @method getCallCounts()
+    @method invalidate(*names) : like ApiManager.invalidate, does nothing
+    '''
+
+    def __init__(self, latencies=None, failureRates=None, nFiles=3,
+            nFineTunes=2, nModels=5, user="user-fake"):
+        '''
+        @param dict latencies: method name->seconds each call sleeps
+        @param dict failureRates: method name->probability a call raises
+        @param int nFiles: number of files listFiles returns
+        @param int nFineTunes: number of fine tunes listFineTunes returns
+        @param int nModels: number of models listModels returns
+        @param string user: the owned_by of the generated fine tuned models
+        '''
+        self._latencies = dict(latencies or {})
+        self._failureRates = dict(failureRates or {})
+        self._callCounts = {}
+        self._lock = threading.Lock()
+        self._files = _makeFiles(nFiles)
+        self._fineTunes = _makeFineTunes(nFineTunes)
+        self._models = _makeModels(nModels, user)
+
+    def setLatency(self, method, seconds):
+        '''
+        @param string method: the name of the ApiManager method
+        @param float seconds: how long every call to it sleeps
+        '''
+        self._latencies[method] = seconds
+
+    def setFailureRate(self, method, rate):
+        '''
+        @param string method: the name of the ApiManager method
+        @param float rate: probability in [0, 1] that a call raises
+        '''
+        self._failureRates[method] = rate
+
+    def getCallCounts(self):
+        '''
+        @returns dict: method name->number of calls so far
+        '''
+        with self._lock:
+            return dict(self._callCounts)
+
+    def _call(self, method):
+        '''
+        counts, sleeps and maybe fails, as configured for method
+        @throws RuntimeError: when the injected failure triggers
+        '''
+        with self._lock:
+            self._callCounts[method] = self._callCounts.get(method, 0) + 1
+        time.sleep(self._latencies.get(method, 0.0))
+        if random.random() < self._failureRates.get(method, 0.0):
+            raise RuntimeError("injected failure in {}".format(method))
+
+    def invalidate(self, *names):
+        #nothing is shared between calls here
+        pass
+
+    def listFiles(self):
+        self._call("listFiles")
+        return {"object": "list", "data": list(self._files)}
+
+    def listFineTunes(self):
+        self._call("listFineTunes")
+        return {"object": "list", "data": list(self._fineTunes)}
+
+    def listModels(self):
+        self._call("listModels")
+        return {"object": "list", "data": list(self._models)}
+
+
+class FakeOpenAiServer:
+    '''
+    Local http stand in for the openai api, for running ApiManager (and the
+    whole app) against. Point ApiManager at it with apiBase=server.url.
+    Requests can be throttled (429 with a Retry-After header) or failed (500)
+    at configurable rates, to exercise the retry and circuit breaker logic of
+    the transport. Latency is a number of seconds or a function drawing one,
+    for every request or by route, so benchmarks can use a realistic
+    distribution. Completions can be streamed, a token per chunk. Created
+    fine tunes succeed after trainingSeconds and add their model. Runs on a
+    daemon thread.
+    @method start() : starts serving, returns the base url
+    @method stop()
+    @method getRequestCounts() : (path, status)->count
+    '''
+
+    def __init__(self, port=0, throttleRate=0.0, retryAfter=1.0,
+            errorRate=0.0, nFiles=3, nFineTunes=2, nModels=5,
+            user="user-fake", processingSeconds=0.0, latency=0.0,
+            routeLatencies=None, completionTokens=8, tokenLatency=0.0,
+            trainingSeconds=0.0):
+        '''
+        @param int port: port to listen on, 0 picks a free one
+        @param float throttleRate: probability a request gets a 429
+        @param float retryAfter: the Retry-After sent with a 429, in seconds
+        @param float errorRate: probability a request gets a 500
+        @param int nFiles: number of files listed
+        @param int nFineTunes: number of fine tunes listed
+        @param int nModels: number of models listed
+        @param string user: the owned_by of the listed models
+        @param float processingSeconds: how long an uploaded file stays in
+          the uploaded status before it is processed
+        @param latency: seconds every request takes, a float or a function
+          returning one for each request, e.g. lambda: random.expovariate(20)
+        @param dict routeLatencies: path prefix, e.g. "/completions"->latency
+          for the requests below it, instead of latency
+        @param int completionTokens: length of every completion, in tokens
+        @param float tokenLatency: seconds between the tokens of a stream
+        @param float trainingSeconds: how long a created fine tune runs
+        '''
+        self.throttleRate = throttleRate
+        self.processingSeconds = processingSeconds
+        self.latency = latency
+        self.routeLatencies = dict(routeLatencies or {})
+        self.completionTokens = completionTokens
+        self.tokenLatency = tokenLatency
+        self.trainingSeconds = trainingSeconds
+        self._nextId = 0
+        self.retryAfter = retryAfter
+        self.errorRate = errorRate
+        self.files = _makeFiles(nFiles)
+        self.fineTunes = _makeFineTunes(nFineTunes)
+        self.fineTuneEvents = _makeEvents(self.fineTunes)
+        self.models = _makeModels(nModels, user)
+        self.user = user
+        self._requestCounts = {}
+        self._lock = threading.Lock()
+        self._server = _HttpServer(("127.0.0.1", port),
+                _makeRequestHandler(self))
+        self._thread = None
+        self.url = "http://127.0.0.1:{}/v1".format(
+                self._server.server_address[1])
+
+    def start(self):
+        '''
+        @returns string: the base url to give ApiManager
+        '''
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def getRequestCounts(self):
+        '''
+        @returns dict: (path, status)->number of requests
+        '''
+        with self._lock:
+            return dict(self._requestCounts)
+
+    def count(self, path, status):
+        with self._lock:
+            key = (path, status)
+            self._requestCounts[key] = self._requestCounts.get(key, 0) + 1
+
+    def latencyFor(self, path):
+        '''
+        @param string path: the path below /v1
+        @returns float: seconds to hold this request
+        '''
+        latency = self.latency
+        for prefix, routeLatency in self.routeLatencies.items():
+            if path.startswith(prefix):
+                latency = routeLatency
+                break
+        return latency() if callable(latency) else latency
+
+    def completionText(self):
+        return " fake" * self.completionTokens
+
+    def _processFineTunes(self):
+        #created fine tunes succeed after trainingSeconds. Holds the lock
+        now = time.time()
+        for fineTune in self.fineTunes:
+            if fineTune["status"] == "pending" and \
+                    now - fineTune["created_at"] >= self.trainingSeconds:
+                fineTune["status"] = "succeeded"
+                fineTune["fine_tuned_model"] = "{}:{}".format(
+                        fineTune["model"], fineTune["id"])
+                self.models.append({"id": fineTune["fine_tuned_model"],
+                        "object": "model", "owned_by": self.user})
+                self.fineTuneEvents[fineTune["id"]].append({
+                        "object": "fine-tune-event", "level": "info",
+                        "message": "Fine-tune succeeded", "created_at": now})
+
+    def _processFiles(self):
+        #uploaded files turn processed after processingSeconds. Holds the lock
+        now = time.time()
+        for fileDatum in self.files:
+            if fileDatum["status"] == "uploaded" and \
+                    now - fileDatum["created_at"] >= self.processingSeconds:
+                fileDatum["status"] = "processed"
+
+    def route(self, method, path, body):
+        '''
+        answers one api request
+        @param string method: GET, POST or DELETE
+        @param string path: the path below /v1
+        @param dict body: the json body of a POST, for a multipart upload
+          just its size in bytes, else {}
+        @returns tuple: status, dict body
+        '''
+        if method == "GET" and path == "/models":
+            with self._lock:
+                self._processFineTunes()
+                return 200, {"object": "list", "data": list(self.models)}
+        if method == "DELETE" and path.startswith("/models/"):
+            modelId = path[len("/models/"):]
+            with self._lock:
+                for i, model in enumerate(self.models):
+                    if model["id"] == modelId:
+                        del self.models[i]
+                        return 200, {"id": modelId, "object": "model",
+                                "deleted": True}
+            return 404, {"error": {"message": "no such model " + modelId,
+                    "type": "invalid_request_error"}}
+        if method == "GET" and path == "/files":
+            with self._lock:
+                self._processFiles()
+                return 200, {"object": "list", "data": list(self.files)}
+        if method == "POST" and path == "/files":
+            with self._lock:
+                fileDatum = {"id": "file-up{}".format(self._nextId),
+                        "object": "file", "filename": "upload.jsonl",
+                        "purpose": "fine-tune", "status": "uploaded",
+                        "bytes": body.get("bytes", 0),
+                        "created_at": time.time()}
+                self._nextId += 1
+                self.files.append(fileDatum)
+                return 200, dict(fileDatum)
+        if path.startswith("/files/") and method in ("GET", "DELETE"):
+            fileId = path[len("/files/"):]
+            with self._lock:
+                self._processFiles()
+                for i, fileDatum in enumerate(self.files):
+                    if fileDatum["id"] == fileId:
+                        if method == "GET":
+                            return 200, dict(fileDatum)
+                        del self.files[i]
+                        return 200, {"id": fileId, "object": "file",
+                                "deleted": True}
+            return 404, {"error": {"message": "no such file " + fileId,
+                    "type": "invalid_request_error"}}
+        if method == "GET" and path == "/fine-tunes":
+            with self._lock:
+                self._processFineTunes()
+                return 200, {"object": "list", "data": [dict(fineTune)
+                        for fineTune in self.fineTunes]}
+        if method == "POST" and path == "/fine-tunes":
+            with self._lock:
+                fineTune = {"id": "ft-new{}".format(self._nextId),
+                        "object": "fine-tune",
+                        "model": body.get("model") or "curie",
+                        "status": "pending", "fine_tuned_model": None,
+                        "training_files": [{"id": body.get("training_file")}],
+                        "created_at": time.time()}
+                self._nextId += 1
+                self.fineTunes.append(fineTune)
+                self.fineTuneEvents[fineTune["id"]] = [{
+                        "object": "fine-tune-event", "level": "info",
+                        "message": "Created fine-tune",
+                        "created_at": fineTune["created_at"]}]
+                return 200, dict(fineTune)
+        if method == "GET" and path.startswith("/fine-tunes/"):
+            fineTuneId = path[len("/fine-tunes/"):]
+            events = fineTuneId.endswith("/events")
+            if events:
+                fineTuneId = fineTuneId[:-len("/events")]
+            with self._lock:
+                self._processFineTunes()
+                for fineTune in self.fineTunes:
+                    if fineTune["id"] == fineTuneId:
+                        if events:
+                            return 200, {"object": "list", "data": list(
+                                    self.fineTuneEvents.get(fineTuneId, []))}
+                        return 200, dict(fineTune)
+            return 404, {"error": {"message": "no such fine tune " +
+                    fineTuneId, "type": "invalid_request_error"}}
+        if method == "POST" and path == "/completions":
+            prompts = body.get("prompt", "")
+            if isinstance(prompts, str):
+                prompts = [prompts]
+            choices = [{"text": self.completionText(), "index": i,
+                    "finish_reason": "stop"} for i in range(len(prompts))]
+            promptTokens = sum(len(prompt) // 4 for prompt in prompts)
+            completionTokens = self.completionTokens * len(prompts)
+            return 200, {"id": "cmpl-fake", "object": "text_completion",
+                    "model": body.get("model"), "choices": choices,
+                    "usage": {"prompt_tokens": promptTokens,
+                        "completion_tokens": completionTokens,
+                        "total_tokens": promptTokens + completionTokens}}
+        return 404, {"error": {"message": "no route {} {}".format(
+                method, path), "type": "invalid_request_error"}}
+
+
+def _makeRequestHandler(fake):
+    '''
+    @param FakeOpenAiServer fake: the server the handler answers for
+    @returns class: a BaseHTTPRequestHandler bound to fake
+    '''
+
+    class RequestHandler(BaseHTTPRequestHandler):
+        #keep-alive, so clients can reuse connections
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _stream(self, body):
+            '''
+            answers a completion with stream set, as Server-Sent-Events in
+            http chunks, one token each
+            '''
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for i in range(fake.completionTokens):
+                if i and fake.tokenLatency:
+                    time.sleep(fake.tokenLatency)
+                chunk = {"id": "cmpl-fake", "object": "text_completion",
+                        "model": body.get("model"), "choices": [{
+                        "text": " fake", "index": 0, "finish_reason": None}]}
+                self._writeChunk("data: {}\n\n".format(json.dumps(chunk)))
+            self._writeChunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def _writeChunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+            self.wfile.flush()
+
+        def _handle(self, method):
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            path = unquote(self.path.split("?")[0])
+            if path.startswith("/v1"):
+                path = path[len("/v1"):]
+            latency = fake.latencyFor(path)
+            if latency:
+                time.sleep(latency)
+            if random.random() < fake.throttleRate:
+                fake.count(path, 429)
+                return self._send(429, {"error": {"message": "throttled",
+                        "type": "requests"}},
+                        {"Retry-After": str(fake.retryAfter)})
+            if random.random() < fake.errorRate:
+                fake.count(path, 500)
+                return self._send(500, {"error": {"message": "injected",
+                        "type": "server_error"}})
+            body = {}
+            contentType = self.headers.get("Content-Type") or ""
+            if raw and "json" in contentType:
+                body = json.loads(raw)
+            elif raw and "multipart" in contentType:
+                body = {"bytes": len(raw)}
+            if method == "POST" and path == "/completions" and \
+                    body.get("stream"):
+                fake.count(path, 200)
+                return self._stream(body)
+            status, response = fake.route(method, path, body)
+            fake.count(path, status)
+            self._send(status, response)
+
+        def do_GET(self):
+            self._handle("GET")
+
+        def do_POST(self):
+            self._handle("POST")
+
+        def do_DELETE(self):
+            self._handle("DELETE")
+
+    return RequestHandler
+
+
+def makeLatency(mean, distribution="fixed"):
+    '''
+    @param float mean: mean seconds
+    @param string distribution: "fixed", "exponential" or "lognormal", the
+      latter with a long tail like real api latencies
+    @returns: a latency for FakeOpenAiServer, seconds or a function
+    '''
+    if not mean or distribution == "fixed":
+        return mean
+    if distribution == "exponential":
+        return lambda: random.expovariate(1.0 / mean)
+    assert(distribution == "lognormal"), \
+            "unknown distribution " + distribution
+    sigma = 0.75
+    mu = math.log(mean) - sigma ** 2 / 2
+    return lambda: random.lognormvariate(mu, sigma)
+
+
+def addServerArguments(parser):
+    '''
+    adds the options of a FakeOpenAiServer to an argparse parser
+    '''
+    group = parser.add_argument_group("fake api")
+    group.add_argument("--latency", type=float, default=0.05,
+            help="mean seconds every api request takes")
+    group.add_argument("--completionLatency", type=float, default=None,
+            help="mean seconds of a completion, defaults to --latency")
+    group.add_argument("--distribution", default="lognormal",
+            choices=("fixed", "exponential", "lognormal"))
+    group.add_argument("--errorRate", type=float, default=0.0)
+    group.add_argument("--throttleRate", type=float, default=0.0)
+    group.add_argument("--files", type=int, default=20)
+    group.add_argument("--fineTunes", type=int, default=10)
+    group.add_argument("--models", type=int, default=10)
+    group.add_argument("--completionTokens", type=int, default=64)
+    group.add_argument("--tokenLatency", type=float, default=0.0,
+            help="seconds between the tokens of a streamed completion")
+
+
+def serverFromArguments(args, port=0):
+    '''
+    @param argparse.Namespace args: parsed with addServerArguments
+    @returns FakeOpenAiServer: not started
+    '''
+    routeLatencies = {}
+    if args.completionLatency is not None:
+        routeLatencies["/completions"] = makeLatency(args.completionLatency,
+                args.distribution)
+    return FakeOpenAiServer(port=port, throttleRate=args.throttleRate,
+            errorRate=args.errorRate, nFiles=args.files,
+            nFineTunes=args.fineTunes, nModels=args.models,
+            latency=makeLatency(args.latency, args.distribution),
+            routeLatencies=routeLatencies,
+            completionTokens=args.completionTokens,
+            tokenLatency=args.tokenLatency)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,
+            formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8001)
+    addServerArguments(parser)
+    args = parser.parse_args(argv)
+    server = serverFromArguments(args, args.port)
+    print("serving the fake api at {}".format(server.url))
+    server.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
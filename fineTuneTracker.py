@@ -0,0 +1,229 @@
+import time
+import threading
+
+import scheduler
+
+#statuses after which a fine tune never changes again
+TERMINAL_STATUSES = ("succeeded", "failed", "cancelled")
+
+
+class FineTuneTracker:
+    '''
+    Keeps a table of fine tune jobs up to date on a background thread, so
+    handlers read it without waiting on the api. One full list seeds the
+    table, and is repeated every resyncSeconds to pick up jobs created
+    elsewhere. Between those only the jobs that haven't finished are polled.
+    A poll asks for the job's events and looks only at the ones it hasn't
+    seen; the job itself is fetched again only when a new event shows up. A
+    poll that finds nothing new doubles that job's interval, up to
+    maxInterval, and any new event brings it back to minInterval.
+    @method start() : starts the polling thread
+    @method stop()
+    @method sync() : full list of the fine tunes, blocking
+    @method track(job) : adds a job we just created
+    @method getFineTunes() : the job table, oldest first
+    @method getEvents(jobId) : the events seen of a job
+    @method getVersion() : a number that changes whenever the table does
+    @method addListener(callback) : calls callback(job) when a job changes
+    '''
+
+    def __init__(self, apiManager, minInterval=5.0, maxInterval=120.0,
+            resyncSeconds=600.0):
+        '''
+        @param ApiManager apiManager: interface to the api
+        @param float minInterval: seconds between polls of an active job
+        @param float maxInterval: the longest a job waits between polls
+        @param float resyncSeconds: seconds between full lists
+        '''
+        self._apiManager = apiManager
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._resyncSeconds = resyncSeconds
+        #jobId->job, in the order the api lists them
+        self._jobs = {}
+        #jobId->events seen so far
+        self._events = {}
+        #jobId->[next poll, interval] of jobs that haven't finished
+        self._schedule = {}
+        self._lastSync = None
+        self._version = 0
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                name="FineTuneTracker")
+        self._thread.start()
+
+    def stop(self):
+        self._stopping = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def addListener(self, callback):
+        '''
+        @param callback: called with the job whenever a job we already knew
+          changes status, or a job is tracked. Runs on the polling thread
+        '''
+        self._listeners.append(callback)
+
+    def sync(self):
+        '''
+        lists every fine tune and merges them into the table. Jobs the api no
+        longer lists are dropped.
+        @returns dict: the list response
+        '''
+        resp = self._apiManager.listFineTunes()
+        listed = set()
+        changed = []
+        with self._lock:
+            for job in resp["data"]:
+                listed.add(job["id"])
+                if self._store(job):
+                    changed.append(job)
+            for jobId in [jobId for jobId in self._jobs
+                    if jobId not in listed]:
+                self._forget(jobId)
+            self._lastSync = time.monotonic()
+        self._notify(changed)
+        return resp
+
+    def track(self, job):
+        '''
+        adds a job that was just created, and polls it soon
+        @param dict job: the api response of the create call
+        '''
+        with self._lock:
+            self._store(job)
+        self._notify([job])
+        self._wake.set()
+
+    def getFineTunes(self):
+        '''
+        @returns list<dict>: every job, as the api describes it. Syncs first
+          if the table was never filled
+        '''
+        with self._lock:
+            synced = self._lastSync is not None
+        if not synced:
+            self.sync()
+        with self._lock:
+            return list(self._jobs.values())
+
+    def getVersion(self):
+        with self._lock:
+            return self._version
+
+    def getEvents(self, jobId):
+        '''
+        @param string jobId: the fine tune
+        @returns list<dict>: its events seen so far, oldest first
+        '''
+        with self._lock:
+            return list(self._events.get(jobId, []))
+
+    def _store(self, job):
+        '''
+        puts job in the table and (un)schedules it by its status. Holds the
+        lock.
+        @returns bool: whether the job was known and changed status
+        '''
+        jobId = job["id"]
+        old = self._jobs.get(jobId)
+        if old != job:
+            self._version += 1
+        self._jobs[jobId] = job
+        if job["status"] in TERMINAL_STATUSES:
+            self._schedule.pop(jobId, None)
+        elif jobId not in self._schedule:
+            self._schedule[jobId] = [time.monotonic(), self._minInterval]
+        return old is not None and old["status"] != job["status"]
+
+    def _forget(self, jobId):
+        #Holds the lock
+        self._version += 1
+        self._jobs.pop(jobId, None)
+        self._events.pop(jobId, None)
+        self._schedule.pop(jobId, None)
+
+    def _notify(self, jobs):
+        for job in jobs:
+            for callback in self._listeners:
+                try:
+                    callback(job)
+                except Exception as e:
+                    print("fine tune listener failed: {}".format(e))
+
+    def _poll(self, jobId):
+        '''
+        checks one job for new events, fetching the job again if there are
+        any, and reschedules it
+        '''
+        try:
+            events = self._apiManager.listFineTuneEvents(jobId)["data"]
+            with self._lock:
+                seen = len(self._events.get(jobId, []))
+            newEvents = events[seen:]
+            job = self._apiManager.getFineTune(jobId) if newEvents else None
+        except Exception as e:
+            print("polling fine tune {} failed: {}".format(jobId, e))
+            newEvents, job = [], None
+        changed = False
+        with self._lock:
+            if jobId not in self._jobs:
+                return
+            self._events.setdefault(jobId, []).extend(newEvents)
+            if job is not None:
+                changed = self._store(job)
+            entry = self._schedule.get(jobId)
+            if entry is not None:
+                entry[1] = self._minInterval if newEvents else \
+                        min(entry[1] * 2, self._maxInterval)
+                entry[0] = time.monotonic() + entry[1]
+        if changed:
+            self._notify([job])
+
+    def _run(self):
+        '''
+        body of the polling thread, whose calls wait behind everybody else's
+        '''
+        with scheduler.priority(scheduler.BACKGROUND):
+            self._loop()
+
+    def _loop(self):
+        retrySyncAt = None
+        while not self._stopping:
+            with self._lock:
+                lastSync = self._lastSync
+            now = time.monotonic()
+            if (lastSync is None or now - lastSync >= self._resyncSeconds) \
+                    and (retrySyncAt is None or now >= retrySyncAt):
+                try:
+                    self.sync()
+                    retrySyncAt = None
+                except Exception as e:
+                    print("syncing fine tunes failed: {}".format(e))
+                    retrySyncAt = now + self._minInterval
+            now = time.monotonic()
+            with self._lock:
+                due = [jobId for jobId, (at, _) in self._schedule.items()
+                        if at <= now]
+            for jobId in due:
+                self._poll(jobId)
+            with self._lock:
+                if retrySyncAt is not None:
+                    wakeAt = retrySyncAt
+                else:
+                    wakeAt = self._lastSync + self._resyncSeconds
+                for at, _ in self._schedule.values():
+                    wakeAt = min(wakeAt, at)
+            self._wake.wait(max(0.0, wakeAt - time.monotonic()))
+            self._wake.clear()
@@ -0,0 +1,418 @@
+'''
+Counters, gauges and latency histograms for the hot paths of the app, served
+in the Prometheus text format from /metrics, and a sampling profiler for
+slow requests.
+
+Instruments are made once, at import time of the module they measure, on the
+shared REGISTRY:
+
+    API_SECONDS = metrics.histogram("ai9_api_seconds",
+            "time in ApiManager calls", ["method"])
+    with API_SECONDS.time(method="listFiles"):
+        ...
+'''
+import sys
+import time
+import inspect
+import functools
+import threading
+from collections import deque, Counter as _Tally
+
+#upper bounds of the latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+        5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n")\
+            .replace('"', '\\"')
+
+
+def _formatLabels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value))
+            for name, value in pairs) + "}"
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    '''
+    A named metric with a value per combination of label values. Safe to use
+    from several threads.
+    '''
+    TYPE = None
+
+    def __init__(self, name, description, labelNames=()):
+        '''
+        @param string name: the metric's name, e.g. ai9_requests_total
+        @param string description: the help line
+        @param list<string> labelNames: the labels every value has
+        '''
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(labelNames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        assert(set(labels) == set(self.labelNames)), \
+                "{} takes labels {}, got {}".format(self.name,
+                self.labelNames, sorted(labels))
+        return tuple(labels[name] for name in self.labelNames)
+
+    def render(self):
+        '''
+        @returns list<string>: the metric's lines of the text format
+        '''
+        lines = ["# HELP {} {}".format(self.name, self.description),
+                "# TYPE {} {}".format(self.name, self.TYPE)]
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item:
+                    tuple(str(value) for value in item[0]))
+            for key, value in values:
+                lines.extend(self._renderValue(key, value))
+        return lines
+
+    def _renderValue(self, key, value):
+        return ["{}{} {}".format(self.name,
+                _formatLabels(self.labelNames, key), _formatValue(value))]
+
+
+class Counter(_Metric):
+    '''
+    A count that only goes up.
+    @method inc(amount=1, **labels)
+    @method set(value, **labels) : for counts kept elsewhere, from a collector
+    '''
+    TYPE = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Gauge(Counter):
+    '''
+    A value that goes up and down, like requests in flight.
+    @method inc(amount=1, **labels)
+    @method dec(amount=1, **labels)
+    @method set(value, **labels)
+    @method track(**labels) : context manager that is +1 while inside
+    '''
+    TYPE = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def track(self, **labels):
+        return _Tracked(self, labels)
+
+
+class _Tracked:
+
+    def __init__(self, gauge, labels):
+        self._gauge = gauge
+        self._labels = labels
+
+    def __enter__(self):
+        self._gauge.inc(**self._labels)
+
+    def __exit__(self, excType, exc, traceback):
+        self._gauge.dec(**self._labels)
+        return False
+
+
+class Histogram(_Metric):
+    '''
+    Counts of observations by bucket, with their sum, for latencies.
+    @method observe(value, **labels)
+    @method time(**labels) : context manager that observes its duration
+    '''
+    TYPE = "histogram"
+
+    def __init__(self, name, description, labelNames=(),
+            buckets=DEFAULT_BUCKETS):
+        '''
+        @param list<float> buckets: upper bounds of the buckets, ascending
+        '''
+        super().__init__(name, description, labelNames)
+        self._buckets = tuple(buckets) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                #[count per bucket, sum]
+                entry = self._values[key] = [[0] * len(self._buckets), 0.0]
+            for i, bound in enumerate(self._buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def _renderValue(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self._buckets, counts):
+            cumulative += count
+            lines.append("{}_bucket{} {}".format(self.name,
+                    _formatLabels(self.labelNames, key,
+                    [("le", _formatValue(bound))]), cumulative))
+        labels = _formatLabels(self.labelNames, key)
+        lines.append("{}_sum{} {}".format(self.name, labels, repr(total)))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class _Timer:
+
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        self._histogram.observe(time.perf_counter() - self._start,
+                **self._labels)
+        return False
+
+
+class MetricsRegistry:
+    '''
+    The metrics of the process, rendered together.
+    @method counter(name, description, labelNames)
+    @method gauge(name, description, labelNames)
+    @method histogram(name, description, labelNames, buckets)
+    @method addCollector(callback) : called before every render
+    @method render() : every metric, in the Prometheus text format
+    '''
+
+    def __init__(self):
+        #name->metric, in the order they were made
+        self._metrics = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _make(self, cls, name, *args, **kwargs):
+        #a module imported twice gets the metric it made the first time
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            assert(type(metric) is cls), \
+                    "{} is already a {}".format(name, metric.TYPE)
+            return metric
+
+    def counter(self, name, description, labelNames=()):
+        return self._make(Counter, name, description, labelNames)
+
+    def gauge(self, name, description, labelNames=()):
+        return self._make(Gauge, name, description, labelNames)
+
+    def histogram(self, name, description, labelNames=(),
+            buckets=DEFAULT_BUCKETS):
+        return self._make(Histogram, name, description, labelNames, buckets)
+
+    def addCollector(self, callback):
+        '''
+        @param callback: called with no arguments before every render, to
+          copy values kept elsewhere (like a cache's hit counts) into metrics
+        '''
+        self._collectors.append(callback)
+
+    def render(self):
+        '''
+        @returns string: the text format, for a scrape
+        '''
+        for callback in list(self._collectors):
+            try:
+                callback()
+            except Exception as e:
+                print("metrics collector failed: {}".format(e))
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+#what /metrics answers with
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def timed(histogram, **labels):
+    '''
+    decorator that observes how long every call of the function takes. Works
+    on functions, coroutines and (async) generators, whose time runs until
+    they are exhausted or closed.
+    @param Histogram histogram: where to observe
+    @param labels: the label values of the observations
+    '''
+    def decorator(function):
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                generator = function(*args, **kwargs)
+                with histogram.time(**labels):
+                    try:
+                        async for item in generator:
+                            yield item
+                    finally:
+                        await generator.aclose()
+        elif inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await function(*args, **kwargs)
+        elif inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return (yield from function(*args, **kwargs))
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+SLOW_REQUESTS = counter("ai9_slow_requests_total",
+        "requests that took longer than the profiling threshold", ["endpoint"])
+
+
+class SlowRequestSampler:
+    '''
+    Sampling profiler for slow requests. While a request is running, a
+    background thread looks at the stack of the thread serving it every
+    interval seconds, once the request is older than thresholdSeconds, and
+    counts the stacks it sees. Requests that end up slower than the threshold
+    are kept as reports with their most common stacks. Requests faster than
+    the threshold cost two dict operations. On the async server every
+    request shares the event loop thread, so a sample shows whatever the
+    loop is running, which may be another request.
+    @method begin(name) : a request starts on this thread, returns a token
+    @method end(token) : that request is done
+    @method getReports() : the slow requests kept, newest last
+    '''
+
+    def __init__(self, thresholdSeconds=1.0, interval=0.01, maxReports=50,
+            maxStacks=10, maxDepth=40):
+        '''
+        @param float thresholdSeconds: requests slower than this are sampled
+        @param float interval: seconds between samples
+        @param int maxReports: the most reports kept
+        @param int maxStacks: stacks kept per report, the most common ones
+        @param int maxDepth: frames kept per stack, innermost ones
+        '''
+        self._threshold = thresholdSeconds
+        self._interval = interval
+        self._maxStacks = maxStacks
+        self._maxDepth = maxDepth
+        #token->[name, thread id, start, stack counts]
+        self._active = {}
+        self._reports = deque(maxlen=maxReports)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._nextToken = 0
+
+    def begin(self, name):
+        '''
+        @param string name: what the request is, e.g. its endpoint
+        @returns int: token for end
+        '''
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True,
+                        name="SlowRequestSampler")
+                self._thread.start()
+            self._nextToken += 1
+            token = self._nextToken
+            self._active[token] = [name, threading.get_ident(),
+                    time.perf_counter(), _Tally()]
+        return token
+
+    def end(self, token):
+        '''
+        @param int token: from begin
+        @returns dict: the report, if the request was slow, else None
+        '''
+        with self._lock:
+            name, _, start, stacks = self._active.pop(token)
+        seconds = time.perf_counter() - start
+        if seconds < self._threshold:
+            return None
+        report = {"name": name, "seconds": seconds,
+                "samples": sum(stacks.values()),
+                "stacks": stacks.most_common(self._maxStacks)}
+        with self._lock:
+            self._reports.append(report)
+        #the report is served from /metrics/slow, the request isn't held up
+        #writing it out
+        SLOW_REQUESTS.inc(endpoint=name)
+        return report
+
+    def getReports(self):
+        with self._lock:
+            return list(self._reports)
+
+    def _stack(self, frame):
+        '''
+        @returns string: the stack, outermost first, in the folded format
+          flame graph tools read
+        '''
+        parts = []
+        while frame is not None and len(parts) < self._maxDepth:
+            code = frame.f_code
+            parts.append("{}:{}:{}".format(code.co_filename.rsplit("/", 1)[-1],
+                    code.co_name, frame.f_lineno))
+            frame = frame.f_back
+        parts.reverse()
+        return ";".join(parts)
+
+    def _run(self):
+        '''
+        body of the sampling thread
+        '''
+        while True:
+            time.sleep(self._interval)
+            now = time.perf_counter()
+            with self._lock:
+                due = [entry for entry in self._active.values()
+                        if now - entry[2] >= self._threshold]
+            if not due:
+                continue
+            frames = sys._current_frames()
+            for entry in due:
+                frame = frames.get(entry[1])
+                if frame is not None:
+                    stack = self._stack(frame)
+                    with self._lock:
+                        entry[3][stack] += 1
@@ -1,55 +1,368 @@
+import time
+
 import openai
 
+import metrics
+from singleFlight import SingleFlight
+from tokenizer import getTokenizer
+from transport import Transport
+
+#context window, prompt plus completion, of the models we offer. Base models
+#and their fine tunes have 2049
+MODEL_CONTEXT_SIZES = {
+        "text-davinci-003": 4097,
+        "text-davinci-002": 4097,
+        }
+DEFAULT_CONTEXT_SIZE = 2049
+
+#statuses of a file the api hasn't finished processing
+PENDING_FILE_STATUSES = ("uploaded", "pending")
+
+API_SECONDS = metrics.histogram("ai9_api_seconds",
+        "time in ApiManager calls, retries and cache hits included", ["method"])
+TOKENS = metrics.counter("ai9_tokens_total",
+        "tokens completions used, from their usage", ["model", "kind"])
+
+def getContextSize(model):
+    return MODEL_CONTEXT_SIZES.get(model, DEFAULT_CONTEXT_SIZE)
+
+def countUsage(model, response):
+    #adds the usage of a completion response to TOKENS. Streamed responses
+    #have none
+    usage = response.get("usage") or {}
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            TOKENS.inc(usage[kind], model=model, kind=kind[:-len("_tokens")])
+
 class ApiManager:
-    def __init__(self, apiKey):
+    def __init__(self, apiKey, completionCache=None, transport=None,
+            apiBase=None):
+        #completionCache is an optional CompletionCache, used for prompts at
+        #temperature 0, whose completions are deterministic.
+        #every sdk call goes through transport (pooling, timeouts, retries).
+        #apiBase points the sdk elsewhere, e.g. at fakeApi.FakeOpenAiServer.
+        #Identical reads, and identical prompts at temperature 0, that are in
+        #flight at the same time share one request
         openai.api_key = apiKey 
+        if apiBase is not None:
+            openai.api_base = apiBase
+        self._completionCache = completionCache
+        self._transport = transport if transport is not None else Transport()
+        self._flight = SingleFlight("api")
+        #read name->generation, bumped when what the read returns changes,
+        #so later reads don't join one that started before
+        self._generations = {}
 
+    @metrics.timed(API_SECONDS, method="prompt")
     def prompt(self, prompt, model="text-davinci-003", 
             temperature=0.0, nTokens=None):
-        if nTokens == None:
-            completionTokens = 32
-        else:
-            #openai doesn't seem to have a way to progamatically count tokens!
-            #they use this heuristic. 4.0 recommended. 4.25 for extra security
-            estimatedPromptTokens = int(len(prompt) / 3.75)
-            #4000 hardcoded as buffer
-            completionTokens = min(nTokens,4000) - estimatedPromptTokens
-        response = openai.Completion.create(
+        promptTokens = getTokenizer().countTokens(prompt)
+        maxTokens = self._completionTokens(prompt, model, nTokens, promptTokens)
+        cacheKey = self._cacheKey(prompt, model, temperature, maxTokens)
+        if cacheKey is not None:
+            response = self._completionCache.get(cacheKey)
+            if response is not None:
+                return response
+        def fetch():
+            response = self._transport.call(openai.Completion.create,
+                    idempotent=False,
+                    model=model,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=maxTokens,
+                    tokens=promptTokens + maxTokens
+                    )
+            countUsage(model, response)
+            if cacheKey is not None:
+                self._completionCache.put(cacheKey, model, response)
+            return response
+        flightKey = self._flightKey(prompt, model, temperature, maxTokens)
+        if flightKey is None:
+            return fetch()
+        return self._flight.do(flightKey, fetch)
+
+    @metrics.timed(API_SECONDS, method="promptStream")
+    def promptStream(self, prompt, model="text-davinci-003",
+            temperature=0.0, nTokens=None):
+        #generator of the completion text, piece by piece as the api sends it
+        promptTokens = getTokenizer().countTokens(prompt)
+        maxTokens = self._completionTokens(prompt, model, nTokens, promptTokens)
+        cacheKey = self._cacheKey(prompt, model, temperature, maxTokens)
+        if cacheKey is not None:
+            response = self._completionCache.get(cacheKey)
+            if response is not None:
+                yield response["choices"][0]["text"]
+                return
+        #retries cover getting the stream started, not breaks halfway
+        response = self._transport.call(openai.Completion.create,
+                idempotent=False,
                 model=model,
                 prompt=prompt,
                 temperature=temperature,
-                max_tokens=completionTokens
+                max_tokens=maxTokens,
+                stream=True,
+                tokens=promptTokens + maxTokens
                 )
-        return response
+        pieces = []
+        for chunk in response:
+            text = chunk["choices"][0]["text"]
+            if text:
+                pieces.append(text)
+                yield text
+        if cacheKey is not None:
+            self._completionCache.put(cacheKey, model,
+                    {"choices": [{"text": "".join(pieces), "index": 0}]})
+
+    @metrics.timed(API_SECONDS, method="aprompt")
+    async def aprompt(self, prompt, model="text-davinci-003",
+            temperature=0.0, nTokens=None):
+        #async version of prompt, for the event loop of the async server
+        promptTokens = getTokenizer().countTokens(prompt)
+        maxTokens = self._completionTokens(prompt, model, nTokens, promptTokens)
+        cacheKey = self._cacheKey(prompt, model, temperature, maxTokens)
+        if cacheKey is not None:
+            response = self._completionCache.get(cacheKey)
+            if response is not None:
+                return response
+        async def fetch():
+            response = await self._transport.acall(openai.Completion.acreate,
+                    idempotent=False,
+                    model=model,
+                    prompt=prompt,
+                    temperature=temperature,
+                    max_tokens=maxTokens,
+                    tokens=promptTokens + maxTokens
+                    )
+            countUsage(model, response)
+            if cacheKey is not None:
+                self._completionCache.put(cacheKey, model, response)
+            return response
+        flightKey = self._flightKey(prompt, model, temperature, maxTokens)
+        if flightKey is None:
+            return await fetch()
+        return await self._flight.ado(flightKey, fetch)
+
+    @metrics.timed(API_SECONDS, method="apromptStream")
+    async def apromptStream(self, prompt, model="text-davinci-003",
+            temperature=0.0, nTokens=None):
+        #async version of promptStream
+        promptTokens = getTokenizer().countTokens(prompt)
+        maxTokens = self._completionTokens(prompt, model, nTokens, promptTokens)
+        cacheKey = self._cacheKey(prompt, model, temperature, maxTokens)
+        if cacheKey is not None:
+            response = self._completionCache.get(cacheKey)
+            if response is not None:
+                yield response["choices"][0]["text"]
+                return
+        response = await self._transport.acall(openai.Completion.acreate,
+                idempotent=False,
+                model=model,
+                prompt=prompt,
+                temperature=temperature,
+                max_tokens=maxTokens,
+                stream=True,
+                tokens=promptTokens + maxTokens
+                )
+        pieces = []
+        async for chunk in response:
+            text = chunk["choices"][0]["text"]
+            if text:
+                pieces.append(text)
+                yield text
+        if cacheKey is not None:
+            self._completionCache.put(cacheKey, model,
+                    {"choices": [{"text": "".join(pieces), "index": 0}]})
+
+    @metrics.timed(API_SECONDS, method="promptBatch")
+    def promptBatch(self, prompts, model="text-davinci-003",
+            temperature=0.0, nTokens=None, maxPrompts=20,
+            maxRequestTokens=16000):
+        #completes a list of prompts with as few requests as possible. Prompts
+        #are packed in order, up to maxPrompts per request and up to
+        #maxRequestTokens of prompts plus completion budget per request. The
+        #prompts of a request share one max_tokens, the smallest any of them
+        #allows. Returns the completion texts in prompt order and the summed
+        #usage
+        completions = []
+        usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        for chunk, maxTokens, promptTokens in self._packBatch(prompts, model,
+                nTokens, maxPrompts, maxRequestTokens):
+            response = self._transport.call(openai.Completion.create,
+                    idempotent=False,
+                    model=model,
+                    prompt=chunk,
+                    temperature=temperature,
+                    max_tokens=maxTokens,
+                    tokens=promptTokens + len(chunk) * maxTokens
+                    )
+            texts = [None] * len(chunk)
+            for choice in response["choices"]:
+                texts[choice["index"]] = choice["text"]
+            completions.extend(texts)
+            countUsage(model, response)
+            responseUsage = response.get("usage") or {}
+            for key in usage:
+                usage[key] += responseUsage.get(key, 0)
+        return completions, usage
+
+    def _packBatch(self, prompts, model, nTokens, maxPrompts,
+            maxRequestTokens):
+        #generator of (list of prompts, max_tokens, prompt tokens) for each
+        #request
+        chunk = []
+        chunkPromptTokens = 0
+        chunkMaxTokens = None
+        for prompt in prompts:
+            promptTokens = getTokenizer().countTokens(prompt)
+            allowed = self._completionTokens(prompt, model, nTokens,
+                    promptTokens)
+            maxTokens = allowed if chunkMaxTokens is None else \
+                    min(chunkMaxTokens, allowed)
+            cost = chunkPromptTokens + promptTokens + \
+                    (len(chunk) + 1) * maxTokens
+            if chunk and (len(chunk) >= maxPrompts or cost > maxRequestTokens):
+                yield chunk, chunkMaxTokens, chunkPromptTokens
+                chunk = []
+                chunkPromptTokens = 0
+                maxTokens = allowed
+            chunk.append(prompt)
+            chunkPromptTokens += promptTokens
+            chunkMaxTokens = maxTokens
+        if chunk:
+            yield chunk, chunkMaxTokens, chunkPromptTokens
+
+    def _cacheKey(self, prompt, model, temperature, maxTokens):
+        #None when the completion shouldn't be cached
+        if self._completionCache is None or temperature != 0.0:
+            return None
+        return self._completionCache.key(model, prompt, maxTokens, temperature)
+
+    def _flightKey(self, prompt, model, temperature, maxTokens):
+        #None when identical prompts may get different completions
+        if temperature != 0.0:
+            return None
+        return ("prompt", model, prompt, maxTokens)
+
+    def invalidate(self, *names):
+        #reads by these names (e.g. "listFiles") no longer join calls that
+        #are already in flight, whose results may predate a change
+        for name in names:
+            self._generations[name] = self._generations.get(name, 0) + 1
+
+    def _shared(self, name, function, *args):
+        #a read, shared with identical reads in flight that started at the
+        #same generation. name tells the reads apart, as the sdk functions of
+        #different resources are the same
+        key = (name, self._generations.get(name, 0)) + args
+        return self._flight.do(key, self._transport.call, function, *args)
+
+    async def _ashared(self, name, function, *args):
+        key = (name, self._generations.get(name, 0)) + args
+        return await self._flight.ado(key, self._transport.acall, function,
+                *args)
+
+    def _completionTokens(self, prompt, model, nTokens, promptTokens=None):
+        if nTokens == None:
+            return 32
+        #nTokens is the budget for prompt and completion together, so the
+        #completion gets whatever the prompt leaves of it
+        if promptTokens is None:
+            promptTokens = getTokenizer().countTokens(prompt)
+        completionTokens = min(nTokens, getContextSize(model)) - promptTokens
+        assert(completionTokens > 0), \
+                "prompt is {} tokens, which leaves nothing of the {} allowed"\
+                .format(promptTokens, nTokens)
+        return completionTokens
     
+    @metrics.timed(API_SECONDS, method="uploadFile")
     def uploadFile(self, filename):
         with open(filename, 'rb') as file:
-            response = openai.File.create(
-                    file=file,
-                    purpose='fine-tune'
-                    )
+            def create():
+                #a retry has to send the file from the start again
+                file.seek(0)
+                return openai.File.create(file=file, purpose='fine-tune')
+            response = self._transport.call(create, idempotent=False)
+        self.invalidate("listFiles")
         return response
     
+    @metrics.timed(API_SECONDS, method="deleteFile")
     def deleteFile(self, filename):
-        #TODO need to be careful of this because the file may not be fully uploaded
-        #by the time this function is called
-        response = openai.File.delete(filename)
+        #the api refuses to delete a file it is still processing, see
+        #getFileStatus
+        response = self._transport.call(openai.File.delete, filename)
+        self.invalidate("listFiles", "getFileStatus")
         return response
 
+    @metrics.timed(API_SECONDS, method="getFileStatus")
+    def getFileStatus(self, fileId):
+        return self._shared("getFileStatus", openai.File.retrieve,
+                fileId)["status"]
+
+    @metrics.timed(API_SECONDS, method="waitForFile")
+    def waitForFile(self, fileId, timeout=30.0, pollInterval=1.0):
+        #polls the file until the api is done processing it or timeout runs
+        #out. Returns the last status seen
+        deadline = time.monotonic() + timeout
+        while True:
+            status = self.getFileStatus(fileId)
+            if status not in PENDING_FILE_STATUSES or \
+                    time.monotonic() + pollInterval > deadline:
+                return status
+            time.sleep(pollInterval)
+
+    @metrics.timed(API_SECONDS, method="listFiles")
     def listFiles(self):
-        return openai.File.list()
+        return self._shared("listFiles", openai.File.list)
 
+    @metrics.timed(API_SECONDS, method="listFineTunes")
     def listFineTunes(self):
-        return openai.FineTune.list()
+        return self._shared("listFineTunes", openai.FineTune.list)
 
+    @metrics.timed(API_SECONDS, method="train")
     def train(self, filename, model="davinci"):
-        return openai.FineTune.create(training_file=filename, model=model)
+        response = self._transport.call(openai.FineTune.create,
+                training_file=filename, model=model, idempotent=False)
+        self.invalidate("listFineTunes")
+        return response
+
+    @metrics.timed(API_SECONDS, method="getFineTune")
+    def getFineTune(self, fineTuneId):
+        return self._shared("getFineTune", openai.FineTune.retrieve,
+                fineTuneId)
+
+    @metrics.timed(API_SECONDS, method="listFineTuneEvents")
+    def listFineTuneEvents(self, fineTuneId):
+        return self._shared("listFineTuneEvents",
+                openai.FineTune.list_events, fineTuneId)
 
+    @metrics.timed(API_SECONDS, method="deleteModel")
     def deleteModel(self, modelName):
-        return openai.Model.delete(modelName)
+        response = self._transport.call(openai.Model.delete, modelName)
+        self.invalidate("listModels")
+        if self._completionCache is not None:
+            self._completionCache.invalidateModel(modelName)
+        return response
 
+    @metrics.timed(API_SECONDS, method="listModels")
     def listModels(self):
-        return openai.Model.list()
+        return self._shared("listModels", openai.Model.list)
+
+    @metrics.timed(API_SECONDS, method="alistFiles")
+    async def alistFiles(self):
+        return await self._ashared("listFiles", openai.File.alist)
+
+    @metrics.timed(API_SECONDS, method="alistFineTunes")
+    async def alistFineTunes(self):
+        return await self._ashared("listFineTunes",
+                openai.FineTune.alist)
+
+    @metrics.timed(API_SECONDS, method="alistModels")
+    async def alistModels(self):
+        return await self._ashared("listModels", openai.Model.alist)
+
+    async def aclose(self):
+        #closes the connection pool of the running event loop
+        await self._transport.aclose()
 
         
 #print(promptAi("5+5"))
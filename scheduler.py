@@ -0,0 +1,274 @@
+import time
+import heapq
+import asyncio
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+
+import metrics
+
+#priorities, lower goes first
+INTERACTIVE = 0
+NORMAL = 1
+BACKGROUND = 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NORMAL: "normal",
+        BACKGROUND: "background"}
+
+_priority = contextvars.ContextVar("apiPriority", default=NORMAL)
+
+QUEUED = metrics.gauge("ai9_scheduler_queued",
+        "api calls waiting for the scheduler", ["priority"])
+WAIT_SECONDS = metrics.histogram("ai9_scheduler_wait_seconds",
+        "time api calls waited for the scheduler", ["priority"])
+SHED = metrics.counter("ai9_scheduler_shed_total",
+        "api calls the scheduler refused", ["priority"])
+
+
+class SchedulerBusyError(Exception):
+    '''
+    raised instead of calling the api when the scheduler sheds the call
+    '''
+    pass
+
+
+def currentPriority():
+    '''
+    @returns int: the priority api calls made here get
+    '''
+    return _priority.get()
+
+
+@contextmanager
+def priority(level):
+    '''
+    gives the api calls made inside it a priority. Holds per thread, or per
+    asyncio task:
+        with scheduler.priority(scheduler.INTERACTIVE):
+            apiManager.prompt(...)
+    @param int level: INTERACTIVE, NORMAL or BACKGROUND
+    '''
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    '''
+    Budget of amount per minute, refilled continuously and holding at most
+    burstSeconds of it, so work can't bunch up into a burst the api would
+    throttle.
+    @method delay(amount, reserve) : seconds until amount can be taken
+    @method take(amount)
+    '''
+
+    def __init__(self, perMinute, burstSeconds=10.0):
+        '''
+        @param float perMinute: the budget
+        @param float burstSeconds: how much budget can pile up, in seconds
+        '''
+        self._rate = perMinute / 60.0
+        self.capacity = max(1.0, self._rate * burstSeconds)
+        self._level = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity,
+                self._level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def delay(self, amount, reserve=0.0):
+        '''
+        @param float amount: what is to be taken, at most capacity counts
+        @param float reserve: fraction of capacity that must be left after
+        @returns float: seconds to wait, 0 if it can be taken now
+        '''
+        self._refill()
+        #the reserve can't ask for more than the bucket holds, or a small
+        #bucket would never let anything through
+        needed = min(min(amount, self.capacity) + reserve * self.capacity,
+                self.capacity)
+        if self._level >= needed:
+            return 0.0
+        return (needed - self._level) / self._rate
+
+    def take(self, amount):
+        self._level -= min(amount, self.capacity)
+
+
+class _Waiter:
+    '''
+    a call waiting its turn. Ordered by priority, then arrival
+    '''
+    __slots__ = ("priority", "seq", "tokens", "wake", "done")
+
+    def __init__(self, priority, seq, tokens, wake):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.wake = wake
+        self.done = False
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class ApiScheduler:
+    '''
+    Orders api calls by priority and paces them with two token buckets, one
+    for requests per minute and one for tokens per minute, so we slow
+    ourselves down before the api starts throttling us. Calls wait in one
+    priority queue and only its head may go: an interactive prompt goes
+    ahead of every refresh or poll waiting, and work below interactive has
+    to leave reserve of each bucket unused, so a prompt arriving later
+    finds budget. Instead of queueing without end, a call is shed with a
+    SchedulerBusyError when its priority already has maxQueued calls
+    waiting, or it has waited maxWait seconds. Threads and asyncio tasks
+    share the queue.
+    @method acquire(tokens) : blocks until the call may go
+    @method aacquire(tokens) : awaits until the call may go
+    '''
+
+    #calls of a priority that may wait at once, None for no limit
+    DEFAULT_MAX_QUEUED = {INTERACTIVE: None, NORMAL: 200, BACKGROUND: 50}
+    #seconds a call of a priority may wait before it is shed
+    DEFAULT_MAX_WAIT = {INTERACTIVE: 60.0, NORMAL: 30.0, BACKGROUND: 10.0}
+
+    def __init__(self, requestsPerMinute=3000, tokensPerMinute=250000,
+            burstSeconds=10.0, reserve=0.2, maxQueued=None, maxWait=None):
+        '''
+        @param float requestsPerMinute: the account's request limit
+        @param float tokensPerMinute: the account's token limit
+        @param float burstSeconds: budget that may pile up, see TokenBucket
+        @param float reserve: fraction of each bucket kept for interactive
+          calls
+        @param dict maxQueued: priority->overrides of DEFAULT_MAX_QUEUED
+        @param dict maxWait: priority->overrides of DEFAULT_MAX_WAIT
+        '''
+        self._requests = TokenBucket(requestsPerMinute, burstSeconds)
+        self._tokens = TokenBucket(tokensPerMinute, burstSeconds)
+        self._reserve = reserve
+        self._maxQueued = dict(self.DEFAULT_MAX_QUEUED)
+        self._maxQueued.update(maxQueued or {})
+        self._maxWait = dict(self.DEFAULT_MAX_WAIT)
+        self._maxWait.update(maxWait or {})
+        #heap of _Waiters
+        self._waiting = []
+        self._queued = {level: 0 for level in PRIORITY_NAMES}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        '''
+        waits for the call's turn and budget, at the priority of the context
+        @param int tokens: tokens the call may use, prompt plus max_tokens
+        @throws SchedulerBusyError: if the call is shed
+        '''
+        event = threading.Event()
+        waiter = self._enqueue(tokens, event.set)
+        start = time.monotonic()
+        deadline = start + self._maxWait[waiter.priority]
+        try:
+            while True:
+                wait = self._tryGrant(waiter, start, deadline)
+                if wait == 0.0:
+                    return
+                event.wait(wait)
+                event.clear()
+        finally:
+            self._abandon(waiter)
+
+    async def aacquire(self, tokens=0):
+        '''
+        acquire, for the event loop
+        '''
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self._enqueue(tokens,
+                lambda: loop.call_soon_threadsafe(event.set))
+        start = time.monotonic()
+        deadline = start + self._maxWait[waiter.priority]
+        try:
+            while True:
+                wait = self._tryGrant(waiter, start, deadline)
+                if wait == 0.0:
+                    return
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                event.clear()
+        finally:
+            #a cancelled task must not hold up the queue
+            self._abandon(waiter)
+
+    def _enqueue(self, tokens, wake):
+        '''
+        @returns _Waiter: the call, in the queue
+        @throws SchedulerBusyError: if its priority's queue is full
+        '''
+        level = currentPriority()
+        with self._lock:
+            limit = self._maxQueued[level]
+            if limit is not None and self._queued[level] >= limit:
+                SHED.inc(priority=PRIORITY_NAMES[level])
+                raise SchedulerBusyError("too many {} api calls waiting"
+                        .format(PRIORITY_NAMES[level]))
+            waiter = _Waiter(level, next(self._seq), tokens, wake)
+            heapq.heappush(self._waiting, waiter)
+            self._queued[level] += 1
+        QUEUED.inc(priority=PRIORITY_NAMES[level])
+        return waiter
+
+    def _tryGrant(self, waiter, start, deadline):
+        '''
+        lets the waiter go if it is at the head and the buckets allow
+        @returns float: 0 if it may go, else seconds to wait before asking
+          again. It is woken sooner if it becomes the head
+        @throws SchedulerBusyError: if it has waited past its deadline
+        '''
+        now = time.monotonic()
+        with self._lock:
+            if self._waiting[0] is waiter:
+                reserve = 0.0 if waiter.priority == INTERACTIVE \
+                        else self._reserve
+                wait = max(self._requests.delay(1, reserve),
+                        self._tokens.delay(waiter.tokens, reserve))
+                if wait == 0.0:
+                    self._requests.take(1)
+                    self._tokens.take(waiter.tokens)
+                    self._remove(waiter)
+                    WAIT_SECONDS.observe(now - start,
+                            priority=PRIORITY_NAMES[waiter.priority])
+                    return 0.0
+            else:
+                wait = deadline - now
+            if now >= deadline:
+                self._remove(waiter)
+                SHED.inc(priority=PRIORITY_NAMES[waiter.priority])
+                raise SchedulerBusyError("api call waited {:.1f}s for the "
+                        "rate limits".format(now - start))
+            return min(wait, deadline - now)
+
+    def _abandon(self, waiter):
+        with self._lock:
+            if not waiter.done:
+                self._remove(waiter)
+
+    def _remove(self, waiter):
+        '''
+        takes a waiter out of the queue and wakes the new head. Holds the lock
+        '''
+        waiter.done = True
+        if self._waiting[0] is waiter:
+            heapq.heappop(self._waiting)
+        else:
+            self._waiting.remove(waiter)
+            heapq.heapify(self._waiting)
+        self._queued[waiter.priority] -= 1
+        QUEUED.dec(priority=PRIORITY_NAMES[waiter.priority])
+        if self._waiting:
+            self._waiting[0].wake()
@@ -0,0 +1,349 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from collections.abc import MutableMapping
+
+
+class SharedStore:
+    '''
+    State shared by every worker process of the app, in one sqlite database
+    in WAL mode, so readers never wait on a writer. Values live in namespaces
+    of json encoded key/value pairs. Every write bumps its namespace's
+    version in the same transaction, so a process can tell with one cheap
+    read whether anybody, itself or another process, changed a namespace
+    since it last looked. That is the cross-process invalidation: everything
+    built on the store keeps a local copy and reloads it when the version
+    moves. Safe to use from several threads; each gets its own connection.
+    @method get(namespace, key, default)
+    @method items(namespace) : every (key, value) of a namespace
+    @method put(namespace, key, value)
+    @method putMany(namespace, items)
+    @method delete(namespace, key)
+    @method version(namespace) : changes whenever the namespace does
+    @method bump(namespace) : a new version of the namespace, for counters
+    '''
+
+    def __init__(self, path=os.path.join("MetaData", "shared.sqlite"),
+            busyTimeout=10.0):
+        '''
+        @param string path: the database file, shared by the processes
+        @param float busyTimeout: seconds a writer waits for another one
+        '''
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self._path = path
+        self._busyTimeout = busyTimeout
+        self._local = threading.local()
+        db = self._connection()
+        db.execute("PRAGMA journal_mode=WAL")
+        with db:
+            db.execute("CREATE TABLE IF NOT EXISTS kv (namespace TEXT, "
+                    "key TEXT, value TEXT, PRIMARY KEY (namespace, key))")
+            db.execute("CREATE TABLE IF NOT EXISTS versions ("
+                    "namespace TEXT PRIMARY KEY, version INTEGER)")
+
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self._path, timeout=self._busyTimeout,
+                    isolation_level=None)
+            #WAL makes NORMAL safe against corruption, and much faster
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def transaction(self):
+        '''
+        @returns context manager: a write transaction, yielding the
+          connection
+        '''
+        return _Transaction(self._connection())
+
+    def readTransaction(self):
+        '''
+        @returns context manager: a read transaction, yielding the connection.
+          It sees one snapshot of the database, without taking the write lock
+        '''
+        return _Transaction(self._connection(), "DEFERRED")
+
+    def get(self, namespace, key, default=None):
+        row = self._connection().execute("SELECT value FROM kv "
+                "WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return default if row is None else json.loads(row[0])
+
+    def items(self, namespace):
+        '''
+        @returns tuple: the version the items are from, and the list of
+          (key, value) of the namespace
+        '''
+        with self.readTransaction() as db:
+            version = self._version(db, namespace)
+            rows = db.execute("SELECT key, value FROM kv WHERE namespace = ?",
+                    (namespace,)).fetchall()
+        return version, [(key, json.loads(value)) for key, value in rows]
+
+    def put(self, namespace, key, value):
+        self.putMany(namespace, [(key, value)])
+
+    def putMany(self, namespace, items):
+        '''
+        @param string namespace: the namespace
+        @param iterable<tuple> items: (key, value) pairs to write, at once
+        '''
+        with self.transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)",
+                    [(namespace, key, json.dumps(value))
+                    for key, value in items])
+            self._bump(db, namespace)
+
+    def delete(self, namespace, key):
+        with self.transaction() as db:
+            db.execute("DELETE FROM kv WHERE namespace = ? AND key = ?",
+                    (namespace, key))
+            self._bump(db, namespace)
+
+    def version(self, namespace):
+        '''
+        @param string namespace: the namespace
+        @returns int: its version, 0 if it was never written
+        '''
+        return self._version(self._connection(), namespace)
+
+    def bump(self, namespace):
+        '''
+        @returns int: the namespace's next version, unique across processes
+        '''
+        with self.transaction() as db:
+            return self._bump(db, namespace)
+
+    def _version(self, db, namespace):
+        row = db.execute("SELECT version FROM versions WHERE namespace = ?",
+                (namespace,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def _bump(self, db, namespace):
+        db.execute("INSERT INTO versions VALUES (?, 1) ON CONFLICT(namespace) "
+                "DO UPDATE SET version = version + 1", (namespace,))
+        return self._version(db, namespace)
+
+
+class _Transaction:
+    '''
+    BEGIN IMMEDIATE ... COMMIT, or ROLLBACK on an exception. Immediate, so
+    the write lock is taken up front and a read-then-write can't deadlock.
+    Reads only begin DEFERRED, and in WAL mode never wait on a writer.
+    '''
+
+    def __init__(self, db, mode="IMMEDIATE"):
+        self._db = db
+        self._mode = mode
+
+    def __enter__(self):
+        self._db.execute("BEGIN " + self._mode)
+        return self._db
+
+    def __exit__(self, excType, exc, traceback):
+        self._db.execute("ROLLBACK" if excType is not None else "COMMIT")
+        return False
+
+
+class SharedDict(MutableMapping):
+    '''
+    Dict kept in a namespace of a SharedStore, standing in for
+    PersistentAppData when several processes run the app: a write by any of
+    them is seen by all. Reads come from a local copy, which is reloaded
+    whenever the namespace's version has moved. Like PersistentAppData it has
+    an inverse index for invGet.
+    @method delete(key)
+    @method hasValue(value)
+    @method invGet(value) : a key holding value
+    '''
+
+    def __init__(self, store, namespace, seed=None):
+        '''
+        @param SharedStore store: the store
+        @param string namespace: the namespace the dict lives in
+        @param seed: optional function returning a dict, whose items are
+          copied in if the namespace was never written. Carries data over
+          from a PersistentAppData
+        '''
+        self._store = store
+        self._namespace = namespace
+        self._data = {}
+        self._inverse = {}
+        self._version = None
+        self._lock = threading.Lock()
+        if seed is not None and store.version(namespace) == 0:
+            store.putMany(namespace, seed().items())
+
+    def _sync(self):
+        '''
+        @returns dict: the local copy, reloaded if the namespace changed
+        '''
+        version = self._store.version(self._namespace)
+        with self._lock:
+            if version == self._version:
+                return self._data
+        version, items = self._store.items(self._namespace)
+        data = dict(items)
+        inverse = {}
+        for key, value in data.items():
+            inverse.setdefault(value, set()).add(key)
+        with self._lock:
+            self._data, self._inverse, self._version = data, inverse, version
+        return data
+
+    def __getitem__(self, key):
+        return self._sync()[key]
+
+    def __contains__(self, key):
+        return key in self._sync()
+
+    def __iter__(self):
+        return iter(list(self._sync()))
+
+    def __len__(self):
+        return len(self._sync())
+
+    def __setitem__(self, key, value):
+        self._store.put(self._namespace, key, value)
+
+    def __delitem__(self, key):
+        if key not in self._sync():
+            raise KeyError(key)
+        self._store.delete(self._namespace, key)
+
+    def delete(self, key):
+        del self[key]
+
+    def hasValue(self, value):
+        self._sync()
+        with self._lock:
+            return value in self._inverse
+
+    def invGet(self, value):
+        '''
+        @throws KeyError: if no key holds value
+        '''
+        self._sync()
+        with self._lock:
+            return next(iter(self._inverse[value]))
+
+
+class SqliteConversationBackend:
+    '''
+    Keeps the conversations of a ConversationStore in a SharedStore, so a
+    session's history follows it to whichever process serves its next
+    request. Every change to a session gives it a new version, unique across
+    processes, which the ConversationStore compares against the one its
+    local copy was loaded at. Sessions idle for longer than idleSeconds are
+    deleted now and then.
+    @method version(sessionId)
+    @method load(sessionId) : version, [(prompt, response, tokens)]
+    @method append(sessionId, prompt, response, tokens, maxTokens)
+    @method clear(sessionId)
+    '''
+
+    #namespace of the version counter
+    NAMESPACE = "conversations"
+
+    def __init__(self, store, idleSeconds=3600.0, expireEvery=60.0):
+        '''
+        @param SharedStore store: the store
+        @param float idleSeconds: sessions unused this long are deleted
+        @param float expireEvery: seconds between sweeps for idle sessions
+        '''
+        self._store = store
+        self._idleSeconds = idleSeconds
+        self._expireEvery = expireEvery
+        self._lastExpire = 0.0
+        with store.transaction() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions ("
+                    "sessionId TEXT PRIMARY KEY, version INTEGER, "
+                    "lastUsed REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS turns (sessionId TEXT, "
+                    "seq INTEGER, prompt TEXT, response TEXT, "
+                    "tokens INTEGER, PRIMARY KEY (sessionId, seq))")
+            db.execute("CREATE INDEX IF NOT EXISTS sessionsByUse "
+                    "ON sessions (lastUsed)")
+
+    def version(self, sessionId):
+        '''
+        @returns int: the session's version, 0 if it has no turns stored
+        '''
+        row = self._store._connection().execute("SELECT version FROM "
+                "sessions WHERE sessionId = ?", (sessionId,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def load(self, sessionId):
+        '''
+        counts as a use of the session, so one that is only read isn't
+        expired
+        @returns tuple: the version, and the turns as (prompt, response,
+          tokens), oldest first
+        '''
+        with self._store.readTransaction() as db:
+            row = db.execute("SELECT version, lastUsed FROM sessions "
+                    "WHERE sessionId = ?", (sessionId,)).fetchone()
+            turns = db.execute("SELECT prompt, response, tokens FROM turns "
+                    "WHERE sessionId = ? ORDER BY seq", (sessionId,)).fetchall()
+        if row is None:
+            return 0, turns
+        now = time.time()
+        #a write per load would serialize the readers, and lastUsed only
+        #needs to be as fine as the sweeps
+        if now - row[1] > self._expireEvery:
+            self._store._connection().execute("UPDATE sessions SET "
+                    "lastUsed = ? WHERE sessionId = ?", (now, sessionId))
+        return row[0], turns
+
+    def append(self, sessionId, prompt, response, tokens, maxTokens):
+        '''
+        adds a turn, then deletes the oldest turns until the session is
+        within maxTokens, the way ContextWindow evicts
+        @param int maxTokens: the most tokens of history kept
+        @returns tuple<int>: the session's version before, and after
+        '''
+        self._maybeExpire()
+        with self._store.transaction() as db:
+            row = db.execute("SELECT version FROM sessions "
+                    "WHERE sessionId = ?", (sessionId,)).fetchone()
+            before = 0 if row is None else row[0]
+            seq = db.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM turns "
+                    "WHERE sessionId = ?", (sessionId,)).fetchone()[0]
+            db.execute("INSERT INTO turns VALUES (?, ?, ?, ?, ?)",
+                    (sessionId, seq, prompt, response, tokens))
+            kept = 0
+            for turnSeq, turnTokens in db.execute("SELECT seq, tokens FROM "
+                    "turns WHERE sessionId = ? ORDER BY seq DESC",
+                    (sessionId,)).fetchall():
+                kept += turnTokens
+                #the newest turn stays, even if it alone is too big
+                if kept > maxTokens and turnSeq != seq:
+                    db.execute("DELETE FROM turns WHERE sessionId = ? AND "
+                            "seq <= ?", (sessionId, turnSeq))
+                    break
+            after = self._store._bump(db, self.NAMESPACE)
+            db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)",
+                    (sessionId, after, time.time()))
+        return before, after
+
+    def clear(self, sessionId):
+        with self._store.transaction() as db:
+            db.execute("DELETE FROM turns WHERE sessionId = ?", (sessionId,))
+            db.execute("DELETE FROM sessions WHERE sessionId = ?",
+                    (sessionId,))
+
+    def _maybeExpire(self):
+        now = time.time()
+        if now - self._lastExpire < self._expireEvery:
+            return
+        self._lastExpire = now
+        with self._store.transaction() as db:
+            cutoff = now - self._idleSeconds
+            db.execute("DELETE FROM turns WHERE sessionId IN (SELECT "
+                    "sessionId FROM sessions WHERE lastUsed < ?)", (cutoff,))
+            db.execute("DELETE FROM sessions WHERE lastUsed < ?", (cutoff,))
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import metrics
+
+COALESCED = metrics.counter("ai9_coalesced_calls_total",
+        "calls that shared the result of an identical call in flight",
+        ["flight"])
+
+
+class _Call:
+    '''
+    one call in flight, and what it came to
+    '''
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Coalesces identical concurrent calls. The first caller with a key makes
+    the call; anybody asking for the same key while it is in flight waits for
+    it and gets the same result, or the same exception, instead of making
+    their own. Once the call is done the key is free again, so nothing is
+    cached beyond the call. Every caller gets the same object back, so
+    results must be treated as read only.
+    @method do(key, function, *args, **kwargs) : calls, or joins a call
+    @method ado(key, function, *args, **kwargs) : the same for a coroutine
+      function, within one event loop
+    '''
+
+    def __init__(self, name):
+        '''
+        @param string name: names the flight in the metrics
+        '''
+        self._name = name
+        #key->_Call
+        self._calls = {}
+        #(event loop, key)->asyncio.Task
+        self._tasks = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, function, *args, **kwargs):
+        '''
+        @param key: hashable, equal for calls that may share a result
+        @param function: makes the call
+        @returns whatever function returns
+        @throws whatever function throws
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            COALESCED.inc(flight=self._name)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = function(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def ado(self, key, function, *args, **kwargs):
+        '''
+        @param key: hashable, equal for calls that may share a result
+        @param function: coroutine function that makes the call
+        @returns whatever function returns
+        @throws whatever function throws
+        '''
+        loop = asyncio.get_running_loop()
+        taskKey = (loop, key)
+        task = self._tasks.get(taskKey)
+        if task is None:
+            task = loop.create_task(function(*args, **kwargs))
+            self._tasks[taskKey] = task
+            task.add_done_callback(lambda _: self._tasks.pop(taskKey, None))
+        else:
+            COALESCED.inc(flight=self._name)
+        #a caller that gives up must not cancel the call for the others
+        return await asyncio.shield(task)
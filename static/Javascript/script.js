@@ -30,3 +30,168 @@ $(document).ready(function() {
     });
 
 });
+
+/*
+ * Streams the completion into the conversation instead of waiting for the
+ * whole page. The /stream endpoint sends Server-Sent-Events: a data event per
+ * piece of text, then done (or error). If streaming is unavailable we fall
+ * back to the normal form post.
+ */
+$(document).ready(function() {
+    var $form = $("#promptForm");
+    $("#submitPrompt").on("click", function(event) {
+      if (!window.fetch || !window.TextDecoder) {
+        return;
+      }
+      event.preventDefault();
+      var $prompt = $("<h3>").text($form.find("[name=textbox]").val());
+      var $response = $("<p>");
+      $("#conversation").prepend($prompt, $response);
+      streamPrompt($form.data("stream"), new FormData($form[0]), $response);
+    });
+});
+
+function streamPrompt(url, formData, $response) {
+    fetch(url, {method: "POST", body: formData}).then(function(resp) {
+      var reader = resp.body.getReader();
+      var decoder = new TextDecoder();
+      var buffer = "";
+      function pump() {
+        return reader.read().then(function(result) {
+          if (result.done) {
+            return;
+          }
+          buffer += decoder.decode(result.value, {stream: true});
+          var events = buffer.split("\n\n");
+          buffer = events.pop();
+          events.forEach(function(raw) {
+            handleStreamEvent(raw, $response);
+          });
+          return pump();
+        });
+      }
+      return pump();
+    }).catch(function(err) {
+      $response.text($response.text() + " [" + err + "]");
+    });
+}
+
+function handleStreamEvent(raw, $response) {
+    var name = "message";
+    var data = "";
+    raw.split("\n").forEach(function(line) {
+      if (line.startsWith("event: ")) {
+        name = line.slice(7);
+      } else if (line.startsWith("data: ")) {
+        data += line.slice(6);
+      }
+    });
+    if (name == "message") {
+      $response.text($response.text() + JSON.parse(data));
+    } else if (name == "error") {
+      $response.text($response.text() + " [" + JSON.parse(data) + "]");
+    }
+}
+
+/*
+ * Forms marked sectionForm post in the background. We send the etags of the
+ * sections the page shows; the server answers with the notice and the html
+ * of only the sections that changed, which replace the old ones. The files
+ * and fine tunes also change on their own (processing, training), so they
+ * are polled, and come back 304 while they stay the same. Their pager links
+ * fetch just the section too. Posts and fetches send the page each paged
+ * section shows, under its own parameter, so neither pager jumps back to the
+ * first page.
+ */
+$(document).ready(function() {
+    $(".sectionForm").on("submit", function(event) {
+      var submitter = event.originalEvent && event.originalEvent.submitter;
+      if (!window.fetch || !submitter) {
+        return;
+      }
+      event.preventDefault();
+      var formData = new FormData(this);
+      formData.append(submitter.name, "");
+      $.each(PAGE_ARGS, function(section, name) {
+        formData.set(name, sectionPage(section));
+      });
+      postSections(this.action, formData);
+    });
+    $(document).on("click", "[data-pager] a", function(event) {
+      if (!window.fetch) {
+        return;
+      }
+      event.preventDefault();
+      var section = $(this).closest("[data-pager]").data("pager");
+      fetchSection(section, $(this).data("page"), null);
+    });
+    if (window.fetch) {
+      setInterval(function() {
+        pollSection("files");
+        pollSection("fineTunes");
+      }, 30000);
+    }
+});
+
+//the parameter with the page shown of each paged section
+var PAGE_ARGS = {files: "filesPage", fineTunes: "fineTunesPage"};
+
+function sectionPage(section) {
+    return $("[data-section=" + section + "]").find("[data-pager]")
+      .data("page") || 1;
+}
+
+function sectionEtags() {
+    var etags = {};
+    $("[data-section]").each(function() {
+      etags[$(this).data("section")] = $(this).attr("data-etag");
+    });
+    return etags;
+}
+
+function setSection(section, html, etag) {
+    $("[data-section=" + section + "]").html(html).attr("data-etag", etag);
+}
+
+function showNotice(text) {
+    $("#notice").text(text || "").prop("hidden", !text);
+}
+
+function postSections(url, formData) {
+    fetch(url, {method: "POST", body: formData,
+        headers: {"X-Section-Etags": JSON.stringify(sectionEtags())}})
+      .then(function(resp) {
+        if (!resp.ok) {
+          throw new Error(resp.status + " " + resp.statusText);
+        }
+        return resp.json();
+      }).then(function(update) {
+        showNotice(update.notice);
+        $.each(update.sections, function(section, part) {
+          setSection(section, part.html, part.etag);
+        });
+      }).catch(function(err) {
+        showNotice("request failed: " + err);
+      });
+}
+
+function pollSection(section) {
+    fetchSection(section, sectionPage(section),
+      $("[data-section=" + section + "]").attr("data-etag"));
+}
+
+function fetchSection(section, page, etag) {
+    var url = $("body").data("fragment").replace("SECTION", section) +
+        "?" + PAGE_ARGS[section] + "=" + page;
+    var headers = etag ? {"If-None-Match": '"' + etag + '"'} : {};
+    fetch(url, {cache: "no-store", headers: headers})
+      .then(function(resp) {
+        if (resp.status != 200) {
+          return;
+        }
+        var newEtag = (resp.headers.get("ETag") || "").replace(/"/g, "");
+        return resp.text().then(function(html) {
+          setSection(section, html, newEtag);
+        });
+      });
+}
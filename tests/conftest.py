@@ -0,0 +1,22 @@
+'''
+The modules are flat files at the root of the repository, next to this
+directory. Everything that writes to MetaData or UploadedFiles does so
+relative to the working directory, so tests that need it run in a scratch
+one.
+'''
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+    '''
+    runs the test in an empty directory holding an api key file
+    '''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "apiKey").write_text("sk-test\n")
+    return tmp_path
@@ -0,0 +1,155 @@
+import time
+import threading
+
+from fakeApi import FakeApiManager
+from app import ApiDataCache
+
+
+class SnapshotFirst(FakeApiManager):
+    '''
+    lists the files the moment it is called, and only answers after latency,
+    like the api does: whatever changes meanwhile is not in the answer
+    '''
+
+    def __init__(self, latency, **kwargs):
+        super().__init__(**kwargs)
+        self.latency = latency
+
+    def listFiles(self):
+        self._call("listFiles")
+        data = list(self._files)
+        time.sleep(self.latency)
+        return {"object": "list", "data": data}
+
+
+def ids(data):
+    return [item["id"] for item in data]
+
+def waitFor(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert(time.monotonic() < deadline), "timed out"
+        time.sleep(0.01)
+
+
+def testFetchesOnceThenAnswersFromMemory():
+    apiManager = FakeApiManager(nFiles=3)
+    cache = ApiDataCache(apiManager)
+    assert(len(cache.getFileData()) == 3)
+    assert(len(cache.getFileData()) == 3)
+    assert(apiManager.getCallCounts()["listFiles"] == 1)
+
+def testStaleDataIsServedWhileItRevalidates():
+    apiManager = FakeApiManager(nFiles=1, latencies={"listFiles": 0.1})
+    cache = ApiDataCache(apiManager, ttls={"files": 0.05})
+    cache.getFileData()
+    apiManager._files.append({"id": "file-new"})
+    time.sleep(0.1)
+    start = time.monotonic()
+    #stale, so answered from memory right away, and revalidated behind it
+    assert("file-new" not in ids(cache.getFileData()))
+    assert(time.monotonic() - start < 0.05)
+    waitFor(lambda: "file-new" in ids(cache.getFileData()))
+    assert(apiManager.getCallCounts()["listFiles"] == 2)
+
+def testInvalidateFetchesBeforeAnswering():
+    apiManager = FakeApiManager(nFiles=1)
+    cache = ApiDataCache(apiManager, ttls={"files": 60.0})
+    cache.getFileData()
+    version = cache.getVersion("files")
+    apiManager._files.append({"id": "file-new"})
+    cache.invalidate("files")
+    assert("file-new" in ids(cache.getFileData()))
+    assert(cache.getVersion("files") != version)
+
+def testReadAfterInvalidateDoesNotJoinAnOlderFetch():
+    #a revalidation that listed the files before the invalidate must neither
+    #answer the read after it, nor be stored once it lands
+    apiManager = SnapshotFirst(0.3, nFiles=1)
+    cache = ApiDataCache(apiManager, ttls={"files": 0.05})
+    cache.getFileData()
+    time.sleep(0.1)
+    cache.getFileData()
+    waitFor(lambda: apiManager.getCallCounts()["listFiles"] == 2)
+    apiManager._files.append({"id": "file-new"})
+    cache.invalidate("files")
+    assert("file-new" in ids(cache.getFileData()))
+    time.sleep(0.4)
+    assert("file-new" in ids(cache.getFileData()))
+
+def testConcurrentMissesShareOneFetch():
+    apiManager = FakeApiManager(latencies={"listModels": 0.2})
+    cache = ApiDataCache(apiManager)
+    threads = [threading.Thread(target=cache.getModels) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(apiManager.getCallCounts()["listModels"] == 1)
+
+def testRefreshReportsFailuresAndKeepsOldData():
+    apiManager = FakeApiManager(nFiles=2)
+    cache = ApiDataCache(apiManager)
+    assert(cache.refresh() == {})
+    apiManager.setFailureRate("listFiles", 1.0)
+    errors = cache.refresh()
+    assert(set(errors) == {"files"})
+    assert(len(cache.getFileData()) == 2)
+
+def testRefreshCostsTheSlowestCallNotTheSum():
+    latencies = {"listFiles": 0.2, "listFineTunes": 0.2, "listModels": 0.2}
+    cache = ApiDataCache(FakeApiManager(latencies=latencies))
+    start = time.monotonic()
+    assert(cache.refresh() == {})
+    assert(time.monotonic() - start < 0.4)
+    sequential = ApiDataCache(FakeApiManager(latencies=latencies),
+            concurrentRefresh=False)
+    start = time.monotonic()
+    assert(sequential.refresh() == {})
+    assert(time.monotonic() - start >= 0.6)
+
+def testAFailureDoesNotHoldBackTheOtherResources():
+    apiManager = FakeApiManager(nModels=5, latencies={"listModels": 0.1})
+    apiManager.setFailureRate("listFiles", 1.0)
+    cache = ApiDataCache(apiManager)
+    errors = cache.refresh()
+    assert(set(errors) == {"files"})
+    assert(isinstance(errors["files"], RuntimeError))
+    assert(len(cache.getModels()) == 5)
+    assert(set(cache.getTimings()) == {"fineTunes", "models"})
+
+def testASlowResourceTimesOutAndLandsLater():
+    apiManager = FakeApiManager(nFiles=2, latencies={"listFiles": 0.3})
+    cache = ApiDataCache(apiManager)
+    start = time.monotonic()
+    errors = cache.refresh(timeout=0.1)
+    assert(time.monotonic() - start < 0.25)
+    assert(set(errors) == {"files"})
+    assert(isinstance(errors["files"], TimeoutError))
+    #the late call still stores what it fetched
+    waitFor(lambda: "files" in cache.getTimings())
+    assert(len(cache.getFileData()) == 2)
+    assert(apiManager.getCallCounts()["listFiles"] == 1)
+
+def testTimingsAreThoseOfTheLastFetch():
+    apiManager = FakeApiManager(latencies={"listFiles": 0.1,
+            "listModels": 0.0})
+    cache = ApiDataCache(apiManager)
+    cache.refresh()
+    timings = cache.getTimings()
+    assert(set(timings) == {"files", "fineTunes", "models"})
+    assert(timings["files"] >= 0.1)
+    assert(timings["models"] < 0.1)
+    apiManager.setLatency("listFiles", 0.0)
+    cache.refresh()
+    assert(cache.getTimings()["files"] < 0.1)
+
+def testOverlappingRefreshesShareTheCalls():
+    apiManager = FakeApiManager(latencies={"listFiles": 0.2})
+    cache = ApiDataCache(apiManager)
+    threads = [threading.Thread(target=cache.refresh) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(apiManager.getCallCounts()["listFiles"] == 1)
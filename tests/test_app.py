@@ -0,0 +1,501 @@
+import io
+import os
+import re
+import json
+import time
+import asyncio
+
+import pytest
+
+import app as appModule
+import metrics
+import scheduler
+from app import (ApiRegistry, CompareHandler, PersistentAppData,
+        TemplateRenderer)
+from fakeApi import FakeApiManager
+
+
+class FakeApi(FakeApiManager):
+    '''
+    FakeApiManager with the calls the handlers make. Files are processed
+    once status says so. The prompt calls record the priority they run at,
+    take promptSeconds, and fail for the model "broken"
+    '''
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.status = "processed"
+        self.trained = []
+        self.deleted = []
+        self.priorities = []
+        self.promptSeconds = 0.01
+
+    def getFileStatus(self, fileId):
+        self._call("getFileStatus")
+        return self.status
+
+    def uploadFile(self, filename):
+        self._call("uploadFile")
+        fileId = "file-up{}".format(len(self._files))
+        self._files.append({"id": fileId, "status": "uploaded"})
+        return {"id": fileId}
+
+    def deleteFile(self, fileId):
+        self._call("deleteFile")
+        self.deleted.append(fileId)
+        self._files = [file for file in self._files if file["id"] != fileId]
+
+    def train(self, fileId, model="davinci"):
+        self._call("train")
+        self.trained.append(fileId)
+        return {"id": "ft-new", "status": "pending", "model": model,
+                "fine_tuned_model": None, "training_files": [{"id": fileId}]}
+
+    def promptStream(self, prompt, model, temperature, nTokens):
+        for text in ("Hel", "lo"):
+            self.priorities.append(scheduler.currentPriority())
+            time.sleep(0.05)
+            yield text
+
+    def _completion(self, model):
+        self.priorities.append(scheduler.currentPriority())
+        if model == "broken":
+            raise RuntimeError("model broken")
+        return {"choices": [{"text": "Hello", "index": 0}],
+                "usage": {"prompt_tokens": 3, "completion_tokens": 1}}
+
+    def prompt(self, prompt, model, temperature, nTokens):
+        time.sleep(self.promptSeconds)
+        return self._completion(model)
+
+    async def aprompt(self, prompt, model, temperature, nTokens):
+        await asyncio.sleep(self.promptSeconds)
+        return self._completion(model)
+
+    async def apromptStream(self, prompt, model, temperature, nTokens):
+        for text in ("Hel", "lo"):
+            self.priorities.append(scheduler.currentPriority())
+            await asyncio.sleep(0.01)
+            yield text
+
+
+@pytest.fixture
+def flaskApp(scratch):
+    flaskApp = appModule.createApp(warm=False)
+    components = flaskApp.extensions["ai9"]
+    components.__dict__["apiManager"] = FakeApi(nFiles=120, nFineTunes=3)
+    for i in range(120):
+        components.filenameLookup["file-{}".format(i)] = "f{}.json".format(i)
+    components.fineTuneTracker.track = lambda job: None
+    return flaskApp
+
+class FakeCache:
+    '''
+    the parts of ApiDataCache an ApiRegistry reads, with versions the test
+    moves on by hand
+    '''
+
+    def __init__(self):
+        self.data = {"files": [], "models": [], "fineTunes": []}
+        self.versions = {"files": 1, "models": 1, "fineTunes": 1}
+
+    def set(self, resource, items):
+        self.data[resource] = items
+        self.versions[resource] += 1
+
+    def getVersion(self, resource):
+        return self.versions[resource]
+
+    def getFileData(self):
+        return self.data["files"]
+
+    def getModels(self):
+        return self.data["models"]
+
+    def getFineTunes(self):
+        return self.data["fineTunes"]
+
+
+class CountingParser:
+    '''
+    parses an item into (its id,), counting what it parses
+    '''
+
+    def __init__(self):
+        self.parsed = []
+
+    def _parse(self, item):
+        self.parsed.append(item["id"])
+        return (item["id"],)
+
+    parseFile = parseModel = parseFineTune = _parse
+
+
+def components(flaskApp):
+    return flaskApp.extensions["ai9"]
+
+def sectionPost(client, form):
+    response = client.post("/", data=form, headers={"X-Section-Etags": "{}"})
+    assert(response.status_code == 200)
+    return response.get_json()
+
+PROMPT_FORM = {"textbox": "hi", "model": "davinci", "nTokens": "100",
+        "temperature": "0"}
+
+class Captured:
+    '''
+    stands in for a TemplateRenderer, keeping what a handler sets
+    '''
+
+    def __init__(self):
+        self.values = {}
+
+    def set(self, name, value):
+        self.values[name] = value
+
+def metricValue(name):
+    for line in metrics.REGISTRY.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split()[1])
+    return None
+
+
+def testSectionHtmlIsCachedUnderItsKey(flaskApp):
+    renderer = TemplateRenderer("index.html", [], ["models"], maxCached=2)
+    with flaskApp.app_context():
+        first = renderer.renderSection("models", ["a"], key=(1, None))
+        #the key says the data is the same, so the html is too
+        assert(renderer.renderSection("models", ["b"], key=(1, None)) ==
+                first)
+        assert("b" in renderer.renderSection("models", ["b"], key=(2, None)))
+        assert("b" in renderer.renderSection("models", ["b"]))
+
+def testSectionCacheIsBoundedAndSharedByForks(flaskApp):
+    renderer = TemplateRenderer("index.html", [], ["models"], maxCached=2)
+    forked = renderer.fork()
+    with flaskApp.app_context():
+        forked.renderSection("models", ["a"], key=1)
+        assert(renderer.renderSection("models", ["x"], key=1) ==
+                forked.renderSection("models", ["a"], key=1))
+        renderer.renderSection("models", ["b"], key=2)
+        renderer.renderSection("models", ["c"], key=3)
+        #the least recently used key fell out
+        assert("x" in renderer.renderSection("models", ["x"], key=1))
+
+def testFragmentAnswers304UntilTheDataChanges(flaskApp):
+    client = flaskApp.test_client()
+    response = client.get("/fragment/models")
+    etag = response.headers["ETag"]
+    assert(client.get("/fragment/models",
+            headers={"If-None-Match": etag}).status_code == 304)
+    apiManager = components(flaskApp).apiManager
+    apiManager._models.append({"id": "davinci:ft-new", "object": "model",
+            "owned_by": appModule.USER})
+    components(flaskApp).apiCache.invalidate("models")
+    response = client.get("/fragment/models",
+            headers={"If-None-Match": etag})
+    assert(response.status_code == 200)
+    assert("davinci:ft-new" in response.get_data(True))
+
+def testEachPagerKeepsItsPage(flaskApp):
+    client = flaskApp.test_client()
+    html = client.get("/?filesPage=2").get_data(True)
+    assert('name="filesPage" value="2"' in html)
+    assert('name="fineTunesPage" value="1"' in html)
+    update = sectionPost(client, {"refresh": "", "filesPage": "3",
+            "fineTunesPage": "1"})
+    assert('data-pager="files" data-page="3"' in
+            update["sections"]["files"]["html"])
+    fragment = client.get("/fragment/files?filesPage=2").get_data(True)
+    assert('data-pager="files" data-page="2"' in fragment)
+
+def testTrainingAFileStillProcessingDoesNotWait(flaskApp):
+    client = flaskApp.test_client()
+    apiManager = components(flaskApp).apiManager
+    apiManager.status = "uploaded"
+    start = time.monotonic()
+    update = sectionPost(client, {"train": "", "file-0": "on",
+            "model": "createModel"})
+    assert(time.monotonic() - start < 1.0)
+    assert("still being processed" in update["notice"])
+    assert(apiManager.trained == [])
+    apiManager.status = "processed"
+    sectionPost(client, {"train": "", "file-0": "on", "model": "createModel"})
+    assert(apiManager.trained == ["file-0"])
+
+def testDeletingAFileStillProcessingLeavesItAlone(flaskApp):
+    client = flaskApp.test_client()
+    apiManager = components(flaskApp).apiManager
+    apiManager.status = "pending"
+    update = sectionPost(client, {"deleteFile": "", "file-0": "on"})
+    assert("still being processed" in update["notice"])
+    assert(apiManager.deleted == [])
+    assert("file-0" in components(flaskApp).filenameLookup)
+    apiManager.status = "processed"
+    sectionPost(client, {"deleteFile": "", "file-0": "on"})
+    assert(apiManager.deleted == ["file-0"])
+    assert("file-0" not in components(flaskApp).filenameLookup)
+
+def testDuplicateUploadSaysWhichFileIsUsed(flaskApp):
+    client = flaskApp.test_client()
+    examples = b'{"prompt": "a", "completion": " b"}\n'
+    update = sectionPost(client, {"upload": "",
+            "fileChooser": (io.BytesIO(examples), "first.json")})
+    assert("already uploaded" not in update["notice"])
+    update = sectionPost(client, {"upload": "",
+            "fileChooser": (io.BytesIO(examples), "second.json")})
+    assert("already uploaded as first.json" in update["notice"])
+    assert(components(flaskApp).apiManager.getCallCounts()["uploadFile"] == 1)
+
+def testStreamIsOneRequestThatLastsUntilItEnds(flaskApp):
+    client = flaskApp.test_client()
+    count = metricValue('ai9_request_seconds_count{endpoint="stream"}') or 0
+    response = client.post("/stream", data={"textbox": "hi",
+            "model": "davinci", "nTokens": "100", "temperature": "0"})
+    events = response.get_data(True)
+    assert(re.findall(r'data: "(\w+)"', events) == ["Hel", "lo"])
+    assert("event: done" in events)
+    assert(metricValue('ai9_request_seconds_count{endpoint="stream"}') ==
+            count + 1)
+    assert(metricValue("ai9_requests_in_flight") == 0)
+
+def testAppsShareOneMetricsCollector(scratch):
+    collectors = len(metrics.REGISTRY._collectors)
+    for _ in range(3):
+        appModule.createApp(warm=False)
+    assert(len(metrics.REGISTRY._collectors) == collectors)
+
+def testTheDefaultConversationStoreStaysBoundedOnReads(flaskApp):
+    store = components(flaskApp).conversations
+    for i in range(200):
+        assert(store.getConversation("unknown{}".format(i)) == [])
+    assert(store.size() == (0, 0))
+
+def testOnlyViewsOfAChangedResourceParseAgain():
+    cache = FakeCache()
+    parser = CountingParser()
+    registry = ApiRegistry(cache, parser)
+    cache.set("files", [{"id": "file-0"}, {"id": "file-1"}])
+    cache.set("models", [{"id": "davinci"}])
+    cache.set("fineTunes", [{"id": "ft-0"}])
+    registry.getFilenames()
+    registry.getModelnames()
+    registry.getFineTunes()
+    assert(sorted(parser.parsed) == ["davinci", "file-0", "file-1", "ft-0"])
+    parser.parsed.clear()
+    #reads without changes parse nothing
+    registry.getFilenames()
+    registry.getModelnames()
+    registry.getFineTunes()
+    assert(parser.parsed == [])
+    #models don't feed any other view
+    cache.set("models", [{"id": "davinci"}, {"id": "curie"}])
+    registry.getFilenames()
+    registry.getFineTunes()
+    assert(parser.parsed == [])
+    assert(registry.hasModel("curie"))
+    assert(parser.parsed == ["curie"])
+    parser.parsed.clear()
+    #fine tune rows show file names, so a files change parses them again, but
+    #only the files that changed
+    cache.set("files", [{"id": "file-0"}, {"id": "file-1"}, {"id": "file-2"}])
+    registry.getFilenames()
+    assert(parser.parsed == ["file-2"])
+    registry.getFineTunes()
+    assert(parser.parsed == ["file-2", "ft-0"])
+
+def testPagesSliceTheRows():
+    cache = FakeCache()
+    cache.set("files", [{"id": "file-{}".format(i)} for i in range(7)])
+    registry = ApiRegistry(cache, CountingParser())
+    page = registry.getFilenames(2, perPage=3)
+    assert(page == [("file-3",), ("file-4",), ("file-5",)])
+    assert((page.page, page.pages) == (2, 3))
+    last = registry.getFilenames(3, perPage=3)
+    assert(last == [("file-6",)])
+    #pages out of range are clamped
+    assert(registry.getFilenames(9, perPage=3) == last)
+    assert(registry.getFilenames(0, perPage=3).page == 1)
+    everything = registry.getFilenames()
+    assert(len(everything) == 7 and everything.pages == 1)
+    cache.set("files", [{"id": "file-{}".format(i)}
+            for i in range(ApiRegistry.PER_PAGE + 1)])
+    assert(len(registry.getFilenames(1)) == ApiRegistry.PER_PAGE)
+    assert(registry.getFilenames(2).pages == 2)
+    #nothing still has one, empty, page
+    cache.set("files", [])
+    empty = registry.getFilenames(1)
+    assert(empty == [] and (empty.page, empty.pages) == (1, 1))
+
+def testStreamPriorityDoesNotLeakToTheConsumer(flaskApp):
+    handler = components(flaskApp).submitButtonHandler
+    with flaskApp.test_request_context("/stream", method="POST",
+            data=PROMPT_FORM):
+        events = handler.stream(appModule.request)
+        for event in events:
+            #the consumer runs between the events, at its own priority
+            assert(scheduler.currentPriority() == scheduler.NORMAL)
+        assert("event: done" in event)
+    assert(components(flaskApp).apiManager.priorities ==
+            [scheduler.INTERACTIVE] * 2)
+
+def testAsyncIndexPromptsOnTheLoop(flaskApp):
+    controller = components(flaskApp).controller
+    with flaskApp.test_request_context("/", method="POST",
+            data=dict(PROMPT_FORM, submitPrompt="")):
+        sessionId = appModule.getSessionId(appModule.request)
+        html = asyncio.run(controller.aindex(appModule.request))
+    assert("Hello" in html)
+    assert(components(flaskApp).conversations.getConversation(sessionId) ==
+            [("hi", "Hello")])
+    assert(components(flaskApp).apiManager.priorities ==
+            [scheduler.INTERACTIVE])
+
+def testAsyncIndexServesThePageOnGet(flaskApp):
+    controller = components(flaskApp).controller
+    with flaskApp.test_request_context("/"):
+        html = asyncio.run(controller.aindex(appModule.request))
+    assert('data-pager="files" data-page="1"' in html)
+
+def testAsyncStream(flaskApp):
+    handler = components(flaskApp).submitButtonHandler
+    async def collect(events):
+        collected = []
+        async for event in events:
+            collected.append((event, scheduler.currentPriority()))
+        return collected
+    with flaskApp.test_request_context("/stream", method="POST",
+            data=PROMPT_FORM):
+        sessionId = appModule.getSessionId(appModule.request)
+        collected = asyncio.run(collect(handler.astream(appModule.request)))
+    events = "".join(event for event, _ in collected)
+    assert(re.findall(r'data: "(\w+)"', events) == ["Hel", "lo"])
+    assert("event: done" in events)
+    assert({level for _, level in collected} == {scheduler.NORMAL})
+    assert(components(flaskApp).apiManager.priorities ==
+            [scheduler.INTERACTIVE] * 2)
+    assert(components(flaskApp).conversations.getConversation(sessionId) ==
+            [("hi", "Hello")])
+
+def testAppDataRewritesTheFileByDefault(scratch):
+    data = PersistentAppData("names.json")
+    data["file-0"] = "a.json"
+    data["file-1"] = "b.json"
+    del data["file-0"]
+    with open(os.path.join("MetaData", "names.json")) as file:
+        assert(json.load(file) == {"file-1": "b.json"})
+    assert(not os.path.exists(os.path.join("MetaData", "names.json.journal")))
+
+def testAppDataJournalIsReplayedAndFoldedIn(scratch):
+    data = PersistentAppData("names.json", journal=True)
+    data["file-0"] = "a.json"
+    data["file-1"] = "b.json"
+    data["file-0"] = "c.json"
+    del data["file-1"]
+    journalPath = os.path.join("MetaData", "names.json.journal")
+    with open(journalPath) as file:
+        assert(len(file.readlines()) == 4)
+    #the json file hasn't been written since it was made
+    with open(os.path.join("MetaData", "names.json")) as file:
+        assert(json.load(file) == {})
+    #either mode loads it, and folds the journal into the json file
+    loaded = PersistentAppData("names.json")
+    assert(loaded == {"file-0": "c.json"})
+    assert(not os.path.exists(journalPath))
+    with open(os.path.join("MetaData", "names.json")) as file:
+        assert(json.load(file) == {"file-0": "c.json"})
+
+def testAppDataDropsATornJournalLine(scratch):
+    data = PersistentAppData("names.json", journal=True)
+    data["file-0"] = "a.json"
+    with open(os.path.join("MetaData", "names.json.journal"), "a") as file:
+        file.write('["set", "file-1", "b.js')
+    assert(PersistentAppData("names.json") == {"file-0": "a.json"})
+
+def testAppDataJournalCompactsEveryCompactEvery(scratch):
+    data = PersistentAppData("names.json", journal=True, compactEvery=3)
+    for i in range(4):
+        data["file-{}".format(i)] = "{}.json".format(i)
+    with open(os.path.join("MetaData", "names.json")) as file:
+        assert(len(json.load(file)) == 3)
+    with open(os.path.join("MetaData", "names.json.journal")) as file:
+        assert(len(file.readlines()) == 1)
+    assert(len(PersistentAppData("names.json")) == 4)
+
+def testAppDataLoadsTheJsonFilesOfBefore(scratch):
+    os.mkdir("MetaData")
+    with open(os.path.join("MetaData", "names.json"), "w") as file:
+        json.dump({"file-0": "a.json", "file-1": "b.json"}, file)
+    data = PersistentAppData("names.json", journal=True)
+    assert(data == {"file-0": "a.json", "file-1": "b.json"})
+    assert(data.invGet("b.json") == "file-1")
+
+def testAppDataInverseIndexFollowsTheMutations(scratch):
+    data = PersistentAppData("names.json")
+    data["file-0"] = "a.json"
+    assert(data.hasValue("a.json") and data.invGet("a.json") == "file-0")
+    data["file-0"] = "b.json"
+    assert(not data.hasValue("a.json"))
+    assert(data.invGet("b.json") == "file-0")
+    with pytest.raises(KeyError):
+        data.invGet("a.json")
+    data["file-1"] = "b.json"
+    with pytest.raises(AssertionError):
+        data.invGet("b.json")
+    del data["file-0"]
+    assert(data.invGet("b.json") == "file-1")
+    data.delete("file-1")
+    assert(not data.hasValue("b.json"))
+
+def compare(flaskApp, models, run):
+    form = dict(PROMPT_FORM, compare="")
+    captured = Captured()
+    with flaskApp.test_request_context("/", method="POST",
+            data=dict(form, compareModels=models)):
+        handler = CompareHandler(components(flaskApp).apiManager,
+                components(flaskApp).submitButtonHandler)
+        run(handler, appModule.request, captured)
+    return captured.values
+
+def syncCompare(handler, request, captured):
+    handler.handle(request, captured)
+
+def asyncCompare(handler, request, captured):
+    asyncio.run(handler.ahandle(request, captured))
+
+def testCompareRunsTheModelsTogether(flaskApp):
+    apiManager = components(flaskApp).apiManager
+    apiManager.promptSeconds = 0.2
+    models = ["davinci", "curie", "babbage", "ada"]
+    for run in (syncCompare, asyncCompare):
+        start = time.monotonic()
+        values = compare(flaskApp, models, run)
+        assert(time.monotonic() - start < 0.6)
+        comparison = values["comparison"]
+        assert([result["model"] for result in comparison] == models)
+        for result in comparison:
+            assert(result["text"] == "Hello" and result["error"] is None)
+            assert((result["promptTokens"], result["completionTokens"]) ==
+                    (3, 1))
+            assert(result["seconds"] >= 0.2)
+        assert("compared 4 models" in values["notice"])
+    assert(set(apiManager.priorities) == {scheduler.INTERACTIVE})
+
+def testAFailingModelOnlySpoilsItsOwnResult(flaskApp):
+    for run in (syncCompare, asyncCompare):
+        comparison = compare(flaskApp, ["davinci", "broken", "curie"],
+                run)["comparison"]
+        assert([result["error"] for result in comparison] ==
+                [None, "model broken", None])
+        assert(comparison[1]["text"] == "")
+        assert(comparison[2]["text"] == "Hello")
+
+def testCompareTakesEachModelOnceUpToMaxModels(flaskApp):
+    models = ["m{}".format(i) for i in range(12)]
+    comparison = compare(flaskApp, ["davinci", "davinci"] + models,
+            syncCompare)["comparison"]
+    assert([result["model"] for result in comparison] ==
+            ["davinci"] + models[:7])
+    values = compare(flaskApp, [], asyncCompare)
+    assert(values["notice"] == "pick the models to compare")
+    assert("comparison" not in values)
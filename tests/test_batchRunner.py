@@ -0,0 +1,93 @@
+import json
+
+from batchRunner import BatchRunner, readBatches, resumePoint
+
+
+class FailingApi:
+    '''
+    completes prompts by upper casing them, but fails any request with a
+    prompt containing "bad"
+    '''
+
+    def __init__(self):
+        self.requests = []
+
+    def promptBatch(self, prompts, **kwargs):
+        self.requests.append(list(prompts))
+        if any("bad" in prompt for prompt in prompts):
+            raise RuntimeError("bad prompt")
+        return ([prompt.upper() for prompt in prompts],
+                {"total_tokens": len(prompts)})
+
+def writePrompts(path, prompts):
+    path.write_text("".join(json.dumps({"prompt": prompt}) + "\n"
+            for prompt in prompts))
+
+def readRecords(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def testReadBatchesSkipsBadLines(tmp_path, capsys):
+    inputPath = tmp_path / "prompts.jsonl"
+    inputPath.write_text('{"prompt": "a"}\nnot json\n\n{"other": 1}\n[1]\n'
+            '{"prompt": "b"}\n{"prompt": "c"}\n')
+    batches = list(readBatches(str(inputPath), 2, 0))
+    assert(batches == [[(0, "a"), (5, "b")], [(6, "c")]])
+    warnings = capsys.readouterr().err
+    for lineNumber in (1, 3, 4):
+        assert("skipping line {}:".format(lineNumber) in warnings)
+
+def testReadBatchesSkipsWhatIsDone(tmp_path):
+    inputPath = tmp_path / "prompts.jsonl"
+    inputPath.write_text("".join('{{"prompt": "{}"}}\n'.format(i)
+            for i in range(5)))
+    assert(list(readBatches(str(inputPath), 10, 3)) == [[(3, "3"), (4, "4")]])
+
+def testResumePointDropsAHalfWrittenLine(tmp_path):
+    outputPath = tmp_path / "completions.jsonl"
+    assert(resumePoint(str(outputPath)) == 0)
+    outputPath.write_text('{"line": 0}\n{"line": 4}\n{"line": 5, "pro')
+    assert(resumePoint(str(outputPath)) == 5)
+    assert(outputPath.read_text() == '{"line": 0}\n{"line": 4}\n')
+
+def testResumePointStopsAtALineWithoutItsNumber(tmp_path):
+    outputPath = tmp_path / "completions.jsonl"
+    outputPath.write_text('{"line": 2}\n{"prompt": "x"}\n[3]\n')
+    assert(resumePoint(str(outputPath)) == 3)
+
+def testReadBatchesSkipsPromptsThatArentStrings(tmp_path, capsys):
+    inputPath = tmp_path / "prompts.jsonl"
+    inputPath.write_text('{"prompt": 1}\n{"prompt": null}\n{"prompt": "a"}\n')
+    assert(list(readBatches(str(inputPath), 10, 0)) == [[(2, "a")]])
+    warnings = capsys.readouterr().err
+    assert("skipping line 0:" in warnings)
+    assert("skipping line 1:" in warnings)
+
+def testAFailingPromptDoesNotStopTheRun(tmp_path):
+    inputPath = tmp_path / "prompts.jsonl"
+    outputPath = tmp_path / "completions.jsonl"
+    writePrompts(inputPath, ["a", "bad", "c", "d", "e"])
+    apiManager = FailingApi()
+    runner = BatchRunner(apiManager, "davinci", batchSize=2, concurrency=2)
+    runner.run(str(inputPath), str(outputPath))
+    records = readRecords(outputPath)
+    assert([record["line"] for record in records] == [0, 1, 2, 3, 4])
+    assert(records[0]["completion"] == "A")
+    assert(records[1]["error"] == "RuntimeError('bad prompt')")
+    assert("completion" not in records[1])
+    assert([record["completion"] for record in records[2:]] == ["C", "D", "E"])
+    #the failed batch was retried a prompt at a time
+    assert(apiManager.requests.count(["a", "bad"]) == 1)
+    assert(["a"] in apiManager.requests and ["bad"] in apiManager.requests)
+    assert((runner.prompts, runner.errors, runner.tokens) == (5, 1, 4))
+
+def testAResumedRunTreatsErrorsAsDone(tmp_path):
+    inputPath = tmp_path / "prompts.jsonl"
+    outputPath = tmp_path / "completions.jsonl"
+    writePrompts(inputPath, ["a", "bad"])
+    BatchRunner(FailingApi(), "davinci").run(str(inputPath), str(outputPath))
+    writePrompts(inputPath, ["a", "bad", "c"])
+    apiManager = FailingApi()
+    BatchRunner(apiManager, "davinci").run(str(inputPath), str(outputPath))
+    assert(apiManager.requests == [["c"]])
+    assert([record["line"] for record in readRecords(outputPath)] == [0, 1, 2])
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+from completionCache import CompletionCache
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "completions.sqlite")
+
+def response(text):
+    return {"choices": [{"text": text}], "usage": {"total_tokens": 3}}
+
+
+def testKeyTellsRequestsApart():
+    key = CompletionCache.key("davinci", "hi", 16, 0)
+    assert(key == CompletionCache.key("davinci", "hi", 16, 0.0))
+    for other in (("curie", "hi", 16, 0), ("davinci", "ho", 16, 0),
+            ("davinci", "hi", 32, 0), ("davinci", "hi", 16, 0.5)):
+        assert(CompletionCache.key(*other) != key)
+
+def testMissThenMemoryHit(path):
+    cache = CompletionCache(path)
+    key = CompletionCache.key("davinci", "hi", 16, 0)
+    assert(cache.get(key) is None)
+    cache.put(key, "davinci", response("there"))
+    assert(cache.get(key) == response("there"))
+    stats = cache.getStats()
+    assert((stats["misses"], stats["memoryHits"], stats["diskHits"]) ==
+            (1, 1, 0))
+
+def testDiskTierSurvivesARestart(path):
+    key = CompletionCache.key("davinci", "hi", 16, 0)
+    CompletionCache(path).put(key, "davinci", response("there"))
+    cache = CompletionCache(path)
+    assert(cache.get(key) == response("there"))
+    assert(cache.getStats()["diskHits"] == 1)
+    #and is in memory from then on
+    cache.get(key)
+    assert(cache.getStats()["memoryHits"] == 1)
+
+def testMemoryTierIsBounded(path):
+    cache = CompletionCache(path, memoryEntries=2)
+    keys = [CompletionCache.key("davinci", str(i), 16, 0) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, "davinci", response(str(i)))
+    assert(cache.getStats()["memoryEntries"] == 2)
+    #the oldest fell back to disk
+    assert(cache.get(keys[0]) == response("0"))
+    assert(cache.getStats()["diskHits"] == 1)
+
+def testInvalidateModel(path):
+    cache = CompletionCache(path)
+    mine = CompletionCache.key("davinci:ft-1", "hi", 16, 0)
+    other = CompletionCache.key("davinci", "hi", 16, 0)
+    cache.put(mine, "davinci:ft-1", response("a"))
+    cache.put(other, "davinci", response("b"))
+    cache.invalidateModel("davinci:ft-1")
+    assert(cache.get(mine) is None)
+    assert(CompletionCache(path).get(mine) is None)
+    assert(cache.get(other) == response("b"))
+    assert(cache.getStats()["diskBytes"] == len(json.dumps(response("b"))))
+
+def testDiskTierIsTrimmedLeastRecentlyUsedFirst(path):
+    size = len(json.dumps(response("0")))
+    cache = CompletionCache(path, memoryEntries=1, maxDiskBytes=2 * size)
+    keys = [CompletionCache.key("davinci", str(i), 16, 0) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, "davinci", response(str(i)))
+    assert(cache.getStats()["diskBytes"] <= 2 * size)
+    assert(CompletionCache(path).get(keys[0]) is None)
+    assert(CompletionCache(path).get(keys[2]) == response("2"))
+
+def testReplacingAnEntryDoesNotCountItTwice(path):
+    cache = CompletionCache(path)
+    key = CompletionCache.key("davinci", "hi", 16, 0)
+    cache.put(key, "davinci", response("a"))
+    cache.put(key, "davinci", response("b"))
+    assert(cache.getStats()["diskBytes"] == len(json.dumps(response("b"))))
+    assert(cache.get(key) == response("b"))
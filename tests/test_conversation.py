@@ -0,0 +1,152 @@
+import time
+import uuid
+
+from conversation import ContextWindow, ConversationStore, Turn
+from conversationLog import ConversationLog
+
+
+class WordTokenizer:
+    '''
+    a token per word, so budgets are easy to count out
+    '''
+
+    def countTokens(self, text):
+        return len(text.split())
+
+    def truncateLeft(self, text, budget):
+        return " ".join(text.split()[-budget:])
+
+
+def window(maxTokens):
+    return ContextWindow(maxTokens, WordTokenizer())
+
+def sessions(store):
+    return list(store._sessions)
+
+
+def testLeastRecentlyUsedSessionsAreDroppedFirst():
+    store = ConversationStore(maxSessions=2)
+    store.append("a", "p", "r")
+    store.append("b", "p", "r")
+    #reading a makes b the least recently used
+    store.getConversation("a")
+    store.append("c", "p", "r")
+    assert(sessions(store) == ["a", "c"])
+    assert(store.getConversation("b") == [])
+
+def testIdleSessionsExpire():
+    store = ConversationStore(idleSeconds=0.05)
+    store.append("a", "p", "r")
+    time.sleep(0.1)
+    store.append("b", "p", "r")
+    assert(sessions(store) == ["b"])
+
+def testSessionsStayWithinTheByteBudget():
+    turnBytes = Turn("p" * 100, "r", 0).size()
+    store = ConversationStore(maxBytes=3 * turnBytes)
+    for i in range(10):
+        store.append(str(i), "p" * 100, "r")
+    count, size = store.size()
+    assert(count == 3)
+    assert(size <= 3 * turnBytes)
+    assert(sessions(store) == ["7", "8", "9"])
+
+def testTheNewestSessionIsKeptEvenIfTooBig():
+    store = ConversationStore(maxBytes=10)
+    store.append("a", "p" * 100, "r")
+    assert(store.getConversation("a") == [("p" * 100, "r")])
+
+def testReadingUnknownSessionsKeepsNothing():
+    store = ConversationStore(maxSessions=5)
+    for _ in range(1000):
+        sessionId = uuid.uuid4().hex
+        assert(store.getConversation(sessionId) == [])
+        assert(store.feed(sessionId, 100) == "")
+    assert(store.size() == (0, 0))
+
+def testFeedKeepsSessionsWithinMaxSessions():
+    store = ConversationStore(maxSessions=5)
+    for i in range(20):
+        store.append(str(i), "p", "r")
+        store.feed(str(i), 100)
+    assert(store.size()[0] == 5)
+
+def testClear():
+    store = ConversationStore()
+    store.append("a", "hello", "there")
+    assert(store.getConversation("a") == [("hello", "there")])
+    store.clear("a")
+    assert(store.getConversation("a") == [])
+    assert(store.size() == (0, 0))
+
+def testReadsThroughABackendStayBounded(tmp_path):
+    backend = ConversationLog(str(tmp_path / "conversations"))
+    store = ConversationStore(maxSessions=5, backend=backend)
+    for _ in range(1000):
+        assert(store.getConversation(uuid.uuid4().hex) == [])
+    assert(store.size() == (0, 0))
+    assert(store._versions == {})
+    #sessions the backend has are loaded, up to maxSessions
+    for i in range(10):
+        backend.append("session{}".format(i), "p", "r", 1, 100)
+    for i in range(10):
+        assert(store.getConversation("session{}".format(i)) == [("p", "r")])
+    assert(store.size()[0] == 5)
+
+def testSessionsFollowTheBackendAcrossStores(tmp_path):
+    backend = ConversationLog(str(tmp_path / "conversations"))
+    first = ConversationStore(backend=backend)
+    second = ConversationStore(backend=backend)
+    first.append("abc", "one", "1")
+    assert(second.getConversation("abc") == [("one", "1")])
+    second.append("abc", "two", "2")
+    assert(first.getConversation("abc") == [("two", "2"), ("one", "1")])
+
+def testTurnsAreCountedOnceWithTheirSeparators():
+    history = window(100)
+    history.append("one two", "three")
+    #two newlines join a turn into the feed
+    assert(history.tokenCount() == 5)
+    assert(history.size() == Turn("one two", "three", 5).size())
+    assert(history.turns() == [("one two", "three")])
+
+def testOldestTurnsAreEvictedPastMaxTokens():
+    history = window(10)
+    for i in range(5):
+        history.append("p{}".format(i), "r{}".format(i))
+    #4 tokens a turn, so two fit
+    assert(history.turns() == [("p3", "r3"), ("p4", "r4")])
+    assert(history.tokenCount() == 8)
+
+def testTheNewestTurnIsKeptEvenIfTooBig():
+    history = window(5)
+    history.append("a", "b")
+    history.append("many words " * 5, "reply")
+    assert(len(history.turns()) == 1)
+    assert(history.tokenCount() == 13)
+    history.append("a", "b")
+    assert(history.turns() == [("a", "b")])
+
+def testFeedHoldsTheNewestTurnsThatFit():
+    history = window(100)
+    for i in range(5):
+        history.append("p{}".format(i), "r{}".format(i))
+    assert(history.feed(100) == "\n".join("p{0}\nr{0}".format(i)
+            for i in range(5)))
+    assert(history.feed(9) == "p3\nr3\np4\nr4")
+    #feeding doesn't evict
+    assert(len(history.turns()) == 5)
+
+def testFeedKeepsTheEndOfANewestTurnThatDoesNotFit():
+    history = window(100)
+    history.append("one two three", "four five")
+    assert(history.feed(3) == "three four five")
+    assert(history.feed(0) == "")
+    assert(window(100).feed(10) == "")
+
+def testClearForgetsEverything():
+    history = window(100)
+    history.append("p", "r")
+    history.clear()
+    assert(history.turns() == [] and history.feed(100) == "")
+    assert((history.tokenCount(), history.size()) == (0, 0))
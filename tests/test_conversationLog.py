@@ -0,0 +1,84 @@
+import os
+import time
+
+import pytest
+
+from conversationLog import ConversationLog
+
+
+@pytest.fixture
+def log(tmp_path):
+    return ConversationLog(str(tmp_path / "conversations"), historyTokens=10)
+
+
+def testAppendsAndLoadsInOrder(log):
+    assert(log.version("abc") == 0)
+    assert(log.load("abc") == (0, []))
+    assert(log.append("abc", "hi", "hello", 2, 100) == (0, 1))
+    assert(log.append("abc", "how are you", "fine", 4, 100) == (1, 2))
+    assert(log.version("abc") == 2)
+    assert(log.load("abc") == (2, [("hi", "hello", 2),
+            ("how are you", "fine", 4)]))
+
+def testLoadTrimsToTheNewestTurnsWithinHistoryTokens(log):
+    for i in range(5):
+        log.append("abc", "p{}".format(i), "r{}".format(i), 4, 100)
+    version, turns = log.load("abc")
+    assert(version == 5)
+    assert([prompt for prompt, _, _ in turns] == ["p3", "p4"])
+
+def testNewestTurnIsLoadedEvenIfTooBig(log):
+    log.append("abc", "small", "turn", 1, 100)
+    log.append("abc", "big", "turn", 50, 100)
+    assert(log.load("abc")[1] == [("big", "turn", 50)])
+
+def testSessionsAreKeptApart(log):
+    log.append("abc", "mine", "a", 1, 100)
+    log.append("abd", "yours", "b", 1, 100)
+    assert(log.load("abc")[1] == [("mine", "a", 1)])
+    assert(log.load("abd")[1] == [("yours", "b", 1)])
+
+def testClear(log):
+    log.append("abc", "hi", "hello", 2, 100)
+    log.clear("abc")
+    assert(log.load("abc") == (0, []))
+    #clearing nothing is fine
+    log.clear("abc")
+
+def testUnicodeRoundTrips(log):
+    log.append("abc", "héllo 😀", "ça va\n", 3, 100)
+    assert(log.load("abc")[1] == [("héllo 😀", "ça va\n", 3)])
+
+def testATornIndexEntryIsDropped(log, tmp_path):
+    log.append("abc", "one", "1", 1, 100)
+    indexPath = tmp_path / "conversations" / "ab" / "abc.idx"
+    with open(indexPath, "ab") as index:
+        #half an entry, as a crash mid write leaves it
+        index.write(b"\0\0\0")
+    assert(log.append("abc", "two", "2", 1, 100) == (1, 2))
+    assert(log.load("abc")[1] == [("one", "1", 1), ("two", "2", 1)])
+
+def testARecordWithoutIndexEntryIsIgnored(log, tmp_path):
+    log.append("abc", "one", "1", 1, 100)
+    logPath = tmp_path / "conversations" / "ab" / "abc.log"
+    with open(logPath, "ab") as file:
+        #a record written just before a crash, whose entry never was
+        file.write(b"\0\0\0\5\0\0\0\1[1,2]")
+    log.append("abc", "two", "2", 1, 100)
+    assert(log.load("abc")[1] == [("one", "1", 1), ("two", "2", 1)])
+
+def testBadSessionIdsAreRefused(log):
+    for sessionId in ("", "../etc", ".hidden", "a/b"):
+        with pytest.raises(AssertionError):
+            log.append(sessionId, "p", "r", 1, 100)
+
+def testIdleLogsExpire(tmp_path):
+    log = ConversationLog(str(tmp_path / "conversations"), idleSeconds=60.0,
+            expireEvery=0.0)
+    log.append("old", "p", "r", 1, 100)
+    hourAgo = time.time() - 3600
+    for name in ("old.log", "old.idx"):
+        os.utime(tmp_path / "conversations" / "ol" / name, (hourAgo, hourAgo))
+    log.append("new", "p", "r", 1, 100)
+    assert(log.version("old") == 0)
+    assert(log.version("new") == 1)
@@ -0,0 +1,94 @@
+import json
+
+from dataset import (BloomFilter, DatasetReport, ExactSet, ShardWriter,
+        main, preprocess, trainingCost)
+
+
+def example(prompt, completion=" done"):
+    return json.dumps({"prompt": prompt, "completion": completion}).encode(
+            "utf-8") + b"\n"
+
+
+def testInvalidLinesAreReportedWithTheirNumbers():
+    lines = [example("a"), b"not json\n", b"[1]\n",
+            b'{"prompt": "a"}\n', b'{"prompt": 1, "completion": "x"}\n',
+            b'{"prompt": "a", "completion": ""}\n',
+            b'{"prompt": "a", "completion": "x", "extra": 1}\n', b"\n"]
+    report = DatasetReport()
+    assert(list(preprocess(lines, report, countTokens=False)) ==
+            [example("a")])
+    assert((report.lines, report.valid, report.invalid) == (7, 1, 6))
+    assert([error.split(":")[0] for error in report.errors] ==
+            ["line {}".format(i) for i in range(2, 8)])
+    assert("invalid json" in report.errors[0])
+    assert("not a json object" in report.errors[1])
+    assert("empty completion" in report.errors[4])
+
+def testOnlySoManyErrorsAreKept():
+    report = DatasetReport()
+    list(preprocess([b"bad\n"] * 50, report))
+    assert(report.invalid == 50)
+    assert(len(report.errors) == DatasetReport.MAX_ERRORS)
+
+def testDuplicatesAreDropped():
+    lines = [example("a"), example("b"), example("a"), example("a", " x"),
+            example("b")]
+    for dedup in ("exact", "bloom"):
+        report = DatasetReport()
+        assert(list(preprocess(lines, report, dedup=dedup,
+                countTokens=False)) == lines[:2] + [lines[3]])
+        assert(report.duplicates == 2)
+    report = DatasetReport()
+    assert(len(list(preprocess(lines, report, dedup=None,
+            countTokens=False))) == 5)
+
+def testBloomFilterHasFewFalsePositives():
+    bloom = BloomFilter(capacity=1000, errorRate=0.01)
+    exact = ExactSet()
+    for i in range(900):
+        data = str(i).encode()
+        assert(not exact.add(data))
+        bloom.add(data)
+    #whatever was added is always found
+    assert(all(bloom.add(str(i).encode()) for i in range(900)))
+    assert(exact.add(b"899"))
+    #adding the probes too keeps the filter within capacity, where about 1 in
+    #100 is a false positive
+    falsePositives = sum(bloom.add("other{}".format(i).encode())
+            for i in range(100))
+    assert(falsePositives < 10)
+
+def testTokensAndCostAreCounted():
+    report = DatasetReport()
+    list(preprocess([example("hello world", " hi")], report))
+    assert(report.promptTokens == 2 and report.completionTokens == 1)
+    assert(report.maxExampleTokens == 3)
+    assert(report.estimatedCost("curie:ft-x") == trainingCost(3, "curie"))
+    assert(trainingCost(1000, "davinci", epochs=1) == 0.03)
+    assert(trainingCost(1000, "gpt-unknown") is None)
+    assert("about $" in report.summary("curie"))
+    assert("about $" not in report.summary("gpt-unknown"))
+
+def testShardsSplitEveryShardLines(tmp_path):
+    writer = ShardWriter(str(tmp_path / "clean.jsonl"), shardLines=2)
+    for i in range(5):
+        writer.write(example(str(i)))
+    paths = writer.close()
+    assert([path.split("/")[-1] for path in paths] == ["clean-00000.jsonl",
+            "clean-00001.jsonl", "clean-00002.jsonl"])
+    assert([len(open(path).readlines()) for path in paths] == [2, 2, 1])
+    writer = ShardWriter(str(tmp_path / "one.jsonl"))
+    writer.write(example("a"))
+    assert(writer.close() == [str(tmp_path / "one.jsonl")])
+
+def testMainWritesTheCleanLinesAndTheReport(tmp_path, capsys):
+    inputPath = tmp_path / "train.jsonl"
+    inputPath.write_bytes(example("a") + example("a") + example("b"))
+    outputPath = tmp_path / "clean.jsonl"
+    assert(main([str(inputPath), "--output", str(outputPath)]) == 0)
+    assert(outputPath.read_bytes() == example("a") + example("b"))
+    result = json.loads(capsys.readouterr().out)
+    assert((result["valid"], result["duplicates"]) == (2, 1))
+    assert(result["outputs"] == [str(outputPath)])
+    inputPath.write_bytes(example("a") + b"oops\n")
+    assert(main([str(inputPath), "--noTokens"]) == 1)
@@ -0,0 +1,153 @@
+import time
+import threading
+
+import scheduler
+from fineTuneTracker import FineTuneTracker
+
+
+class FakeFineTunes:
+    '''
+    the fine tune calls of ApiManager, over jobs and events the test edits
+    '''
+
+    def __init__(self, *statuses):
+        self.jobs = {"ft-{}".format(i): {"id": "ft-{}".format(i),
+                "status": status} for i, status in enumerate(statuses)}
+        self.events = {jobId: [] for jobId in self.jobs}
+        self.calls = []
+        self.priorities = set()
+        self.failing = False
+
+    def _call(self, name):
+        self.calls.append(name)
+        self.priorities.add(scheduler.currentPriority())
+        if self.failing:
+            raise RuntimeError("api down")
+
+    def listFineTunes(self):
+        self._call("listFineTunes")
+        return {"data": [dict(job) for job in self.jobs.values()]}
+
+    def listFineTuneEvents(self, jobId):
+        self._call("listFineTuneEvents")
+        return {"data": list(self.events[jobId])}
+
+    def getFineTune(self, jobId):
+        self._call("getFineTune")
+        return dict(self.jobs[jobId])
+
+    def progress(self, jobId, status, message):
+        self.jobs[jobId]["status"] = status
+        self.events[jobId].append({"message": message})
+
+
+def interval(tracker, jobId):
+    return tracker._schedule[jobId][1]
+
+
+def testSyncSchedulesOnlyUnfinishedJobs():
+    api = FakeFineTunes("pending", "succeeded", "running")
+    tracker = FineTuneTracker(api)
+    assert([job["id"] for job in tracker.getFineTunes()] ==
+            ["ft-0", "ft-1", "ft-2"])
+    assert(set(tracker._schedule) == {"ft-0", "ft-2"})
+    #the table was filled, so reading it doesn't list again
+    tracker.getFineTunes()
+    assert(api.calls == ["listFineTunes"])
+
+def testSyncDropsJobsTheApiNoLongerLists():
+    api = FakeFineTunes("pending", "pending")
+    tracker = FineTuneTracker(api)
+    tracker.sync()
+    version = tracker.getVersion()
+    del api.jobs["ft-1"]
+    tracker.sync()
+    assert([job["id"] for job in tracker.getFineTunes()] == ["ft-0"])
+    assert("ft-1" not in tracker._schedule)
+    assert(tracker.getVersion() != version)
+    #nothing changed, nor does the version
+    version = tracker.getVersion()
+    tracker.sync()
+    assert(tracker.getVersion() == version)
+
+def testQuietPollsBackOffUpToMaxInterval():
+    api = FakeFineTunes("running")
+    tracker = FineTuneTracker(api, minInterval=1.0, maxInterval=5.0)
+    tracker.sync()
+    intervals = []
+    for _ in range(5):
+        tracker._poll("ft-0")
+        intervals.append(interval(tracker, "ft-0"))
+    assert(intervals == [2.0, 4.0, 5.0, 5.0, 5.0])
+    #no new events, so the job itself was never fetched again
+    assert("getFineTune" not in api.calls)
+
+def testNewEventsAreReadOnceAndResetTheInterval():
+    api = FakeFineTunes("pending")
+    tracker = FineTuneTracker(api, minInterval=1.0, maxInterval=8.0)
+    changes = []
+    tracker.addListener(changes.append)
+    tracker.sync()
+    tracker._poll("ft-0")
+    tracker._poll("ft-0")
+    api.progress("ft-0", "running", "started")
+    version = tracker.getVersion()
+    tracker._poll("ft-0")
+    assert(interval(tracker, "ft-0") == 1.0)
+    assert(tracker.getEvents("ft-0") == [{"message": "started"}])
+    assert(tracker.getFineTunes()[0]["status"] == "running")
+    assert(tracker.getVersion() != version)
+    assert([job["status"] for job in changes] == ["running"])
+    api.progress("ft-0", "running", "epoch 1")
+    tracker._poll("ft-0")
+    assert(tracker.getEvents("ft-0") == [{"message": "started"},
+            {"message": "epoch 1"}])
+    #the status didn't change, so the listeners weren't told
+    assert(len(changes) == 1)
+    assert(api.calls.count("getFineTune") == 2)
+
+def testFinishedJobsAreNoLongerPolled():
+    api = FakeFineTunes("running")
+    tracker = FineTuneTracker(api)
+    tracker.sync()
+    api.progress("ft-0", "succeeded", "done")
+    tracker._poll("ft-0")
+    assert(tracker._schedule == {})
+
+def testAFailedPollBacksOff(capsys):
+    api = FakeFineTunes("running")
+    tracker = FineTuneTracker(api, minInterval=1.0)
+    tracker.sync()
+    api.failing = True
+    tracker._poll("ft-0")
+    assert(interval(tracker, "ft-0") == 2.0)
+    assert("polling fine tune ft-0 failed" in capsys.readouterr().out)
+
+def testAFailingListenerDoesNotStopTheOthers(capsys):
+    api = FakeFineTunes()
+    tracker = FineTuneTracker(api)
+    def fail(job):
+        raise ValueError("listener bug")
+    changes = []
+    tracker.addListener(fail)
+    tracker.addListener(changes.append)
+    tracker.track({"id": "ft-new", "status": "pending"})
+    assert([job["id"] for job in changes] == ["ft-new"])
+    assert("fine tune listener failed" in capsys.readouterr().out)
+
+def testThePollingThreadFollowsAJobToTheEnd():
+    api = FakeFineTunes("running")
+    tracker = FineTuneTracker(api, minInterval=0.01, maxInterval=0.02)
+    finished = threading.Event()
+    tracker.addListener(lambda job: finished.set()
+            if job["status"] == "succeeded" else None)
+    tracker.start()
+    try:
+        time.sleep(0.05)
+        api.progress("ft-0", "succeeded", "done")
+        assert(finished.wait(2.0))
+    finally:
+        tracker.stop()
+    assert(tracker._schedule == {})
+    #its calls wait behind everybody else's
+    assert(api.priorities == {scheduler.BACKGROUND})
@@ -0,0 +1,141 @@
+import time
+import asyncio
+
+import pytest
+
+from metrics import MetricsRegistry, SlowRequestSampler, timed
+
+
+def lines(registry):
+    return registry.render().splitlines()
+
+
+def testCountersAndGaugesRender():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "requests", ["endpoint"])
+    inFlight = registry.gauge("in_flight", "requests running")
+    requests.inc(endpoint="main")
+    requests.inc(2, endpoint="main")
+    requests.inc(endpoint='say "hi"\n')
+    with inFlight.track():
+        assert("in_flight 1" in lines(registry))
+    assert(lines(registry) == [
+            "# HELP requests_total requests",
+            "# TYPE requests_total counter",
+            'requests_total{endpoint="main"} 3',
+            'requests_total{endpoint="say \\"hi\\"\\n"} 1',
+            "# HELP in_flight requests running",
+            "# TYPE in_flight gauge",
+            "in_flight 0"])
+
+def testLabelsMustMatch():
+    registry = MetricsRegistry()
+    requests = registry.counter("requests_total", "requests", ["endpoint"])
+    with pytest.raises(AssertionError):
+        requests.inc()
+    with pytest.raises(AssertionError):
+        requests.inc(endpoint="main", method="GET")
+
+def testAMetricIsMadeOnce():
+    registry = MetricsRegistry()
+    first = registry.counter("requests_total", "requests")
+    assert(registry.counter("requests_total", "requests") is first)
+    with pytest.raises(AssertionError):
+        registry.gauge("requests_total", "requests")
+
+def testHistogramBucketsAreCumulative():
+    registry = MetricsRegistry()
+    seconds = registry.histogram("seconds", "latency", ["method"],
+            buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        seconds.observe(value, method="get")
+    assert(lines(registry)[2:] == [
+            'seconds_bucket{method="get",le="0.1"} 1',
+            'seconds_bucket{method="get",le="1.0"} 3',
+            'seconds_bucket{method="get",le="+Inf"} 4',
+            'seconds_sum{method="get"} 6.25',
+            'seconds_count{method="get"} 4'])
+
+def testCollectorsRunBeforeEveryRender(capsys):
+    registry = MetricsRegistry()
+    hits = registry.counter("hits_total", "hits")
+    source = {"hits": 0}
+    registry.addCollector(lambda: hits.set(source["hits"]))
+    registry.addCollector(lambda: 1 / 0)
+    source["hits"] = 7
+    assert("hits_total 7" in lines(registry))
+    assert("metrics collector failed" in capsys.readouterr().out)
+
+def count(registry, name, labels=""):
+    for line in lines(registry):
+        if line.startswith("{}_count{} ".format(name, labels)):
+            return int(line.split()[1])
+    return 0
+
+def testTimedObservesEveryKindOfFunction():
+    registry = MetricsRegistry()
+    seconds = registry.histogram("seconds", "latency", ["kind"])
+
+    @timed(seconds, kind="function")
+    def function():
+        time.sleep(0.01)
+        return 1
+
+    @timed(seconds, kind="generator")
+    def generator():
+        yield 1
+        time.sleep(0.01)
+        yield 2
+
+    @timed(seconds, kind="coroutine")
+    async def coroutine():
+        await asyncio.sleep(0.01)
+        return 3
+
+    @timed(seconds, kind="asyncGenerator")
+    async def asyncGenerator():
+        yield 4
+        await asyncio.sleep(0.01)
+        yield 5
+
+    async def drain():
+        return [item async for item in asyncGenerator()]
+
+    assert(function() == 1)
+    #a generator is timed until it is exhausted
+    items = generator()
+    assert(next(items) == 1)
+    assert(count(registry, "seconds", '{kind="generator"}') == 0)
+    assert(list(items) == [2])
+    assert(asyncio.run(coroutine()) == 3)
+    assert(asyncio.run(drain()) == [4, 5])
+    for kind in ("function", "generator", "coroutine", "asyncGenerator"):
+        assert(count(registry, "seconds",
+                '{{kind="{}"}}'.format(kind)) == 1)
+    for line in lines(registry):
+        if line.startswith("seconds_sum"):
+            assert(float(line.split()[1]) >= 0.01)
+
+def testTimedObservesCallsThatFail():
+    registry = MetricsRegistry()
+    seconds = registry.histogram("seconds", "latency")
+
+    @timed(seconds)
+    def fail():
+        raise ValueError("no")
+
+    with pytest.raises(ValueError):
+        fail()
+    assert(count(registry, "seconds") == 1)
+
+def testSlowRequestsAreSampled():
+    sampler = SlowRequestSampler(thresholdSeconds=0.05, interval=0.005)
+    assert(sampler.end(sampler.begin("fast")) is None)
+    token = sampler.begin("slow")
+    time.sleep(0.15)
+    report = sampler.end(token)
+    assert(report["name"] == "slow" and report["seconds"] >= 0.15)
+    assert(report["samples"] > 0)
+    #the stacks are those of this thread, sleeping in this test
+    assert("testSlowRequestsAreSampled" in report["stacks"][0][0])
+    assert(sampler.getReports() == [report])
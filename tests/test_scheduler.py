@@ -0,0 +1,113 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+import scheduler
+from scheduler import ApiScheduler, SchedulerBusyError, TokenBucket
+
+
+def testBucketHoldsBurstSecondsOfBudget():
+    bucket = TokenBucket(60, burstSeconds=2.0)
+    assert(bucket.capacity == 2.0)
+    assert(bucket.delay(2) == 0.0)
+    bucket.take(2)
+    assert(bucket.delay(1) == pytest.approx(1.0, abs=0.05))
+
+def testBucketKeepsTheReserve():
+    bucket = TokenBucket(600, burstSeconds=1.0)
+    bucket.take(5)
+    assert(bucket.delay(4) == 0.0)
+    assert(bucket.delay(4, reserve=0.2) > 0.0)
+
+def testMoreThanTheCapacityCountsAsAllOfIt():
+    bucket = TokenBucket(600, burstSeconds=1.0)
+    assert(bucket.delay(1000) == 0.0)
+
+def testReserveNeverAsksForMoreThanTheBucketHolds():
+    bucket = TokenBucket(6, burstSeconds=10.0)
+    assert(bucket.capacity == 1.0)
+    assert(bucket.delay(1, reserve=0.2) == 0.0)
+
+def testPriorityHoldsPerContext():
+    assert(scheduler.currentPriority() == scheduler.NORMAL)
+    with scheduler.priority(scheduler.BACKGROUND):
+        assert(scheduler.currentPriority() == scheduler.BACKGROUND)
+        seen = []
+        thread = threading.Thread(
+                target=lambda: seen.append(scheduler.currentPriority()))
+        thread.start()
+        thread.join()
+        assert(seen == [scheduler.NORMAL])
+    assert(scheduler.currentPriority() == scheduler.NORMAL)
+
+def testInteractiveCallsGoFirst():
+    #ten requests a second, one at a time
+    apiScheduler = ApiScheduler(requestsPerMinute=600, burstSeconds=0.1,
+            reserve=0.0)
+    apiScheduler.acquire()
+    order = []
+    def call(level):
+        with scheduler.priority(level):
+            apiScheduler.acquire()
+        order.append(level)
+    threads = []
+    for level in (scheduler.BACKGROUND, scheduler.NORMAL,
+            scheduler.INTERACTIVE):
+        threads.append(threading.Thread(target=call, args=(level,)))
+        threads[-1].start()
+        time.sleep(0.02)
+    for thread in threads:
+        thread.join()
+    assert(order == [scheduler.INTERACTIVE, scheduler.NORMAL,
+            scheduler.BACKGROUND])
+
+def testPacesToTheRate():
+    apiScheduler = ApiScheduler(requestsPerMinute=600, burstSeconds=0.1)
+    start = time.monotonic()
+    with scheduler.priority(scheduler.INTERACTIVE):
+        for _ in range(4):
+            apiScheduler.acquire()
+    #the first goes right away, the others a tenth of a second apart
+    assert(time.monotonic() - start == pytest.approx(0.3, abs=0.08))
+
+def testTokensArePacedToo():
+    apiScheduler = ApiScheduler(tokensPerMinute=6000, burstSeconds=1.0)
+    start = time.monotonic()
+    with scheduler.priority(scheduler.INTERACTIVE):
+        apiScheduler.acquire(tokens=100)
+        apiScheduler.acquire(tokens=20)
+    assert(time.monotonic() - start == pytest.approx(0.2, abs=0.08))
+
+def testShedsWhenTheQueueIsFull():
+    apiScheduler = ApiScheduler(maxQueued={scheduler.BACKGROUND: 0})
+    with scheduler.priority(scheduler.BACKGROUND):
+        with pytest.raises(SchedulerBusyError):
+            apiScheduler.acquire()
+    apiScheduler.acquire()
+
+def testShedsAfterMaxWait():
+    apiScheduler = ApiScheduler(requestsPerMinute=6, burstSeconds=0.1,
+            maxWait={scheduler.NORMAL: 0.05})
+    apiScheduler.acquire()
+    start = time.monotonic()
+    with pytest.raises(SchedulerBusyError):
+        apiScheduler.acquire()
+    assert(time.monotonic() - start < 0.5)
+
+def testAsyncCallsShareTheQueue():
+    apiScheduler = ApiScheduler(requestsPerMinute=600, burstSeconds=0.1,
+            reserve=0.0)
+    apiScheduler.acquire()
+    order = []
+    async def call(level, delay):
+        await asyncio.sleep(delay)
+        with scheduler.priority(level):
+            await apiScheduler.aacquire()
+        order.append(level)
+    async def run():
+        await asyncio.gather(call(scheduler.BACKGROUND, 0.0),
+                call(scheduler.INTERACTIVE, 0.02))
+    asyncio.run(run())
+    assert(order == [scheduler.INTERACTIVE, scheduler.BACKGROUND])
@@ -0,0 +1,127 @@
+import sqlite3
+import threading
+
+import pytest
+
+from sharedState import SharedStore, SharedDict, SqliteConversationBackend
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "shared.sqlite")
+
+
+def testPutGetDelete(path):
+    store = SharedStore(path)
+    assert(store.get("ns", "a") is None)
+    assert(store.get("ns", "a", 7) == 7)
+    store.put("ns", "a", {"x": [1, 2]})
+    assert(store.get("ns", "a") == {"x": [1, 2]})
+    store.delete("ns", "a")
+    assert(store.get("ns", "a") is None)
+
+def testEveryWriteMovesTheVersion(path):
+    store = SharedStore(path)
+    assert(store.version("ns") == 0)
+    store.put("ns", "a", 1)
+    first = store.version("ns")
+    store.putMany("ns", [("b", 2), ("c", 3)])
+    second = store.version("ns")
+    assert(0 < first < second)
+    assert(store.items("ns") == (second, [("a", 1), ("b", 2), ("c", 3)]))
+    #other namespaces are left alone
+    assert(store.version("other") == 0)
+    assert(store.bump("counter") < store.bump("counter"))
+
+def testStoresOnOneFileSeeEachOther(path):
+    #as the processes of the app do
+    first, second = SharedStore(path), SharedStore(path)
+    first.put("ns", "a", 1)
+    assert(second.get("ns", "a") == 1)
+    assert(second.version("ns") == first.version("ns"))
+
+def testReadsDoNotWaitForAWriter(path):
+    writer = SharedStore(path)
+    reader = SharedStore(path, busyTimeout=0.1)
+    writer.put("ns", "a", 1)
+    with writer.transaction() as db:
+        db.execute("INSERT OR REPLACE INTO kv VALUES ('ns', 'a', '2')")
+        #the write isn't committed, and doesn't hold the reader up
+        assert(reader.items("ns")[1] == [("a", 1)])
+    assert(reader.items("ns")[1] == [("a", 2)])
+
+def testWritersTakeTurns(path):
+    writer = SharedStore(path)
+    other = SharedStore(path, busyTimeout=0.1)
+    with writer.transaction():
+        with pytest.raises(sqlite3.OperationalError):
+            other.put("ns", "a", 1)
+
+def testFailedTransactionRollsBack(path):
+    store = SharedStore(path)
+    with pytest.raises(ValueError):
+        with store.transaction() as db:
+            db.execute("INSERT INTO kv VALUES ('ns', 'a', '1')")
+            raise ValueError("abandon")
+    assert(store.get("ns", "a") is None)
+
+def testConnectionPerThread(path):
+    store = SharedStore(path)
+    def write(i):
+        store.put("ns", str(i), i)
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert(len(store.items("ns")[1]) == 8)
+
+def testSharedDict(path):
+    first = SharedDict(SharedStore(path), "filenames",
+            seed=lambda: {"file-1": "a.json"})
+    second = SharedDict(SharedStore(path), "filenames",
+            seed=lambda: {"file-9": "never.json"})
+    #only an empty namespace is seeded
+    assert(dict(second) == {"file-1": "a.json"})
+    first["file-2"] = "b.json"
+    assert(second["file-2"] == "b.json")
+    assert(second.invGet("b.json") == "file-2")
+    assert(second.hasValue("a.json"))
+    second.delete("file-1")
+    assert("file-1" not in first)
+    with pytest.raises(KeyError):
+        first.invGet("a.json")
+
+
+def testConversationBackendKeepsTurnsWithinMaxTokens(path):
+    backend = SqliteConversationBackend(SharedStore(path))
+    before, after = backend.append("s", "p1", "r1", 4, 10)
+    assert(before == 0 and after > 0)
+    backend.append("s", "p2", "r2", 4, 10)
+    version = backend.append("s", "p3", "r3", 4, 10)[1]
+    assert(backend.version("s") == version)
+    assert(backend.load("s") == (version,
+            [("p2", "r2", 4), ("p3", "r3", 4)]))
+    backend.clear("s")
+    assert(backend.load("s") == (0, []))
+
+def testConversationVersionsAreUniqueAcrossStores(path):
+    first = SqliteConversationBackend(SharedStore(path))
+    second = SqliteConversationBackend(SharedStore(path))
+    a = first.append("s", "p", "r", 1, 10)[1]
+    b = second.append("t", "p", "r", 1, 10)[1]
+    assert(a != b)
+    assert(second.load("s")[0] == a)
+
+def testLoadingASessionKeepsItFromExpiring(path):
+    store = SharedStore(path)
+    backend = SqliteConversationBackend(store, idleSeconds=60.0,
+            expireEvery=0.0)
+    backend.append("read", "p", "r", 1, 10)
+    backend.append("idle", "p", "r", 1, 10)
+    store._connection().execute("UPDATE sessions SET lastUsed = 0")
+    backend.load("read")
+    #appending sweeps for idle sessions
+    backend.append("other", "p", "r", 1, 10)
+    assert(backend.version("read") != 0)
+    assert(backend.load("idle") == (0, []))
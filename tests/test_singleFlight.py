@@ -0,0 +1,116 @@
+import time
+import asyncio
+import threading
+
+import pytest
+
+from singleFlight import SingleFlight
+
+
+def runTogether(count, target):
+    results = [None] * count
+    def run(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def testConcurrentCallsShareOne():
+    flight = SingleFlight("test")
+    calls = []
+    def slow():
+        calls.append(1)
+        time.sleep(0.1)
+        return {"answer": 42}
+    results = runTogether(8, lambda: flight.do("key", slow))
+    assert(len(calls) == 1)
+    #everybody gets the very same object
+    assert(all(result is results[0] for result in results))
+
+def testDifferentKeysDoNotWaitForEachOther():
+    flight = SingleFlight("test")
+    calls = []
+    def slow(key):
+        calls.append(key)
+        time.sleep(0.1)
+        return key
+    start = time.monotonic()
+    results = runTogether(4, lambda: flight.do(threading.get_ident(), slow,
+            threading.get_ident()))
+    assert(time.monotonic() - start < 0.3)
+    assert(len(calls) == 4 and sorted(results) == sorted(calls))
+
+def testTheErrorReachesEveryWaiter():
+    flight = SingleFlight("test")
+    calls = []
+    def fail():
+        calls.append(1)
+        time.sleep(0.1)
+        raise ValueError("api down")
+    results = runTogether(4, lambda: flight.do("key", fail))
+    assert(len(calls) == 1)
+    assert(all(isinstance(result, ValueError) for result in results))
+
+def testNothingIsKeptOnceTheCallIsDone():
+    flight = SingleFlight("test")
+    calls = []
+    def call():
+        calls.append(1)
+        if len(calls) == 1:
+            raise ValueError("first fails")
+        return len(calls)
+    with pytest.raises(ValueError):
+        flight.do("key", call)
+    assert(flight.do("key", call) == 2)
+    assert(flight.do("key", call) == 3)
+    assert(flight._calls == {})
+
+def testAsyncCallsShareOne():
+    flight = SingleFlight("test")
+    calls = []
+    async def slow(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        return [value]
+    async def main():
+        results = await asyncio.gather(*(flight.ado("key", slow, 1)
+                for _ in range(8)), flight.ado("other", slow, 2))
+        #done, so the next call is a call of its own
+        results.append(await flight.ado("key", slow, 3))
+        return results
+    results = asyncio.run(main())
+    assert(calls == [1, 2, 3])
+    assert(all(result is results[0] for result in results[:8]))
+    assert(results[8:] == [[2], [3]])
+    assert(flight._tasks == {})
+
+def testAsyncErrorsReachEveryWaiter():
+    flight = SingleFlight("test")
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("api down")
+    async def main():
+        return await asyncio.gather(*(flight.ado("key", fail)
+                for _ in range(3)), return_exceptions=True)
+    assert(all(isinstance(result, ValueError) for result in
+            asyncio.run(main())))
+
+def testAnAsyncCallerGivingUpLeavesTheCallToTheOthers():
+    flight = SingleFlight("test")
+    async def slow():
+        await asyncio.sleep(0.1)
+        return "done"
+    async def main():
+        impatient = asyncio.ensure_future(flight.ado("key", slow))
+        patient = asyncio.ensure_future(flight.ado("key", slow))
+        await asyncio.sleep(0.01)
+        impatient.cancel()
+        return await patient
+    assert(asyncio.run(main()) == "done")
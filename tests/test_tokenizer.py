@@ -0,0 +1,43 @@
+from tokenizer import Tokenizer, getTokenizer
+
+
+def testCountsMatchGpt2():
+    tokenizer = getTokenizer()
+    assert(tokenizer.countTokens("") == 0)
+    assert(tokenizer.countTokens("hello world") == 2)
+    assert(tokenizer.tokenize("Hello, world!") ==
+            ["Hello", ",", "Ġworld", "!"])
+    assert(tokenizer.countTokens(
+            "The quick brown fox jumps over the lazy dog.") == 10)
+
+def testTokensCoverTheText():
+    tokenizer = getTokenizer()
+    text = "naïve café, 😀 and\n\ttabs"
+    #every byte of the text is in exactly one token
+    assert(tokenizer.truncateLeft(text, len(tokenizer.tokenize(text))) ==
+            text)
+
+def testTruncateLeftKeepsTheEnd():
+    tokenizer = getTokenizer()
+    assert(tokenizer.truncateLeft("hello world", 1) == " world")
+    assert(tokenizer.truncateLeft("hello world", 5) == "hello world")
+    assert(tokenizer.truncateLeft("hello world", 0) == "")
+
+def testTruncateLeftDropsHalfACharacter():
+    tokenizer = getTokenizer()
+    #the emoji is split over two tokens, of which only the last is kept
+    assert(tokenizer.truncateLeft("héllo 😀", 1) == "")
+    assert(tokenizer.truncateLeft("héllo 😀 end", 3) == " 😀 end")
+
+def testWordsAreCached():
+    tokenizer = Tokenizer(cacheSize=16)
+    #" cat" is a word of its own, and comes twice
+    tokenizer.countTokens("the cat cat")
+    hits = tokenizer.cacheInfo().hits
+    assert(hits == 1)
+    tokenizer.countTokens("the cat")
+    assert(tokenizer.cacheInfo().hits == hits + 2)
+    assert(tokenizer.cacheInfo().currsize <= 16)
+
+def testGetTokenizerIsShared():
+    assert(getTokenizer() is getTokenizer())
@@ -0,0 +1,148 @@
+import time
+import asyncio
+
+import pytest
+import requests
+import openai
+
+from transport import Transport, CircuitBreaker, CircuitOpenError
+
+
+class Flaky:
+    '''
+    an sdk call that raises the given errors, one per call, then answers
+    '''
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return "ok"
+
+    async def acall(self, *args, **kwargs):
+        return self(*args, **kwargs)
+
+
+def serverError():
+    return openai.error.APIError("boom", http_status=500)
+
+def notSent():
+    '''
+    @returns APIConnectionError: the way the sdk wraps a refused connection
+    '''
+    try:
+        try:
+            requests.get("http://127.0.0.1:1", timeout=1)
+        except requests.exceptions.RequestException as e:
+            raise openai.error.APIConnectionError("connect failed") from e
+    except openai.error.APIConnectionError as e:
+        return e
+
+def makeTransport(**kwargs):
+    kwargs.setdefault("baseDelay", 0.0)
+    kwargs.setdefault("maxDelay", 0.0)
+    return Transport(**kwargs)
+
+
+def testRetriesTransientErrors():
+    function = Flaky(serverError(), openai.error.Timeout("slow"),
+            openai.error.ServiceUnavailableError("down"))
+    assert(makeTransport().call(function) == "ok")
+    assert(function.calls == 4)
+
+def testGivesUpAfterMaxRetries():
+    function = Flaky(*[serverError() for _ in range(5)])
+    with pytest.raises(openai.error.APIError):
+        makeTransport(maxRetries=2).call(function)
+    assert(function.calls == 3)
+
+def testDoesNotRetryClientErrors():
+    function = Flaky(openai.error.InvalidRequestError("bad", "model"))
+    with pytest.raises(openai.error.InvalidRequestError):
+        makeTransport().call(function)
+    assert(function.calls == 1)
+
+def testNonIdempotentCallsAreNotRetriedAfterTheySent():
+    for error in (serverError(), openai.error.Timeout("slow")):
+        function = Flaky(error)
+        with pytest.raises(type(error)):
+            makeTransport().call(function, idempotent=False)
+        assert(function.calls == 1)
+
+def testNonIdempotentCallsAreRetriedWhenThrottledOrNeverSent():
+    function = Flaky(openai.error.RateLimitError("slow down"), notSent())
+    assert(makeTransport().call(function, idempotent=False) == "ok")
+    assert(function.calls == 3)
+
+def testHonoursRetryAfter():
+    error = openai.error.RateLimitError("slow down",
+            headers={"Retry-After": "2"})
+    transport = makeTransport(maxDelay=30.0)
+    assert(transport._delay(error, 0) == 2.0)
+    #but never longer than maxDelay
+    assert(makeTransport(maxDelay=1.0)._delay(error, 0) == 1.0)
+
+def testBreakerOpensAndLetsOneTrialThrough():
+    breaker = CircuitBreaker(failureThreshold=2, resetSeconds=0.05)
+    breaker.failure()
+    breaker.before()
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+    time.sleep(0.06)
+    breaker.before()
+    #only the one trial
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+    breaker.success()
+    assert(not breaker.isOpen())
+    breaker.before()
+
+def testFailingTrialOpensTheBreakerAgain():
+    breaker = CircuitBreaker(failureThreshold=2, resetSeconds=0.05)
+    breaker.failure()
+    breaker.failure()
+    time.sleep(0.06)
+    breaker.before()
+    breaker.failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.before()
+
+def testTransportFailsFastOnceTheBreakerOpens():
+    transport = makeTransport(maxRetries=0,
+            breaker=CircuitBreaker(failureThreshold=2, resetSeconds=60.0))
+    for _ in range(2):
+        with pytest.raises(openai.error.APIError):
+            transport.call(Flaky(serverError()))
+    function = Flaky()
+    with pytest.raises(CircuitOpenError):
+        transport.call(function)
+    assert(function.calls == 0)
+
+def testThrottlingDoesNotOpenTheBreaker():
+    breaker = CircuitBreaker(failureThreshold=2, resetSeconds=60.0)
+    transport = makeTransport(maxRetries=0, breaker=breaker)
+    for _ in range(3):
+        with pytest.raises(openai.error.RateLimitError):
+            transport.call(Flaky(openai.error.RateLimitError("slow down")))
+    assert(not breaker.isOpen())
+
+def testAcallRetriesAndTimesOut():
+    async def run():
+        transport = makeTransport(timeout=0.05)
+        try:
+            function = Flaky(serverError())
+            assert(await transport.acall(function.acall) == "ok")
+            assert(function.calls == 2)
+
+            async def hang():
+                await asyncio.sleep(1.0)
+            with pytest.raises(openai.error.Timeout):
+                await transport.acall(hang, idempotent=False)
+        finally:
+            await transport.aclose()
+    asyncio.run(run())
@@ -0,0 +1,175 @@
+import os
+import sys
+import time
+import functools
+
+#the real pattern needs unicode classes, which only the regex package has.
+#without it we approximate \p{L} with [^\W\d_] and \p{N} with \d, which only
+#differs on unusual numerals
+try:
+    import regex as re
+    _PATTERN = (r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+"""
+            r"""| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+except ImportError:
+    import re
+    _PATTERN = (r"""'s|'t|'re|'ve|'m|'ll|'d| ?[^\W\d_]+| ?\d+"""
+            r"""| ?(?:[^\s\w]|_)+|\s+(?!\S)|\s+""")
+
+DEFAULT_MERGES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "TokenizerData", "vocab.bpe")
+
+
+def _bytesToUnicode():
+    '''
+    The byte level bpe works on strings where every byte is one printable
+    character. This is the mapping gpt2 uses for that.
+    @returns dict<int, string>: byte->character
+    '''
+    printable = list(range(ord("!"), ord("~") + 1)) + \
+            list(range(ord("¡"), ord("¬") + 1)) + \
+            list(range(ord("®"), ord("ÿ") + 1))
+    chars = printable[:]
+    n = 0
+    for b in range(256):
+        if b not in printable:
+            printable.append(b)
+            chars.append(256 + n)
+            n += 1
+    return dict(zip(printable, [chr(c) for c in chars]))
+
+
+class Tokenizer:
+    '''
+    Byte level bpe tokenizer of the gpt2/gpt3 family, which covers every
+    model in the model dropdown. For r50k models (davinci, curie, babbage, ada
+    and their fine tunes) counts are exact. text-davinci-003 additionally has
+    tokens for runs of spaces, so for it the count is an upper bound that is
+    only loose on heavily indented text. Works offline from the bundled merges
+    file (TokenizerData/vocab.bpe, the gpt2 merges published by openai).
+    The merge result for every word is kept in a bounded lru cache, so
+    conversation feeds, which repeat the same words over and over, mostly
+    skip the bpe loop.
+    @method tokenize(text) : the tokens of text
+    @method countTokens(text) : the number of tokens in text
+    @method truncateLeft(text, nTokens) : the last nTokens tokens of text
+    '''
+
+    def __init__(self, mergesPath=DEFAULT_MERGES, cacheSize=65536):
+        '''
+        @param string mergesPath: path to a vocab.bpe merges file
+        @param int cacheSize: max number of words whose merges are cached
+        '''
+        with open(mergesPath, 'r', encoding="utf-8") as file:
+            lines = file.read().split("\n")
+        #first line is the version header
+        merges = [tuple(line.split()) for line in lines[1:] if line]
+        self._ranks = {pair: rank for rank, pair in enumerate(merges)}
+        byteEncoder = _bytesToUnicode()
+        #latin-1 maps every byte to the code point of the same value, which
+        #lets str.translate do the byte->character step in one pass
+        self._byteTable = byteEncoder
+        self._byteDecoder = {c: b for b, c in byteEncoder.items()}
+        self._pattern = re.compile(_PATTERN)
+        self._bpe = functools.lru_cache(maxsize=cacheSize)(self._bpeUncached)
+
+    def tokenize(self, text):
+        '''
+        @param string text: the text to split
+        @returns list<string>: the tokens, in the byte->character alphabet
+        '''
+        tokens = []
+        for word in self._pattern.findall(text):
+            tokens.extend(self._bpe(word))
+        return tokens
+
+    def countTokens(self, text):
+        '''
+        @param string text: the text to count
+        @returns int: the number of tokens the api will see
+        '''
+        bpe = self._bpe
+        return sum([len(bpe(word)) for word in self._pattern.findall(text)])
+
+    def truncateLeft(self, text, nTokens):
+        '''
+        cuts text down to its last nTokens tokens
+        @param string text: the text to cut
+        @param int nTokens: number of tokens to keep
+        @returns string: the end of text
+        '''
+        if nTokens <= 0:
+            return ""
+        tokens = self.tokenize(text)
+        if len(tokens) <= nTokens:
+            return text
+        data = bytes(self._byteDecoder[c] for c in "".join(tokens[-nTokens:]))
+        #the cut may land inside a multi byte character
+        return data.decode("utf-8", errors="ignore")
+
+    def cacheInfo(self):
+        '''
+        @returns functools._CacheInfo: hits, misses and size of the word cache
+        '''
+        return self._bpe.cache_info()
+
+    def _bpeUncached(self, word):
+        '''
+        applies the merges to one pre-tokenized word
+        @param string word: a piece of text produced by the split pattern
+        @returns tuple<string>: the tokens of word
+        '''
+        symbols = word.encode("utf-8").decode("latin-1").translate(
+                self._byteTable)
+        parts = list(symbols)
+        ranks = self._ranks
+        while len(parts) > 1:
+            best = None
+            bestRank = None
+            for i in range(len(parts) - 1):
+                rank = ranks.get((parts[i], parts[i + 1]))
+                if rank is not None and (bestRank is None or rank < bestRank):
+                    best = (parts[i], parts[i + 1])
+                    bestRank = rank
+            if best is None:
+                break
+            merged = []
+            i = 0
+            while i < len(parts):
+                if i < len(parts) - 1 and \
+                        parts[i] == best[0] and parts[i + 1] == best[1]:
+                    merged.append(best[0] + best[1])
+                    i += 2
+                else:
+                    merged.append(parts[i])
+                    i += 1
+            parts = merged
+        return tuple(parts)
+
+
+_tokenizer = None
+
+def getTokenizer():
+    '''
+    @returns Tokenizer: the process wide tokenizer, loaded on first use so the
+      word cache is shared by everyone counting tokens
+    '''
+    global _tokenizer
+    if _tokenizer is None:
+        _tokenizer = Tokenizer()
+    return _tokenizer
+
+
+if __name__ == "__main__":
+    #benchmark: python tokenizer.py FILE [FILE ...]
+    tokenizer = getTokenizer()
+    for path in sys.argv[1:]:
+        with open(path, 'r', encoding="utf-8") as file:
+            text = file.read()
+        size = len(text.encode("utf-8")) / 1e6
+        for label in ("cold", "warm"):
+            start = time.perf_counter()
+            count = tokenizer.countTokens(text)
+            elapsed = time.perf_counter() - start
+            print("{} {}: {} tokens, {:.2f} MB in {:.3f}s, {:.2f} MB/s".format(
+                path, label, count, size, elapsed, size / elapsed))
+        print(tokenizer.cacheInfo())
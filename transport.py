@@ -0,0 +1,329 @@
+import time
+import random
+import asyncio
+import threading
+import weakref
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+
+import aiohttp
+import requests
+import urllib3
+import openai
+from openai import api_requestor
+
+
+class CircuitOpenError(Exception):
+    '''
+    raised instead of calling the api while the circuit breaker is open
+    '''
+    pass
+
+
+class CircuitBreaker:
+    '''
+    Stops calls to an api that keeps failing. After failureThreshold failures
+    in a row the breaker opens and every call fails fast for resetSeconds.
+    Then one trial call is let through: success closes the breaker, failure
+    opens it again.
+    @method before() : call before a request, raises if open
+    @method success() : report a successful request
+    @method failure() : report a failed request
+    '''
+
+    def __init__(self, failureThreshold=5, resetSeconds=30.0):
+        '''
+        @param int failureThreshold: failures in a row that open the breaker
+        @param float resetSeconds: how long the breaker stays open
+        '''
+        self._failureThreshold = failureThreshold
+        self._resetSeconds = resetSeconds
+        self._failures = 0
+        self._openedAt = None
+        self._trialRunning = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        '''
+        @throws CircuitOpenError: if the breaker is open
+        '''
+        with self._lock:
+            if self._openedAt is None:
+                return
+            if time.monotonic() - self._openedAt < self._resetSeconds or \
+                    self._trialRunning:
+                raise CircuitOpenError("api circuit breaker is open")
+            self._trialRunning = True
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._openedAt = None
+            self._trialRunning = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trialRunning or self._failures >= self._failureThreshold:
+                self._openedAt = time.monotonic()
+            self._trialRunning = False
+
+    def isOpen(self):
+        with self._lock:
+            return self._openedAt is not None
+
+
+class _TimeoutAdapter(requests.adapters.HTTPAdapter):
+    '''
+    HTTPAdapter whose timeout can be set per call from the calling thread.
+    The openai sdk always passes its own 600 second timeout, which this
+    replaces.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        self.local = threading.local()
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        override = getattr(self.local, "timeout", None)
+        if override is not None:
+            timeout = override
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+class Transport:
+    '''
+    What ApiManager calls the openai sdk through. It gives the sdk one
+    keep-alive connection pool shared by every thread, puts a timeout on every
+    call, retries throttled (429) and transient (5xx, timeout, connection)
+    failures with exponential backoff and full jitter, honouring Retry-After,
+    and trips a circuit breaker when the api keeps failing.
+    acall does the same for the sdk's async functions (acreate, alist...),
+    which share one aiohttp connection pool per event loop.
+    Given a scheduler.ApiScheduler, every attempt, retries included, first
+    waits for its turn and rate limit budget there.
+    Calls that are not idempotent, like creating a fine tune, are only
+    retried when the api surely didn't act on them: when throttled, or when
+    the connection failed before the request was sent. A timeout or a 5xx
+    may come after the api started the work, and a second attempt would do
+    it twice.
+    @method call(function, *args, timeout=None, tokens=0, idempotent=True,
+      **kwargs) : calls through
+    @method acall(function, *args, timeout=None, tokens=0, idempotent=True,
+      **kwargs) : awaits through
+    @method aclose() : closes the aiohttp pool of the running loop
+    '''
+
+    def __init__(self, timeout=60.0, maxRetries=4, baseDelay=0.5,
+            maxDelay=30.0, poolSize=32, breaker=None, asyncPoolSize=512,
+            scheduler=None):
+        '''
+        @param float timeout: default seconds a call may take, per attempt
+        @param int maxRetries: retries after the first attempt
+        @param float baseDelay: backoff of the first retry, doubling after
+        @param float maxDelay: longest wait between attempts
+        @param int poolSize: keep-alive connections kept per host
+        @param CircuitBreaker breaker: defaults to a CircuitBreaker()
+        @param int asyncPoolSize: connections acall keeps open at once
+        @param ApiScheduler scheduler: paces and orders the calls, optional
+        '''
+        self._timeout = timeout
+        self._maxRetries = maxRetries
+        self._baseDelay = baseDelay
+        self._maxDelay = maxDelay
+        self._breaker = breaker if breaker is not None else CircuitBreaker()
+        self._scheduler = scheduler
+        self._adapter = _TimeoutAdapter(pool_connections=4,
+                pool_maxsize=poolSize, max_retries=0)
+        self._session = requests.Session()
+        self._session.mount("https://", self._adapter)
+        self._session.mount("http://", self._adapter)
+        self._asyncPoolSize = asyncPoolSize
+        #event loop->aiohttp session
+        self._aioSessions = weakref.WeakKeyDictionary()
+
+    def call(self, function, *args, timeout=None, tokens=0, idempotent=True,
+            **kwargs):
+        '''
+        calls function (an openai sdk call) with retries
+        @param function: the sdk function
+        @param float timeout: seconds per attempt, defaults to the transport's
+        @param int tokens: tokens the call may use, for the scheduler
+        @param bool idempotent: false for calls that must not run twice
+        @returns whatever function returns
+        @throws CircuitOpenError: if the breaker is open
+        @throws SchedulerBusyError: if the scheduler sheds the call
+        @throws openai.error.OpenAIError: once retries are used up, or right
+          away for errors retrying can't fix
+        '''
+        self._installSession()
+        self._adapter.local.timeout = \
+                timeout if timeout is not None else self._timeout
+        attempt = 0
+        try:
+            while True:
+                if self._scheduler is not None:
+                    self._scheduler.acquire(tokens)
+                self._breaker.before()
+                try:
+                    result = function(*args, **kwargs)
+                except openai.error.OpenAIError as e:
+                    time.sleep(self._onError(e, attempt, idempotent))
+                    attempt += 1
+                    continue
+                except Exception:
+                    #not an api error we know, so no retry, but it still ends
+                    #a trial call
+                    self._breaker.failure()
+                    raise
+                self._breaker.success()
+                return result
+        finally:
+            self._adapter.local.timeout = None
+
+    async def acall(self, function, *args, timeout=None, tokens=0,
+            idempotent=True, **kwargs):
+        '''
+        awaits function (an async openai sdk call) with retries, like call
+        @param function: the async sdk function
+        @param float timeout: seconds per attempt, defaults to the transport's
+        @param int tokens: tokens the call may use, for the scheduler
+        @param bool idempotent: false for calls that must not run twice
+        @returns whatever function returns
+        @throws CircuitOpenError: if the breaker is open
+        @throws SchedulerBusyError: if the scheduler sheds the call
+        @throws openai.error.OpenAIError: once retries are used up, or right
+          away for errors retrying can't fix
+        '''
+        openai.aiosession.set(self._aioSession())
+        timeout = timeout if timeout is not None else self._timeout
+        attempt = 0
+        while True:
+            if self._scheduler is not None:
+                await self._scheduler.aacquire(tokens)
+            self._breaker.before()
+            try:
+                try:
+                    result = await asyncio.wait_for(
+                            function(*args, **kwargs), timeout)
+                except asyncio.TimeoutError as e:
+                    raise openai.error.Timeout("Request timed out") from e
+            except openai.error.OpenAIError as e:
+                await asyncio.sleep(self._onError(e, attempt, idempotent))
+                attempt += 1
+                continue
+            except Exception:
+                self._breaker.failure()
+                raise
+            self._breaker.success()
+            return result
+
+    async def aclose(self):
+        session = self._aioSessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def _aioSession(self):
+        '''
+        @returns aiohttp.ClientSession: the pool of the running event loop
+        '''
+        loop = asyncio.get_running_loop()
+        session = self._aioSessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                    limit=self._asyncPoolSize))
+            self._aioSessions[loop] = session
+        return session
+
+    def _onError(self, error, attempt, idempotent=True):
+        '''
+        tells the breaker about a failed attempt, and decides on a retry
+        @param openai.error.OpenAIError error: what the attempt raised
+        @param int attempt: attempts so far, less one
+        @param bool idempotent: whether the call may safely run twice
+        @returns float: seconds to wait before retrying
+        @throws error: when it shouldn't be retried
+        '''
+        retry, breakerFailure = self._classify(error)
+        if retry and not idempotent:
+            retry = isinstance(error, openai.error.RateLimitError) or \
+                    self._notSent(error)
+        if breakerFailure:
+            self._breaker.failure()
+        else:
+            #the api answered, so as far as the breaker cares it is up
+            self._breaker.success()
+        if not retry or attempt >= self._maxRetries:
+            raise error
+        return self._delay(error, attempt)
+
+    def _installSession(self):
+        #the sdk keeps one session per thread in a private thread local. We
+        #hand it ours, so every thread shares the one pool
+        if getattr(api_requestor._thread_context, "session", None) is not \
+                self._session:
+            api_requestor._thread_context.session = self._session
+
+    def _classify(self, error):
+        '''
+        @returns tuple<bool>: whether to retry, whether it counts against the
+          circuit breaker
+        '''
+        if isinstance(error, openai.error.RateLimitError):
+            #throttling says the api is up, so the breaker stays closed
+            return True, False
+        if isinstance(error, (openai.error.ServiceUnavailableError,
+                openai.error.Timeout, openai.error.APIConnectionError,
+                openai.error.TryAgain)):
+            return True, True
+        if isinstance(error, openai.error.APIError):
+            status = error.http_status
+            transient = status is None or status >= 500
+            return transient, transient
+        return False, False
+
+    @staticmethod
+    def _notSent(error):
+        '''
+        @returns bool: whether error is a connection failure from before the
+          request went out, so the api never saw it
+        '''
+        cause = error.__cause__
+        if isinstance(cause, (requests.exceptions.ConnectTimeout,
+                aiohttp.ClientConnectorError)):
+            return True
+        if isinstance(cause, requests.exceptions.ConnectionError):
+            #requests wraps urllib3's MaxRetryError, whose reason is the
+            #error of the last attempt to connect
+            reason = cause.args[0] if cause.args else None
+            reason = getattr(reason, "reason", reason)
+            return isinstance(reason, urllib3.exceptions.NewConnectionError)
+        return False
+
+    def _delay(self, error, attempt):
+        '''
+        @returns float: seconds to wait before the next attempt
+        '''
+        retryAfter = self._retryAfter(error)
+        if retryAfter is not None:
+            return min(retryAfter, self._maxDelay)
+        return random.uniform(0, min(self._maxDelay,
+                self._baseDelay * 2 ** attempt))
+
+    def _retryAfter(self, error):
+        '''
+        @returns float: seconds the Retry-After header asks for, or None
+        '''
+        headers = getattr(error, "headers", None) or {}
+        value = headers.get("Retry-After") or headers.get("retry-after")
+        if value is None:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())